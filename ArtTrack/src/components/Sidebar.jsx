@@ -34,6 +34,23 @@ export default function Sidebar() {
         }
     };
 
+    // scans run in the background on the scan server, poll until the job finishes
+    const waitForScan = async (jobId) => {
+        while (true) {
+            const response = await fetch(`http://localhost:8000/images/scan/${jobId}`, {
+                method: "GET"
+            });
+            if (!response.ok) {
+                throw new Error('Error fetching scan status');
+            }
+            const job = await response.json();
+            if (job.status === 'done' || job.status === 'failed') {
+                return job;
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    };
+
     const handleScan = async (e) => {
         if (!UserId) {
             console.error("User ID not found");
@@ -50,6 +67,10 @@ export default function Sidebar() {
                 throw new Error('Error uploading image');
             } else {
                 const data = await response.json();
+                const job = await waitForScan(data.job_id);
+                if (job.status === 'failed') {
+                    throw new Error(job.error);
+                }
                 alert("scan is completed!");
                 const currentTime = new Date();
                 const formattedTime = `${currentTime.getMonth() + 1}/${currentTime.getDate()}/${currentTime.getFullYear()}, ${currentTime.getHours()}:${currentTime.getMinutes()}:${currentTime.getSeconds()}`;
@@ -9,7 +9,7 @@ import torchvision.transforms as transforms
 from torchvision import models
 from PIL import Image
 import faiss
-from typing import List
+from typing import List, Tuple
 
 # configuration
 USER_IMAGES_DIR = 'algorithm/user_images'
@@ -35,27 +35,29 @@ class FeatureExtractor:
             transforms.ToTensor(),
         ])
 
-    def extract_features(self, image_paths: List[str]) -> np.ndarray:
+    def extract_features(self, image_paths: List[str]) -> Tuple[np.ndarray, List[str]]:
         """
         extract feature vectors from a list of image paths
 
         :param image_paths: list of image file paths
-        :return: numpy array of feature vectors
+        :return: numpy array of feature vectors and the paths they belong to, images that failed to decode are left out
         """
         images = []
+        kept_paths = []
         for image_path in image_paths:
             try:
                 image = Image.open(image_path).convert('RGB')
                 image = self.transform(image)
                 images.append(image)
+                kept_paths.append(image_path)
             except Exception as e:
                 logging.error(f"error processing image {image_path}: {e}")  # log error if image processing fails
         if not images:
-            return np.array([])
+            return np.array([]), []
         images = torch.stack(images).to(self.device)
         with torch.no_grad():
             features = self.model(images)
-        return features.cpu().numpy()
+        return features.cpu().numpy(), kept_paths
 
 
 def load_image_paths(directory: str) -> List[str]:
@@ -97,10 +99,10 @@ def main():
     user_filenames = []
     for i in range(0, len(user_image_paths), BATCH_SIZE):
         batch_paths = user_image_paths[i:i+BATCH_SIZE]
-        features = extractor.extract_features(batch_paths)
-        if features.size > 0:
+        features, kept_paths = extractor.extract_features(batch_paths)
+        if kept_paths:
             user_vectors.append(features)
-            user_filenames.extend([os.path.basename(p) for p in batch_paths])  # keep track of filenames
+            user_filenames.extend([os.path.basename(p) for p in kept_paths])  # only images that decoded
     if not user_vectors:
         logging.error("no user images were processed successfully")
         sys.exit(1)
@@ -121,10 +123,10 @@ def main():
     new_filenames = []
     for i in range(0, len(new_image_paths), BATCH_SIZE):
         batch_paths = new_image_paths[i:i+BATCH_SIZE]
-        features = extractor.extract_features(batch_paths)
-        if features.size > 0:
+        features, kept_paths = extractor.extract_features(batch_paths)
+        if kept_paths:
             new_vectors.append(features)
-            new_filenames.extend([os.path.basename(p) for p in batch_paths])  # keep track of filenames
+            new_filenames.extend([os.path.basename(p) for p in kept_paths])  # only images that decoded
     if not new_vectors:
         logging.error("no new images were processed successfully")
         sys.exit(1)
@@ -1,63 +1,223 @@
 import os
-import sys
 import logging
 import numpy as np
 import torch
-from torch import nn
-from torch.utils.data import DataLoader
-import torchvision.transforms as transforms
-from torchvision import models
+import threading
+from torch.utils.data import DataLoader, Dataset
 from PIL import Image
-import faiss
-from typing import List
-import json
+from typing import Iterator, List, Optional, Tuple
+import time
+
+from backbones import BACKBONE, BACKBONE_WEIGHTS_FILE, embedding_dimension, load_backbone, model_id
+from image_manifest import ImageManifest, ManifestEntry
+from inference_backends import INFERENCE_BACKEND, CALIBRATION_BATCHES, CHANNELS_LAST, build_backend, configure_threads
+from metrics import IMAGES, STAGE_SECONDS, timed
 
  
 # configuration
 USER_IMAGES_DIR = 'images/users-images'
 NEW_IMAGES_DIR = 'images/internet-images'
 BATCH_SIZE = 16
-NUM_NEIGHBORS = 5
-IMAGE_SIZE = (224, 224)
+NUM_WORKERS = min(4, os.cpu_count() or 1)  # processes decoding images in parallel with inference
+PREFETCH_FACTOR = 2  # batches each worker decodes ahead
+IMAGE_SIZE = (224, 224)  # (height, width) of the model input
+IMAGENET_MEAN = (0.485, 0.456, 0.406)  # the torchvision backbones were trained on inputs normalized with these
+IMAGENET_STD = (0.229, 0.224, 0.225)
+DRAFT_DECODE = True  # let libjpeg decode large JPEGs at 1/2, 1/4 or 1/8 scale, still at least IMAGE_SIZE
+RESIZE_FILTER = Image.BILINEAR
+PREPROCESSING_VERSION = 2  # part of the model id, bump whenever decoding or normalisation changes the embeddings
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(message)s')  # remove timestamp
 
 
+def decode_image(image: Image.Image) -> torch.Tensor:
+    """
+    decode at reduced scale where the format allows it and resize on uint8 data
+
+    :param image: opened PIL image, drafting only helps before its pixels are loaded
+    :return: (height, width, 3) uint8 tensor of IMAGE_SIZE
+    """
+    size = (IMAGE_SIZE[1], IMAGE_SIZE[0])
+    if DRAFT_DECODE:
+        image.draft('RGB', size)  # JPEG only, other formats ignore it
+    return torch.from_numpy(np.array(image.convert('RGB').resize(size, RESIZE_FILTER)))
+
+
+class ImagePathDataset(Dataset):
+    """dataset over image paths, images are decoded and resized inside DataLoader workers"""
+
+    def __init__(self, image_paths: List[str]):
+        self.image_paths = image_paths
+
+    def __len__(self) -> int:
+        return len(self.image_paths)
+
+    def __getitem__(self, idx: int) -> Tuple[Optional[torch.Tensor], int]:
+        image_path = self.image_paths[idx]
+        try:
+            with Image.open(image_path) as image:
+                return decode_image(image), idx
+        except Exception as e:
+            logging.error(f"error processing image {image_path}: {e}")  # log error if image processing fails
+            return None, idx
+
+
+def collate_decoded(batch: List[Tuple[Optional[torch.Tensor], int]]) -> Tuple[Optional[torch.Tensor], List[int]]:
+    """stack the decoded images of a batch, dropping failed ones but keeping the index of every kept item"""
+    kept = [(image, idx) for image, idx in batch if image is not None]
+    if not kept:
+        return None, []
+    return torch.stack([image for image, _ in kept]), [idx for _, idx in kept]
+
+
 class FeatureExtractor:
-    def __init__(self, device: torch.device = DEVICE):
-        """initialize the feature extractor with a pre-trained model"""
+    def __init__(self, device: torch.device = DEVICE, batch_size: int = BATCH_SIZE, num_workers: int = NUM_WORKERS,
+                 backend: str = INFERENCE_BACKEND, calibration_paths: Optional[List[str]] = None,
+                 backbone: str = BACKBONE, weights_file: Optional[str] = BACKBONE_WEIGHTS_FILE):
+        """
+        initialize the feature extractor with a pre-trained model
+
+        :param backbone: model producing the embeddings, see backbones.BACKBONES
+        :param weights_file: local weights of the backbone, downloaded ImageNet weights if None
+        :param backend: inference backend, see inference_backends.INFERENCE_BACKENDS
+        :param calibration_paths: representative images for the int8 calibration and the backend parity check,
+            the user images by default
+        """
         self.device = device
-        self.model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
-        self.model.fc = nn.Identity()  # remove the last layer
-        self.model.to(self.device)
-        self.model.eval()
-        self.transform = transforms.Compose([
-            transforms.Resize(IMAGE_SIZE),
-            transforms.ToTensor(),
-        ])
-
-    def extract_features(self, image_paths: List[str]) -> np.ndarray:
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.model = load_backbone(backbone, weights_file).to(self.device)
+        self.model_id = f"{model_id(backbone, weights_file)}-pre{PREPROCESSING_VERSION}"  # stored with every embedding
+        self.dimension = embedding_dimension(backbone)
+        # uint8 pixels are normalized in one multiply-add: (x / 255 - mean) / std = x * scale + shift
+        std = torch.tensor(IMAGENET_STD, device=self.device).view(1, 3, 1, 1)
+        self.scale = 1 / (255 * std)
+        self.shift = -torch.tensor(IMAGENET_MEAN, device=self.device).view(1, 3, 1, 1) / std
+        self.buffers = threading.local()  # one reusable input batch per thread, scans and uploads run concurrently
+        if self.device.type == 'cpu':
+            configure_threads()
+        elif backend in ('onnx', 'int8'):
+            logging.warning(f"{backend} inference backend runs on CPU only, using eager mode on {self.device}")
+            backend = 'eager'
+        calibration = self.calibration_batches(calibration_paths) if backend != 'eager' else []
+        example = calibration[0] if calibration else torch.rand((self.batch_size, 3, *IMAGE_SIZE), device=self.device)
+        self.infer = build_backend(backend, self.model, example, calibration=calibration, model_id=self.model_id)
+
+    def prepare_batch(self, images: torch.Tensor) -> torch.Tensor:
+        """
+        normalize a batch of decoded images into the model input buffer of the calling thread
+
+        :param images: (N, height, width, 3) uint8 images
+        :return: (N, 3, height, width) float32 view of the buffer, overwritten by the thread's next call
+        """
+        buffer = getattr(self.buffers, 'batch', None)
+        if buffer is None or len(buffer) < len(images):
+            memory_format = torch.channels_last if CHANNELS_LAST else torch.contiguous_format
+            buffer = torch.empty((max(len(images), self.batch_size), 3, *IMAGE_SIZE), device=self.device)
+            buffer = buffer.to(memory_format=memory_format)
+            self.buffers.batch = buffer
+        batch = buffer[:len(images)]
+        # an NHWC uint8 batch viewed as NCHW, converted, scaled and shifted in a single kernel
+        torch.addcmul(self.shift, images.to(self.device, non_blocking=True).permute(0, 3, 1, 2), self.scale, out=batch)
+        return batch
+
+    def calibration_batches(self, image_paths: Optional[List[str]] = None) -> List[torch.Tensor]:
+        """decode up to CALIBRATION_BATCHES batches of representative images"""
+        if image_paths is None:
+            image_paths = load_image_paths(USER_IMAGES_DIR) if os.path.isdir(USER_IMAGES_DIR) else []
+        batches = []
+        for images, _ in DataLoader(ImagePathDataset(image_paths[:CALIBRATION_BATCHES * self.batch_size]),
+                                    batch_size=self.batch_size, collate_fn=collate_decoded):
+            if images is not None:
+                batches.append(self.prepare_batch(images).clone())  # kept, so not the shared buffer
+        return batches
+
+    def iter_features(self, image_paths: List[str]) -> Iterator[Tuple[np.ndarray, List[str]]]:
+        """
+        stream feature vectors batch by batch, decoding the next batches while the model runs
+
+        :param image_paths: list of image file paths
+        :return: iterator of (feature vectors, paths of the images that decoded) per batch
+        """
+        num_workers = self.num_workers if len(image_paths) > self.batch_size else 0  # not worth spawning for one batch
+        loader_options = {'prefetch_factor': PREFETCH_FACTOR, 'persistent_workers': False} if num_workers else {}
+        loader = DataLoader(
+            ImagePathDataset(image_paths),
+            batch_size=self.batch_size,
+            num_workers=num_workers,
+            collate_fn=collate_decoded,
+            pin_memory=self.device.type == 'cuda',
+            **loader_options
+        )
+        start, embedded = time.perf_counter(), 0
+        waited = start
+        for images, indices in loader:
+            # with loader workers the decoding happens in other processes, only the time spent waiting on it shows
+            STAGE_SECONDS.observe(time.perf_counter() - waited, stage='load')
+            if images is not None:  # None when the whole batch failed to decode
+                with timed('inference'):
+                    features = self.infer(self.prepare_batch(images)).cpu().numpy()
+                embedded += len(indices)
+                IMAGES.inc(len(indices), stage='embedded')
+                yield features, [image_paths[i] for i in indices]
+            waited = time.perf_counter()
+        elapsed = time.perf_counter() - start
+        if embedded:
+            logging.info(f"embedded {embedded} images in {elapsed:.2f}s ({embedded / elapsed:.1f} images/sec)")
+
+    def extract_images(self, images: List[Image.Image]) -> np.ndarray:
+        """
+        extract feature vectors from images already decoded in memory, e.g. straight from the downloader
+
+        :param images: list of PIL images
+        :return: numpy array of feature vectors, one per image
+        """
+        with timed('load'):
+            batch = self.prepare_batch(torch.stack([decode_image(image) for image in images]))
+        with timed('inference'):
+            features = self.infer(batch).cpu().numpy()
+        IMAGES.inc(len(images), stage='embedded')
+        return features
+
+    def extract_features(self, image_paths: List[str]) -> Tuple[np.ndarray, List[str]]:
         """
         extract feature vectors from a list of image paths
 
         :param image_paths: list of image file paths
-        :return: numpy array of feature vectors
+        :return: numpy array of feature vectors and the paths they belong to, images that failed to decode are left out
         """
-        images = []
-        for image_path in image_paths:
-            try:
-                image = Image.open(image_path).convert('RGB')
-                image = self.transform(image)
-                images.append(image)
-            except Exception as e:
-                logging.error(f"error processing image {image_path}: {e}")  # log error if image processing fails
-        if not images:
-            return np.array([])
-        images = torch.stack(images).to(self.device)
-        with torch.no_grad():
-            features = self.model(images)
-        return features.cpu().numpy()
+        vectors = []
+        kept_paths = []
+        for features, paths in self.iter_features(image_paths):
+            vectors.append(features)
+            kept_paths.extend(paths)
+        if not vectors:
+            return np.array([]), []
+        return np.vstack(vectors), kept_paths
+
+
+_manifest: Optional[ImageManifest] = None
+_manifest_lock = threading.Lock()
+
+
+def image_manifest() -> ImageManifest:
+    """:return: the process-wide manifest of image directories, opened on first use"""
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            _manifest = ImageManifest()
+        return _manifest
+
+
+def load_image_entries(directory: str) -> List[ManifestEntry]:
+    """
+    list the images of a directory with their size, mtime, format and dimensions, probing only new or changed files
+
+    :param directory: directory to search for images
+    :return: manifest entries sorted by path
+    """
+    return image_manifest().scan(directory)
 
 
 def load_image_paths(directory: str) -> List[str]:
@@ -65,92 +225,12 @@ def load_image_paths(directory: str) -> List[str]:
     load image file paths from a directory, filtering by supported formats
 
     :param directory: directory to search for images
-    :return: list of image file paths
+    :return: list of image file paths, sorted
     """
-    
-    image_paths = []
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        try:
-            with Image.open(file_path) as img:
-                image_paths.append(file_path)
-        except (IOError, ValueError): continue
-    return image_paths
+    return [entry.path for entry in load_image_entries(directory)]
 
 
 def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
     """normalize vectors to unit length"""
     norms = np.linalg.norm(vectors, axis=1, keepdims=True)
     return vectors / norms
-
-
-def scan():
-    # load image paths
-    user_image_paths = load_image_paths(USER_IMAGES_DIR)
-    new_image_paths = load_image_paths(NEW_IMAGES_DIR)
-    logging.info(f"found {len(user_image_paths)} user images")
-    logging.info(f"found {len(new_image_paths)} new images")
-
-    # initialize feature extractor
-    extractor = FeatureExtractor()
-
-    # extract features for user images
-    user_vectors = []
-    user_filenames = []
-    for i in range(0, len(user_image_paths), BATCH_SIZE):
-        batch_paths = user_image_paths[i:i+BATCH_SIZE]
-        features = extractor.extract_features(batch_paths)
-        if features.size > 0:
-            user_vectors.append(features)
-            user_filenames.extend([os.path.basename(p) for p in batch_paths])  # keep track of filenames
-    if not user_vectors:
-        logging.error("no user images were processed successfully")
-        sys.exit(1)
-    user_vectors = np.vstack(user_vectors).astype('float32')
-    user_vectors = normalize_vectors(user_vectors)  # normalize user vectors
-    # print("\nUSER VECTORS", user_vectors)
-    # print("\nUSER FILENAMES", user_filenames)
-    
-    # build faiss index
-    dimension = user_vectors.shape[1]
-    index = faiss.IndexFlatIP(dimension)  # use inner product for cosine similarity
-    index.add(user_vectors)
-    logging.info(f"faiss index created with dimension {dimension}")
-    # faiss.write_index(index, "user_vector_index.faiss")
-
-    # extract features for new images
-    new_vectors = []
-    new_filenames = []
-    for i in range(0, len(new_image_paths), BATCH_SIZE):
-        batch_paths = new_image_paths[i:i+BATCH_SIZE]
-        features = extractor.extract_features(batch_paths)
-        if features.size > 0:
-            new_vectors.append(features)
-            new_filenames.extend([os.path.basename(p) for p in batch_paths])  # keep track of filenames
-    if not new_vectors:
-        logging.error("no new images were processed successfully")
-        sys.exit(1)
-    new_vectors = np.vstack(new_vectors).astype('float32')
-    new_vectors = normalize_vectors(new_vectors)  # normalize new vectors
-    # print("\nNEW VECTORS", new_vectors)
-    # print("\nNEW FILENAMES", new_filenames)
-
-    # search for nearest neighbors
-    matches = []
-    distances, indices = index.search(new_vectors, NUM_NEIGHBORS)
-    for i, new_filename in enumerate(new_filenames):
-        # logging.info(f"nearest images to {new_filename}:")
-        for similarity, idx in zip(distances[i], indices[i]):
-            user_filename = user_filenames[idx]
-            percentage_similarity = ((similarity + 1) / 2) * 100  # map from [-1,1] to [0,100]
-            # logging.info(f" - {user_filename}, similarity: {percentage_similarity:.2f}%")  # output with percentage
-            if percentage_similarity >= 90:
-                matched_image = {
-                    "new_filename": new_filename,
-                    "user_filename": user_filenames[idx],
-                    "similarity": percentage_similarity
-                }
-                matches.append(matched_image)
-    return matches
-
-# we find matches for ne images from users images
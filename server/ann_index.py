@@ -0,0 +1,190 @@
+import math
+import logging
+import numpy as np
+import faiss
+from typing import Optional, Tuple, Union
+
+from mapped_index import MAPPED_INDEX_DIR, MappedIndex
+
+# configuration
+INDEX_MODE = 'auto'  # 'flat', 'ivf', 'hnsw', 'ivfpq', 'mapped' or 'auto' to choose by corpus size
+INDEX_MODES = ('flat', 'ivf', 'hnsw', 'ivfpq', 'mapped')  # 'auto' never chooses 'ivfpq' or 'mapped'
+FLAT_MAX_VECTORS = 50_000  # exact search stays fast enough below this
+HNSW_MAX_VECTORS = 500_000  # graph memory overhead is acceptable below this
+IVF_NPROBE = 32  # inverted lists visited per query
+HNSW_M = 32  # graph neighbours per node
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 128  # candidate list size per query
+PQ_M = 64  # sub-quantizers for IVF-PQ, one byte each per vector at 8 bits
+PQ_NBITS = 8
+REFINE_K_FACTOR = 4  # IVF-PQ candidates re-ranked exactly per requested neighbour, PQ scores alone miss the threshold
+MIN_POINTS_PER_CENTROID = 39  # faiss warns about undertrained clusters below this
+SIMILARITY_THRESHOLD = 90  # default percentage similarity reported as a match
+RANGE_FALLBACK_K = 64  # neighbours fetched per query when an index has no range search
+
+
+def choose_index_mode(num_vectors: int) -> str:
+    """
+    pick an index type for a corpus of the given size
+
+    :param num_vectors: number of vectors to index
+    :return: one of INDEX_MODES
+    """
+    if num_vectors < FLAT_MAX_VECTORS:
+        return 'flat'
+    if num_vectors < HNSW_MAX_VECTORS:
+        return 'hnsw'
+    return 'ivf'  # ivfpq keeps the full vectors for re-ranking too, it is faster to scan but never smaller
+
+
+def resolve_index_mode(mode: str, num_vectors: int) -> str:
+    """
+    resolve 'auto' and fall back to flat when there are too few vectors to train an IVF quantizer
+
+    :param mode: configured mode
+    :param num_vectors: number of vectors to index
+    :return: one of INDEX_MODES
+    """
+    if mode == 'auto':
+        mode = choose_index_mode(num_vectors)
+    if mode not in INDEX_MODES:
+        raise ValueError(f"unknown index mode {mode}, expected one of {INDEX_MODES} or 'auto'")
+    min_train = {'ivf': MIN_POINTS_PER_CENTROID * 4, 'ivfpq': MIN_POINTS_PER_CENTROID * 2 ** PQ_NBITS}.get(mode, 0)
+    if num_vectors < min_train:
+        logging.warning(f"only {num_vectors} vectors, too few to train {mode}, using flat index")
+        return 'flat'
+    return mode
+
+
+def ivf_nlist(num_vectors: int) -> int:
+    """number of inverted lists, about 4*sqrt(N) while keeping enough training points per list"""
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def pq_subquantizers(dimension: int) -> int:
+    """largest sub-quantizer count up to PQ_M that divides the dimension"""
+    return next(m for m in range(min(PQ_M, dimension), 0, -1) if dimension % m == 0)
+
+
+def build_index(vectors: np.ndarray, ids: np.ndarray, mode: str, dimension: int = None) -> Union[faiss.Index, MappedIndex]:
+    """
+    build an inner-product index over normalized vectors, training it on them when needed
+
+    :param vectors: (N, D) float32 unit vectors
+    :param ids: int64 ids to store with the vectors
+    :param mode: one of INDEX_MODES, see resolve_index_mode
+    :param dimension: vector dimension, needed when vectors is empty
+    :return: index supporting add_with_ids
+    """
+    dimension = dimension or vectors.shape[1]
+    if mode == 'mapped':
+        # compact codes on disk, shared by every process that maps MAPPED_INDEX_DIR
+        return MappedIndex.build(MAPPED_INDEX_DIR, vectors, ids, dimension=dimension)
+    metric = faiss.METRIC_INNER_PRODUCT  # inner product on unit vectors = cosine
+    if mode == 'flat':
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+    elif mode == 'hnsw':
+        hnsw = faiss.IndexHNSWFlat(dimension, HNSW_M, metric)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+        index = faiss.IndexIDMap2(hnsw)
+    elif mode == 'ivf':
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFFlat(quantizer, dimension, ivf_nlist(len(vectors)), metric)
+        index.train(vectors)
+        index.nprobe = IVF_NPROBE
+    elif mode == 'ivfpq':
+        quantizer = faiss.IndexFlatIP(dimension)
+        ivfpq = faiss.IndexIVFPQ(quantizer, dimension, ivf_nlist(len(vectors)), pq_subquantizers(dimension), PQ_NBITS, metric)
+        ivfpq.nprobe = IVF_NPROBE
+        refine = faiss.IndexRefineFlat(ivfpq)  # re-scores the PQ candidates against the stored float vectors
+        refine.k_factor = REFINE_K_FACTOR
+        index = faiss.IndexIDMap2(refine)
+        index.train(vectors)
+    else:
+        raise ValueError(f"unknown index mode {mode}")
+    if len(vectors):
+        index.add_with_ids(vectors, ids)
+    return index
+
+
+def set_search_params(index: faiss.Index, nprobe: int = None, ef_search: int = None):
+    """
+    adjust the recall/latency knobs of an index built by build_index
+
+    :param index: index to tune
+    :param nprobe: inverted lists visited per query (IVF modes)
+    :param ef_search: candidate list size per query (HNSW)
+    """
+    inner = _unwrap(index)
+    if nprobe is not None and isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = nprobe
+    if ef_search is not None and isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = ef_search
+
+
+def _refine_stage(index) -> Optional[faiss.IndexRefine]:
+    """:return: the exact re-ranking stage of an IVF-PQ index built by build_index, None for other indexes"""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    return inner if isinstance(inner, faiss.IndexRefine) else None
+
+
+def _unwrap(index: faiss.Index) -> faiss.Index:
+    """:return: the index doing the search under the id map and the IVF-PQ refine stage"""
+    refine = _refine_stage(index)
+    if refine is not None:
+        return faiss.downcast_index(refine.base_index)
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+
+
+def supports_remove(mode: str) -> bool:
+    """HNSW graphs and the IVF-PQ refine stage cannot drop vectors, removed ids are masked out until the next rebuild"""
+    return mode not in ('hnsw', 'ivfpq')
+
+
+def index_memory_bytes(index: Union[faiss.Index, MappedIndex]) -> int:
+    """approximate memory footprint of an index, measured as its serialized size"""
+    if isinstance(index, MappedIndex):
+        return index.memory_bytes()
+    return faiss.serialize_index(index).nbytes
+
+
+def similarity_to_inner_product(percentage: float) -> float:
+    """invert the [-1,1] -> [0,100] similarity mapping to get an inner-product cut-off"""
+    return percentage / 50 - 1
+
+
+def inner_product_to_similarity(inner_products: np.ndarray) -> np.ndarray:
+    """map inner products of unit vectors from [-1,1] to percentages in [0,100]"""
+    return (inner_products + 1) / 2 * 100
+
+
+def range_search(index: Union[faiss.Index, MappedIndex], queries: np.ndarray, threshold: float = SIMILARITY_THRESHOLD) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    find every indexed vector at or above a percentage similarity to each query
+
+    :param index: index built by build_index
+    :param queries: (M, D) float32 unit vectors
+    :param threshold: percentage similarity cut-off
+    :return: flat arrays of query row, matched id and percentage similarity, one entry per pair
+    """
+    lims, distances, ids = index_range_search(index, queries, similarity_to_inner_product(threshold))
+    query_rows = np.repeat(np.arange(len(queries)), np.diff(lims).astype('int64'))
+    return query_rows, ids, inner_product_to_similarity(distances)
+
+
+def index_range_search(index, queries: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    faiss range_search, or a wide top-k cut at the radius where it is missing or unusable: the IVF-PQ refine stage
+    silently returns nothing and HNSW range search aborts the process once efSearch reaches 128
+
+    :return: lims, inner products and ids, grouped by query
+    """
+    if _refine_stage(index) is None and not isinstance(_unwrap(index), faiss.IndexHNSW):
+        try:
+            return index.range_search(queries, radius)
+        except RuntimeError:
+            pass  # not every index type implements range search
+    distances, ids = index.search(queries, min(RANGE_FALLBACK_K, max(1, index.ntotal)))
+    keep = (distances >= radius) & (ids >= 0)
+    return np.concatenate([[0], np.cumsum(keep.sum(axis=1))]), distances[keep], ids[keep]
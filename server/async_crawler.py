@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from typing import Dict, Optional
+import aiohttp
+
+import completely_legal_scraping as scraping
+from completely_legal_scraping import ImageMetadata, WikimediaImageDownloader
+from metrics import DOWNLOADED_BYTES, timed
+
+# configuration
+MAX_CONNECTIONS = 16  # pooled connections shared by API calls and downloads
+MAX_CONCURRENT_INFO = 4  # imageinfo batches requested at the same time
+REQUESTS_PER_SECOND = 10.0  # token bucket refill rate
+BURST = 20  # token bucket capacity
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # seconds, doubled on every retry
+BACKOFF_MAX = 30.0
+MAXLAG = 5  # seconds, the API refuses requests while replication lag is higher, see mediawiki.org/wiki/Manual:Maxlag_parameter
+REQUEST_TIMEOUT = 30  # seconds per request
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """token bucket rate limiter shared by every request of a crawl, paused when the server asks us to back off"""
+
+    def __init__(self, rate: float = REQUESTS_PER_SECOND, capacity: int = BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """wait until a request may be sent"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """stop handing out tokens for a while, e.g. after Retry-After or a maxlag error"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RetryableError(Exception):
+    """a response worth retrying, optionally with the delay the server asked for"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After in seconds, HTTP dates are treated as absent"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class CrawlStats:
+    """throughput counters of one crawl"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.api_requests = 0
+        self.retries = 0
+        self.bytes = 0
+        self.images = 0
+
+    def report(self) -> Dict[str, float]:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return {
+            'seconds': round(elapsed, 3),
+            'api_requests': self.api_requests,
+            'retries': self.retries,
+            'bytes': self.bytes,
+            'images': self.images,
+            'bytes_per_sec': round(self.bytes / elapsed, 1),
+            'images_per_sec': round(self.images / elapsed, 3),
+        }
+
+
+class AsyncWikimediaCrawler:
+    """asyncio crawl mode for WikimediaImageDownloader: pooled client, concurrent imageinfo batches, rate limiting and retries"""
+
+    def __init__(self, downloader: WikimediaImageDownloader, rate: float = REQUESTS_PER_SECOND, burst: int = BURST):
+        """
+        :param downloader: supplies the configuration, metadata handling, compression and callbacks
+        :param rate: requests per second
+        :param burst: requests that may be sent at once before the rate applies
+        """
+        self.downloader = downloader
+        self.rate = rate
+        self.burst = burst
+        self.stats = CrawlStats()
+
+    async def request(self, session: aiohttp.ClientSession, url: str, params: Optional[Dict] = None) -> bytes:
+        """
+        GET with rate limiting and exponential backoff
+
+        :param session: pooled client session
+        :param url: URL to fetch
+        :param params: query parameters, API requests get maxlag added
+        :return: response body
+        """
+        kind = 'api' if params is not None else 'image'
+        for attempt in range(MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                with timed('api' if params is not None else 'download'):  # includes waiting on the event loop
+                    async with session.get(url, params=params) as response:
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        if response.status in RETRY_STATUSES:
+                            raise RetryableError(f"HTTP {response.status}", retry_after)
+                        response.raise_for_status()
+                        body = await response.read()
+                self.stats.bytes += len(body)
+                DOWNLOADED_BYTES.inc(len(body), kind=kind)
+                if params is not None:
+                    self.stats.api_requests += 1
+                    error = json.loads(body).get('error', {})
+                    if error.get('code') == 'maxlag':
+                        raise RetryableError(f"maxlag: {error.get('info', '')}", retry_after or MAXLAG)
+                return body
+            except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as e:
+                if isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES:
+                    raise  # e.g. 404 or 403, retrying only spends rate limit tokens
+                if attempt == MAX_RETRIES:
+                    raise
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is not None:
+                    delay = retry_after
+                    self.bucket.pause(delay)  # the whole crawl backs off, not just this request
+                else:
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * (0.5 + random.random())  # jitter
+                self.stats.retries += 1
+                logging.warning(f"retrying {url} in {delay:.1f}s after: {e}")
+                await asyncio.sleep(delay)
+
+    async def api(self, session: aiohttp.ClientSession, params: Dict) -> Dict:
+        params = {**params, 'maxlag': MAXLAG}
+        try:
+            return json.loads(await self.request(session, self.downloader.api_url, params))
+        except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError, ValueError) as e:
+            logging.error(f"error querying {params.get('list') or params.get('prop')}: {e}")
+            return {}
+
+    async def fetch_images(self, session: aiohttp.ClientSession):
+        """page through the category, fetching the imageinfo batches of each page concurrently"""
+        cmcontinue = self.downloader.state.cursor(scraping.CATEGORY)  # resume from the last crawl
+        while len(self.downloader.images) < scraping.MAX_IMAGES:
+            data = await self.api(session, self.downloader.image_titles_params(cmcontinue))
+            if not data:
+                break  # exit if no data returned
+            pages = data.get('query', {}).get('categorymembers', [])
+            titles = [page['title'] for page in pages if page['ns'] == 6]  # namespace 6 for files
+            if not titles:
+                break  # exit if no titles found
+
+            batches = [titles[i:i + scraping.IMAGEINFO_BATCH_SIZE] for i in range(0, len(titles), scraping.IMAGEINFO_BATCH_SIZE)]
+            while batches and len(self.downloader.images) < scraping.MAX_IMAGES:
+                # only as many batches as could still be needed, like the threaded path stopping at MAX_IMAGES
+                needed = -(-(scraping.MAX_IMAGES - len(self.downloader.images)) // scraping.IMAGEINFO_BATCH_SIZE)
+                wave, batches = batches[:min(needed, MAX_CONCURRENT_INFO)], batches[min(needed, MAX_CONCURRENT_INFO):]
+                for info_data in await asyncio.gather(*(self.api(session, self.downloader.image_info_params(batch)) for batch in wave)):
+                    if info_data and len(self.downloader.images) < scraping.MAX_IMAGES:
+                        self.downloader.process_api_response(info_data)
+
+            cmcontinue = self.downloader.next_cursor(data)
+            if not cmcontinue:
+                break  # exit if no more pages
+
+    async def download_image(self, session: aiohttp.ClientSession, image: ImageMetadata):
+        """download one image, compression and saving run on a worker thread"""
+        if self.downloader.keep_existing(image):
+            return  # already on disk, not fetched again
+        try:
+            content = await self.request(session, image.url)
+            await asyncio.get_running_loop().run_in_executor(None, self.downloader.save_image, image, content)
+        except Exception as e:
+            logging.error(f"failed to download {image.url}: {e}")  # log any download errors
+            image.local_path = None  # mark as failed
+            return
+        if image.duplicate_of:
+            return  # caught by the dedup stage after download
+        self.stats.images += 1
+        if self.downloader.progress:
+            self.downloader.progress(downloaded=self.stats.images)
+
+    async def crawl(self) -> bool:
+        """async counterpart of WikimediaImageDownloader.run"""
+        self.bucket = TokenBucket(self.rate, self.burst)
+        self.stats = CrawlStats()
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        headers = {'User-Agent': scraping.USER_AGENT}
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+            logging.info(f"starting async image fetch for category: {scraping.CATEGORY}")
+            await self.fetch_images(session)
+            if not self.downloader.images:
+                logging.error("no images found to download")
+                return False
+            logging.info(f"found {len(self.downloader.images)} images. starting download...")
+            await asyncio.gather(*(self.download_image(session, image) for image in self.downloader.images))
+
+        for image in self.downloader.images:
+            if not image.local_path and not image.duplicate_of:
+                logging.warning(f"image {image.title} was not downloaded successfully")
+        self.downloader.save_metadata_to_csv()
+        self.downloader.crawl_stats = self.stats.report()
+        logging.info(f"crawl finished: {self.downloader.crawl_stats}")
+        logging.info(f"dedup: {self.downloader.dedup_report()}")
+        logging.info(f"compression: {self.downloader.compression.report()}")
+        return True
+
+    def run(self) -> bool:
+        """
+        run the crawl on a fresh event loop, from a plain (non-async) thread
+
+        :return: False if no images were found to download
+        """
+        if not os.path.exists(self.downloader.download_dir):
+            os.makedirs(self.downloader.download_dir)  # create download directory if it doesn't exist
+        return asyncio.run(self.crawl())
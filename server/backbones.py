@@ -0,0 +1,69 @@
+import os
+import hashlib
+import logging
+import torch
+from torch import nn
+from torchvision import models
+from typing import Optional
+
+# configuration
+BACKBONE = 'resnet50'  # 'resnet50', 'resnet18', 'mobilenet_v3_large', 'mobilenet_v3_small' or 'efficientnet_b0'
+BACKBONE_WEIGHTS_FILE: Optional[str] = None  # local state_dict of the full classifier, used instead of downloading weights
+
+# name -> (torchvision constructor name, pretrained weights, classifier attribute replaced by Identity, embedding dimension)
+BACKBONES = {
+    'resnet50': ('resnet50', 'ResNet50_Weights.IMAGENET1K_V1', 'fc', 2048),
+    'resnet18': ('resnet18', 'ResNet18_Weights.IMAGENET1K_V1', 'fc', 512),
+    'mobilenet_v3_large': ('mobilenet_v3_large', 'MobileNet_V3_Large_Weights.IMAGENET1K_V1', 'classifier', 960),
+    'mobilenet_v3_small': ('mobilenet_v3_small', 'MobileNet_V3_Small_Weights.IMAGENET1K_V1', 'classifier', 576),
+    'efficientnet_b0': ('efficientnet_b0', 'EfficientNet_B0_Weights.IMAGENET1K_V1', 'classifier', 1280),
+}
+
+
+def _weights(spec: str):
+    enum_name, member = spec.split('.')
+    return getattr(getattr(models, enum_name), member)
+
+
+def model_id(name: str = BACKBONE, weights_file: Optional[str] = BACKBONE_WEIGHTS_FILE) -> str:
+    """
+    identifier stored with every embedding, vectors of different ids are never compared
+
+    :return: the backbone name, plus a digest of the weights file when local weights are used
+    """
+    if name not in BACKBONES:
+        raise ValueError(f"unknown backbone {name}, expected one of {tuple(BACKBONES)}")
+    if weights_file is None:
+        return name
+    digest = hashlib.sha256()
+    with open(weights_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return f"{name}@{digest.hexdigest()[:12]}"
+
+
+def embedding_dimension(name: str = BACKBONE) -> int:
+    return BACKBONES[name][3]
+
+
+def load_backbone(name: str = BACKBONE, weights_file: Optional[str] = BACKBONE_WEIGHTS_FILE) -> nn.Module:
+    """
+    build a pretrained classifier and drop its classification head
+
+    :param name: one of BACKBONES
+    :param weights_file: state_dict saved from the full torchvision classifier, the ImageNet weights are downloaded if None
+    :return: eval-mode model mapping (N, 3, H, W) images to (N, embedding_dimension(name)) features
+    """
+    if name not in BACKBONES:
+        raise ValueError(f"unknown backbone {name}, expected one of {tuple(BACKBONES)}")
+    constructor, weights, head, _ = BACKBONES[name]
+    if weights_file is None:
+        model = getattr(models, constructor)(weights=_weights(weights))
+    else:
+        if not os.path.exists(weights_file):
+            raise FileNotFoundError(f"backbone weights file {weights_file} does not exist")
+        model = getattr(models, constructor)(weights=None)
+        model.load_state_dict(torch.load(weights_file, map_location='cpu', weights_only=True))
+        logging.info(f"loaded {name} weights from {weights_file}")
+    setattr(model, head, nn.Identity())  # remove the last layer(s), keep the pooled features
+    return model.eval()
@@ -0,0 +1,89 @@
+"""recall vs latency of the approximate index modes against the exact flat baseline
+
+run from the server directory:
+    python -m benchmarks.ann_recall --size 200000 --queries 2000
+    python -m benchmarks.ann_recall --store user_embeddings.db
+"""
+import argparse
+import time
+import numpy as np
+
+from ann_index import (
+    INDEX_MODES, SIMILARITY_THRESHOLD, build_index, index_memory_bytes, range_search, resolve_index_mode, set_search_params,
+)
+
+
+def synthetic_corpus(size: int, num_queries: int, dimension: int, seed: int = 0):
+    """
+    random unit vectors plus queries that are noisy copies of corpus items (near-duplicates) or unrelated
+
+    :return: corpus vectors and query vectors
+    """
+    rng = np.random.default_rng(seed)
+    corpus = rng.standard_normal((size, dimension), dtype='float32')
+    corpus /= np.linalg.norm(corpus, axis=1, keepdims=True)
+    copies = corpus[rng.integers(0, size, num_queries // 2)]
+    copies = copies + rng.standard_normal(copies.shape, dtype='float32') * 0.015  # cosine around 0.9 to the source
+    unrelated = rng.standard_normal((num_queries - len(copies), dimension), dtype='float32')
+    queries = np.vstack([copies, unrelated])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return corpus, queries
+
+
+def stored_corpus(path: str, num_queries: int, seed: int = 0):
+    """use real embeddings from an embedding store, querying with perturbed copies of them"""
+    from embedding_store import EmbeddingStore
+    _, _, corpus = EmbeddingStore(path).load()
+    corpus = corpus / np.linalg.norm(corpus, axis=1, keepdims=True)
+    rng = np.random.default_rng(seed)
+    queries = corpus[rng.integers(0, len(corpus), num_queries)]
+    queries = queries + rng.standard_normal(queries.shape, dtype='float32') * 0.005
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return corpus.astype('float32'), queries.astype('float32')
+
+
+def run(corpus: np.ndarray, queries: np.ndarray, nprobe: int, ef_search: int):
+    ids = np.arange(len(corpus), dtype='int64')
+    baseline = None
+    print(f"{'mode':<8}{'built as':<10}{'build s':>10}{'query ms':>10}{'memory MB':>11}{'recall':>9}")
+    for mode in INDEX_MODES:
+        if mode == 'mapped':
+            continue  # writes to disk, compared in benchmarks.embedding_formats
+        built = resolve_index_mode(mode, len(corpus))  # flat when the corpus is too small to train the mode, as served
+        start = time.perf_counter()
+        index = build_index(corpus, ids, built)
+        set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows, found_ids, _ = range_search(index, queries, SIMILARITY_THRESHOLD)  # the matching the scan runs
+        query_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+        found = set(zip(rows.tolist(), found_ids.tolist()))
+        if baseline is None:
+            baseline = found  # flat is first and exact
+        recall = len(found & baseline) / len(baseline) if baseline else 1.0
+        memory_mb = index_memory_bytes(index) / 2 ** 20
+        print(f"{mode:<8}{built:<10}{build_seconds:>10.2f}{query_ms:>10.3f}{memory_mb:>11.1f}{recall:>9.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100_000, help='synthetic corpus size')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--dimension', type=int, default=2048)
+    parser.add_argument('--store', help='use the embeddings of this embedding store instead of synthetic vectors')
+    parser.add_argument('--nprobe', type=int, default=None)
+    parser.add_argument('--ef-search', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.store:
+        corpus, queries = stored_corpus(args.store, args.queries)
+    else:
+        corpus, queries = synthetic_corpus(args.size, args.queries, args.dimension)
+    print(f"corpus {corpus.shape}, {len(queries)} queries, threshold {SIMILARITY_THRESHOLD}%")
+    run(corpus, queries, args.nprobe, args.ef_search)
+
+
+if __name__ == '__main__':
+    main()
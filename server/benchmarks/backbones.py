@@ -0,0 +1,75 @@
+"""speed, memory and match quality of each feature extractor backbone
+
+every backbone embeds the user images and a crawl set made of the given crawl images plus
+altered copies of the user images (see benchmarks.two_stage), then all pairs are scored:
+recall of the planted copies and false matches at the scan threshold, and the margin between
+the weakest planted copy and the strongest unrelated pair
+
+run from the server directory:
+    python -m benchmarks.backbones --user-images ../algorithm/user_images --crawl-images ../algorithm/new_images
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import torch
+
+from algorithm import FeatureExtractor, load_image_paths, normalize_vectors
+from ann_index import SIMILARITY_THRESHOLD, inner_product_to_similarity
+from backbones import BACKBONES
+from benchmarks.two_stage import make_infringements
+
+
+def model_megabytes(model: torch.nn.Module) -> float:
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user-images', default='../algorithm/user_images')
+    parser.add_argument('--crawl-images', default='../algorithm/new_images')
+    parser.add_argument('--threshold', type=float, default=SIMILARITY_THRESHOLD)
+    parser.add_argument('--backbones', nargs='+', default=list(BACKBONES))
+    parser.add_argument('--weights-dir', help='directory of <backbone>.pth weights files, downloaded weights if omitted')
+    args = parser.parse_args()
+
+    crawl_dir = tempfile.mkdtemp(prefix='arttrack-bench-')
+    try:
+        for path in load_image_paths(args.crawl_images):
+            shutil.copy(path, crawl_dir)
+        user_paths = load_image_paths(args.user_images)
+        planted = make_infringements(user_paths, crawl_dir)
+        crawl_paths = load_image_paths(crawl_dir)
+        print(f"{len(user_paths)} user images, {len(crawl_paths)} crawl images, {len(planted)} planted copies, "
+              f"threshold {args.threshold}%, {torch.get_num_threads()} threads")
+
+        print(f"{'backbone':<20}{'dim':>6}{'model MB':>10}{'load s':>8}{'images/s':>10}{'recall':>8}{'false':>7}{'margin':>8}")
+        for name in args.backbones:
+            weights_file = os.path.join(args.weights_dir, f'{name}.pth') if args.weights_dir else None
+            start = time.perf_counter()
+            extractor = FeatureExtractor(torch.device('cpu'), backend='eager', backbone=name, weights_file=weights_file)
+            load = time.perf_counter() - start
+
+            extractor.extract_features(user_paths[:1])  # warm-up
+            start = time.perf_counter()
+            user_vectors, kept_user = extractor.extract_features(user_paths)
+            crawl_vectors, kept_crawl = extractor.extract_features(crawl_paths)
+            speed = (len(kept_user) + len(kept_crawl)) / (time.perf_counter() - start)
+
+            similarity = inner_product_to_similarity(normalize_vectors(crawl_vectors) @ normalize_vectors(user_vectors).T)
+            is_planted = np.array([[(os.path.basename(c), os.path.basename(u)) in planted for u in kept_user] for c in kept_crawl])
+            found = similarity >= args.threshold
+            recall = (found & is_planted).sum() / max(1, is_planted.sum())
+            false = int((found & ~is_planted).sum())
+            margin = similarity[is_planted].min() - similarity[~is_planted].max()  # > 0: some threshold separates them
+            print(f"{name:<20}{extractor.dimension:>6}{model_megabytes(extractor.model):>10.1f}{load:>8.2f}{speed:>10.1f}"
+                  f"{recall:>8.3f}{false:>7}{margin:>8.2f}")
+    finally:
+        shutil.rmtree(crawl_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
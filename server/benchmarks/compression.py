@@ -0,0 +1,78 @@
+"""CPU time and encode count of the download compression stage: the old fixed three-step compression, reopened
+and saved once more, against the draft decode and scale search of compression.py
+
+the sources are the given images upscaled to camera-sized JPEGs, the size crawled originals arrive at
+
+run from the server directory:
+    python -m benchmarks.compression --images ../algorithm/user_images --width 4000
+"""
+import time
+import argparse
+from io import BytesIO
+from PIL import Image
+
+import compression
+from algorithm import load_image_paths
+from completely_legal_scraping import COMPRESSION_QUALITY, TARGET_SIZE
+
+
+def make_sources(image_paths, width: int):
+    sources = []
+    for path in image_paths:
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+            height = max(1, image.height * width // image.width)
+            buffer = BytesIO()
+            image.resize((width, height), Image.BICUBIC).save(buffer, format='JPEG', quality=95)
+            sources.append(buffer.getvalue())
+    return sources
+
+
+def legacy(content: bytes):
+    """the compression save_image did before, :return: (saved bytes, encodes)"""
+    img = Image.open(BytesIO(content)).convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=COMPRESSION_QUALITY)
+    encodes, size = 1, buffer.tell()
+    if size > TARGET_SIZE:
+        scale_factor = (TARGET_SIZE / size) ** 0.5
+        img = img.resize((max(1, int(img.width * scale_factor)), max(1, int(img.height * scale_factor))), Image.LANCZOS)
+        buffer = BytesIO()
+        img.save(buffer, format='JPEG', quality=COMPRESSION_QUALITY)
+        encodes, size = encodes + 1, buffer.tell()
+        if size > TARGET_SIZE:
+            buffer = BytesIO()
+            img.save(buffer, format='JPEG', quality=max(int(COMPRESSION_QUALITY * (TARGET_SIZE / size)), 10))
+            encodes += 1
+    buffer.seek(0)
+    out = BytesIO()
+    Image.open(buffer).save(out, 'JPEG', quality=COMPRESSION_QUALITY)  # reopened and saved to disk again
+    return out.getvalue(), encodes + 1
+
+
+def adaptive(content: bytes):
+    result = compression.compress(compression.decode(content), TARGET_SIZE, COMPRESSION_QUALITY)
+    return result.data, result.encodes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default='../algorithm/user_images')
+    parser.add_argument('--width', type=int, default=4000, help='width of the synthetic originals')
+    args = parser.parse_args()
+
+    sources = make_sources(load_image_paths(args.images), args.width)
+    print(f"{len(sources)} JPEGs {args.width} px wide, {sum(map(len, sources)) / len(sources) / 1e6:.1f} MB on average, "
+          f"budget {TARGET_SIZE} bytes")
+    print(f"{'pipeline':<12}{'cpu ms/image':>14}{'encodes/image':>15}{'KB/image':>10}{'over budget':>13}")
+    for name, run in (('legacy', legacy), ('adaptive', adaptive)):
+        start = time.process_time()
+        results = [run(content) for content in sources]
+        seconds = time.process_time() - start
+        sizes = [len(data) for data, _ in results]
+        print(f"{name:<12}{seconds * 1000 / len(sources):>14.1f}{sum(e for _, e in results) / len(results):>15.2f}"
+              f"{sum(sizes) / len(sizes) / 1000:>10.1f}{sum(size > TARGET_SIZE for size in sizes):>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""synthetic corpora for the benchmark suite: procedurally drawn user images, and a crawl set mixing
+near-duplicates of them (re-encodes, resizes, crops) with unrelated images, plus the ground truth pairs
+
+every image is drawn from its own seed, so a corpus is the same whatever the number of jobs, and a
+directory generated with the same parameters is reused
+
+run from the server directory:
+    python -m benchmarks.corpus --out /tmp/arttrack-corpus --users 1000 --crawl 100000 --jobs 8
+"""
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from io import BytesIO
+from typing import Dict, List, Tuple
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+CORPUS_FILE = 'corpus.json'  # parameters and ground truth, written last so an interrupted run is regenerated
+VARIANTS = ('reencode', 'resize', 'crop')  # near-duplicate kinds, from clear copies to ones only ResNet catches
+IMAGE_SIZE = 768  # longer side of the drawn images
+SHAPES = 24  # shapes per image
+CHUNK = 256  # images per task handed to a worker
+
+
+def draw_image(seed: Tuple[int, ...], size: int = IMAGE_SIZE) -> Image.Image:
+    """a random gradient covered with random shapes, different enough from every other seed to not match it"""
+    rng = np.random.default_rng(seed)
+    width, height = size, int(size * rng.uniform(0.6, 1.0))
+    if rng.random() < 0.5:
+        width, height = height, width
+    top, bottom = rng.integers(0, 256, 3), rng.integers(0, 256, 3)
+    ramp = np.linspace(0, 1, height, dtype='float32')[:, None, None]
+    background = (top * (1 - ramp) + bottom * ramp).astype('uint8')
+    image = Image.fromarray(np.broadcast_to(background, (height, width, 3)).copy())
+    draw = ImageDraw.Draw(image)
+    for _ in range(SHAPES):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        x1, y1 = x0 + rng.integers(width // 20, width // 2), y0 + rng.integers(height // 20, height // 2)
+        colour = tuple(int(c) for c in rng.integers(0, 256, 3))
+        kind = rng.integers(0, 3)
+        if kind == 0:
+            draw.ellipse((x0, y0, x1, y1), fill=colour)
+        elif kind == 1:
+            draw.rectangle((x0, y0, x1, y1), fill=colour)
+        else:
+            points = [(int(x), int(y)) for x, y in zip(rng.integers(0, width, 3), rng.integers(0, height, 3))]
+            draw.polygon(points, fill=colour)
+    return image.filter(ImageFilter.GaussianBlur(1))
+
+
+def variant(image: Image.Image, kind: str, seed: Tuple[int, ...]) -> Tuple[Image.Image, int]:
+    """:return: the altered image and the JPEG quality to save it at"""
+    rng = np.random.default_rng(seed)
+    if kind == 'reencode':
+        return image, int(rng.integers(40, 75))
+    if kind == 'resize':
+        scale = rng.uniform(0.3, 0.7)
+        return image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.BILINEAR), 85
+    if kind == 'crop':
+        w, h = image.size
+        left, top = int(w * rng.uniform(0, 0.15)), int(h * rng.uniform(0, 0.15))
+        right, bottom = w - int(w * rng.uniform(0, 0.15)), h - int(h * rng.uniform(0, 0.15))
+        return image.crop((left, top, right, bottom)), 90
+    raise ValueError(f"unknown variant {kind}")
+
+
+def _save(image: Image.Image, path: str, quality: int = 90):
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    with open(path, 'wb') as f:
+        f.write(buffer.getvalue())
+
+
+def _write(task: Tuple[int, List[tuple]]) -> int:
+    """worker: draw and save one chunk of (path, source seed, variant kind, variant seed) items"""
+    size, items = task
+    written = 0
+    for path, source, kind, seed in items:
+        image = draw_image(source, size)
+        quality = 90
+        if kind is not None:
+            image, quality = variant(image, kind, seed)
+        _save(image, path, quality)
+        written += 1
+    return written
+
+
+def plan(out_dir: str, users: int, crawl: int, duplicate_ratio: float, seed: int) -> Tuple[List[tuple], List[List[str]]]:
+    """:return: every file to write and the (crawled filename, user filename, variant) ground truth"""
+    rng = np.random.default_rng(seed)
+    user_dir, crawl_dir = os.path.join(out_dir, 'user'), os.path.join(out_dir, 'crawl')
+    items = [(os.path.join(user_dir, f'u{i:07d}.jpg'), (seed, 0, i), None, None) for i in range(users)]
+    duplicates = int(crawl * duplicate_ratio)
+    sources = rng.integers(0, users, duplicates)
+    kinds = rng.integers(0, len(VARIANTS), duplicates)
+    positions = set(rng.choice(crawl, duplicates, replace=False).tolist()) if duplicates else set()
+    pairs, copy = [], 0
+    for i in range(crawl):
+        filename = f'c{i:07d}.jpg'
+        path = os.path.join(crawl_dir, filename)
+        if i in positions:
+            source, kind = int(sources[copy]), VARIANTS[kinds[copy]]
+            items.append((path, (seed, 0, source), kind, (seed, 2, i)))
+            pairs.append([filename, f'u{source:07d}.jpg', kind])
+            copy += 1
+        else:
+            items.append((path, (seed, 1, i), None, None))  # unrelated image
+    return items, pairs
+
+
+def generate(out_dir: str, users: int, crawl: int, duplicate_ratio: float = 0.1, seed: int = 0,
+             size: int = IMAGE_SIZE, jobs: int = 1) -> dict:
+    """
+    write a corpus, or reuse the one already in out_dir if it was generated with the same parameters
+
+    :param out_dir: directory to write user/ and crawl/ into
+    :param users: user images
+    :param crawl: crawled images, duplicate_ratio of them near-duplicates of user images
+    :param jobs: worker processes drawing images
+    :return: corpus description with the parameters, the directories and the ground truth pairs
+    """
+    params = {'users': users, 'crawl': crawl, 'duplicate_ratio': duplicate_ratio, 'seed': seed, 'size': size}
+    corpus_file = os.path.join(out_dir, CORPUS_FILE)
+    if os.path.exists(corpus_file):
+        with open(corpus_file) as f:
+            corpus = json.load(f)
+        if corpus['params'] == params:
+            return corpus
+    os.makedirs(os.path.join(out_dir, 'user'), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, 'crawl'), exist_ok=True)
+    items, pairs = plan(out_dir, users, crawl, duplicate_ratio, seed)
+    tasks = [(size, items[i:i + CHUNK]) for i in range(0, len(items), CHUNK)]
+    start = time.perf_counter()
+    if jobs > 1:
+        with multiprocessing.get_context('spawn').Pool(jobs) as pool:
+            written = sum(pool.imap_unordered(_write, tasks))
+    else:
+        written = sum(map(_write, tasks))
+    corpus = {
+        'params': params,
+        'user_dir': os.path.join(out_dir, 'user'),
+        'crawl_dir': os.path.join(out_dir, 'crawl'),
+        'pairs': pairs,
+        'generation_seconds': time.perf_counter() - start,
+    }
+    with open(corpus_file + '.tmp', 'w') as f:
+        json.dump(corpus, f)
+    os.replace(corpus_file + '.tmp', corpus_file)
+    print(f"generated {written} images in {corpus['generation_seconds']:.1f}s")
+    return corpus
+
+
+def expected_pairs(corpus: dict) -> Dict[Tuple[str, str], str]:
+    """:return: (crawled filename, user filename) -> variant kind"""
+    return {(crawled, user): kind for crawled, user, kind in corpus['pairs']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--crawl', type=int, default=1000)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', type=int, default=IMAGE_SIZE)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    corpus = generate(args.out, args.users, args.crawl, args.duplicate_ratio, args.seed, args.size, args.jobs)
+    print(f"{corpus['params']['users']} user images, {corpus['params']['crawl']} crawled images, "
+          f"{len(corpus['pairs'])} near-duplicates in {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""size, load time, query time and recall of the compact embedding formats against the float32 flat index
+
+run from the server directory:
+    python -m benchmarks.embedding_formats --size 100000 --queries 500
+    python -m benchmarks.embedding_formats --store user_embeddings.db --pca 256
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import faiss
+
+from ann_index import SIMILARITY_THRESHOLD, similarity_to_inner_product
+from embedding_codec import EmbeddingCodec
+from mapped_index import MappedIndex
+from benchmarks.ann_recall import stored_corpus
+
+
+def low_rank_corpus(size: int, num_queries: int, dimension: int, rank: int = 256, seed: int = 0):
+    """
+    unit vectors with a decaying spectrum, like CNN embeddings whose energy sits in a few hundred directions,
+    queried with noisy copies of corpus items and with unrelated vectors
+
+    :return: corpus vectors and query vectors
+    """
+    rng = np.random.default_rng(seed)
+    basis = np.linalg.qr(rng.standard_normal((dimension, rank)))[0].T.astype('float32')
+    weights = (1.0 / np.sqrt(np.arange(1, rank + 1))).astype('float32')
+
+    def sample(n):
+        vectors = (rng.standard_normal((n, rank), dtype='float32') * weights) @ basis
+        vectors += rng.standard_normal(vectors.shape, dtype='float32') * 0.002  # small full-rank residual
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    corpus = sample(size)
+    copies = corpus[rng.integers(0, size, num_queries // 2)]
+    copies = copies + rng.standard_normal(copies.shape, dtype='float32') * 0.01
+    queries = np.vstack([copies, sample(num_queries - len(copies))])
+    return corpus, queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def pairs(lims: np.ndarray, ids: np.ndarray) -> set:
+    rows = np.repeat(np.arange(len(lims) - 1), np.diff(lims).astype('int64'))
+    return set(zip(rows.tolist(), ids.tolist()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100_000, help='synthetic corpus size')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--dimension', type=int, default=2048)
+    parser.add_argument('--pca', type=int, default=256, help='PCA output dimension for the reduced formats')
+    parser.add_argument('--store', help='use the embeddings of this embedding store instead of synthetic vectors')
+    args = parser.parse_args()
+
+    if args.store:
+        corpus, queries = stored_corpus(args.store, args.queries)
+    else:
+        corpus, queries = low_rank_corpus(args.size, args.queries, args.dimension)
+    ids = np.arange(len(corpus), dtype='int64')
+    radius = similarity_to_inner_product(SIMILARITY_THRESHOLD)
+    print(f"corpus {corpus.shape}, {len(queries)} queries, threshold {SIMILARITY_THRESHOLD}%")
+
+    # current path: float32 vectors loaded into a flat faiss index in every process
+    start = time.perf_counter()
+    flat = faiss.IndexIDMap2(faiss.IndexFlatIP(corpus.shape[1]))
+    flat.add_with_ids(corpus, ids)
+    flat_load = time.perf_counter() - start
+    start = time.perf_counter()
+    lims, distances, found = flat.range_search(queries, radius)
+    flat_query = time.perf_counter() - start
+    baseline = pairs(lims, found)
+    exact_scores, _ = flat.search(queries, 1)
+
+    print(f"{'format':<16}{'B/vector':>9}{'file MB':>9}{'heap MB':>9}{'load ms':>9}{'query ms':>10}{'recall':>8}{'extra':>7}{'max err':>9}")
+    print(f"{'float32 faiss':<16}{corpus.shape[1] * 4:>9}{'-':>9}{corpus.nbytes / 2 ** 20:>9.1f}"
+          f"{flat_load * 1000:>9.1f}{flat_query * 1000 / len(queries):>10.3f}{1.0:>8.3f}{0:>7}{0.0:>9.4f}")
+
+    workdir = tempfile.mkdtemp(prefix='arttrack-bench-')
+    try:
+        formats = [(dtype, None) for dtype in ('float32', 'float16', 'int8')] + [(dtype, args.pca) for dtype in ('float32', 'float16', 'int8')]
+        for dtype, pca_dims in formats:
+            name = dtype if pca_dims is None else f"pca{pca_dims}-{dtype}"
+            directory = os.path.join(workdir, name)
+            codec = EmbeddingCodec(dtype, pca_dims)
+            MappedIndex.build(directory, corpus, ids, codec)
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            index = MappedIndex.open(directory)  # what each extra worker process pays
+            load = time.perf_counter() - start
+            heap = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            start = time.perf_counter()
+            lims, distances, found = index.range_search(queries, radius)
+            query = time.perf_counter() - start
+            result = pairs(lims, found)
+            recall = len(result & baseline) / len(baseline) if baseline else 1.0
+            scores, _ = index.search(queries, 1)
+            error = float(np.abs(scores[:, 0] - exact_scores[:, 0]).max()) * 50  # in similarity percentage points
+            file_mb = sum(os.path.getsize(os.path.join(index.directory, f)) for f in os.listdir(index.directory)) / 2 ** 20
+            print(f"{name:<16}{codec.bytes_per_vector(corpus.shape[1]):>9}{file_mb:>9.1f}{heap / 2 ** 20:>9.1f}"
+                  f"{load * 1000:>9.1f}{query * 1000 / len(queries):>10.3f}{recall:>8.3f}{len(result - baseline):>7}{error:>9.4f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
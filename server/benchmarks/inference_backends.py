@@ -0,0 +1,59 @@
+"""images/sec of each CPU inference backend and the cosine parity of its embeddings with eager mode
+
+run from the server directory:
+    python -m benchmarks.inference_backends --images ../algorithm/user_images --threads 4
+"""
+import copy
+import time
+import argparse
+import torch
+
+from algorithm import FeatureExtractor, load_image_paths
+from inference_backends import INFERENCE_BACKENDS, PARITY_MIN_COSINE, build_backend, configure_threads, cosine_parity
+
+
+def throughput(backend, batches, repeat: int) -> float:
+    backend(batches[0])  # warm-up, torch.compile and the JIT optimise on the first calls
+    images = sum(len(batch) for batch in batches) * repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for batch in batches:
+            backend(batch)
+    return images / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default='../algorithm/user_images', help='images embedded by every backend')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the images per backend')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads, torch default if omitted')
+    parser.add_argument('--backends', nargs='+', default=list(INFERENCE_BACKENDS))
+    args = parser.parse_args()
+
+    configure_threads(intra_op=args.threads)
+    extractor = FeatureExtractor(torch.device('cpu'), batch_size=args.batch_size, backend='eager')
+    batches = extractor.calibration_batches(load_image_paths(args.images))  # decoded once, only inference is timed
+    if not batches:
+        raise SystemExit(f"no images could be decoded in {args.images}")
+    model = extractor.model.to(memory_format=torch.contiguous_format)
+    with torch.inference_mode():
+        reference = [model(batch) for batch in batches]  # eager, contiguous: the current path
+    print(f"{sum(len(b) for b in batches)} images in batches of {args.batch_size}, {torch.get_num_threads()} threads")
+
+    print(f"{'backend':<14}{'layout':<16}{'images/s':>10}{'min cosine':>12}{'ok':>4}")
+    for name in args.backends:
+        for channels_last in (False, True):
+            backend = build_backend(name, copy.deepcopy(model), batches[0], channels_last=channels_last, calibration=batches,
+                                    model_id=extractor.model_id)
+            if backend.name != name:
+                print(f"{name:<14}{'-':<16}{'unavailable, see log':>26}")
+                break
+            parity = min(cosine_parity(expected, backend(batch)) for expected, batch in zip(reference, batches))
+            speed = throughput(backend, batches, args.repeat)
+            layout = 'channels_last' if channels_last else 'contiguous'
+            print(f"{name:<14}{layout:<16}{speed:>10.1f}{parity:>12.4f}{'yes' if parity >= PARITY_MIN_COSINE else 'no':>4}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""local stand-in for the Wikimedia Commons API, serving a directory of images
+
+run from the server directory:
+    python -m benchmarks.mock_mediawiki --images ../algorithm/new_images --port 8765
+then point WikimediaImageDownloader(api_url='http://127.0.0.1:8765/w/api.php') at it
+
+failures are injected with MockMediaWiki.fail, e.g. fail('api', 503, times=2) or fail('file', 429, retry_after=1)
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple, Union
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote, unquote
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+KINDS = ('api', 'file')  # request kinds failures are injected into
+
+
+class MockMediaWiki:
+    """serves categorymembers/imageinfo queries and the image files of one directory over HTTP"""
+
+    def __init__(self, image_dir: str, page_size: int = 50, license: str = 'CC BY 4.0', latency: float = 0.0):
+        """
+        :param image_dir: directory whose images make up the category
+        :param page_size: titles per categorymembers page
+        :param license: LicenseShortName reported for every image
+        :param latency: seconds added to every response, to imitate a remote server
+        """
+        self.image_dir = image_dir
+        self.page_size = page_size
+        self.license = license
+        self.latency = latency
+        self.filenames = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+        self.requests = 0
+        self.bytes_served = 0
+        self.failures: Dict[str, Deque[Tuple[Union[int, str], Optional[float]]]] = {kind: deque() for kind in KINDS}
+        self.history: List[Tuple[float, str, str, int]] = []  # (monotonic time, kind, query or filename, status) per request
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self) -> str:
+        return f'{self.url}/w/api.php'
+
+    def start(self, port: int = 0) -> str:
+        """
+        serve on a background thread
+
+        :param port: port to bind, 0 picks a free one
+        :return: API URL to hand to the downloader
+        """
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                mock.handle(self)
+
+            def log_message(self, *args):
+                pass  # keep benchmark output readable
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.api_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(self, kind: str, status: Union[int, str] = 503, times: int = 1, retry_after: Optional[float] = None):
+        """
+        answer the next requests of one kind with an error instead of their content
+
+        :param kind: 'api' or 'file'
+        :param status: HTTP status, or 'maxlag' for the API's maxlag error, sent with status 200 like MediaWiki does
+        :param times: requests that fail, queued after the failures already injected
+        :param retry_after: seconds sent in a Retry-After header
+        """
+        if kind not in KINDS:
+            raise ValueError(f"unknown request kind {kind}, expected one of {KINDS}")
+        with self.lock:
+            self.failures[kind].extend([(status, retry_after)] * times)
+
+    def requests_of(self, kind: str, target: Optional[str] = None) -> List[Tuple[float, int]]:
+        """:return: (monotonic time, status) of the requests of a kind, optionally only one query or file"""
+        with self.lock:
+            return [(at, status) for at, k, t, status in self.history if k == kind and target in (None, t)]
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        if self.latency:
+            time.sleep(self.latency)
+        parsed = urlparse(request.path)
+        if parsed.path == '/w/api.php':
+            params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+            target = params.get('list') or params.get('prop') or ''
+            if not self.inject(request, 'api', target):
+                self.respond(request, 200, 'application/json', json.dumps(self.api(params)).encode(), ('api', target))
+        elif parsed.path.startswith('/files/'):
+            filename = os.path.basename(unquote(parsed.path))
+            if self.inject(request, 'file', filename):
+                return
+            path = os.path.join(self.image_dir, filename)
+            if not os.path.isfile(path):
+                self.respond(request, 404, 'text/plain', b'not found', ('file', filename))
+                return
+            with open(path, 'rb') as f:
+                self.respond(request, 200, 'application/octet-stream', f.read(), ('file', filename))
+        else:
+            self.respond(request, 404, 'text/plain', b'not found')
+
+    def inject(self, request: BaseHTTPRequestHandler, kind: str, target: str) -> bool:
+        """:return: True if an injected failure was sent instead of the response"""
+        with self.lock:
+            if not self.failures[kind]:
+                return False
+            status, retry_after = self.failures[kind].popleft()
+        headers = {'Retry-After': f'{retry_after:g}'} if retry_after is not None else {}
+        if status == 'maxlag':
+            body = {'error': {'code': 'maxlag', 'info': 'Waiting for a database server: 6 seconds lagged.'}}
+            self.respond(request, 200, 'application/json', json.dumps(body).encode(), (kind, target), headers)
+        else:
+            self.respond(request, status, 'text/plain', f'injected {status}'.encode(), (kind, target), headers)
+        return True
+
+    def respond(self, request: BaseHTTPRequestHandler, status: int, content_type: str, body: bytes,
+                logged: Optional[Tuple[str, str]] = None, headers: Optional[Dict[str, str]] = None):
+        with self.lock:
+            self.requests += 1
+            self.bytes_served += len(body)
+            if logged is not None:
+                self.history.append((time.monotonic(), *logged, status))
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def api(self, params: dict) -> dict:
+        if params.get('list') == 'categorymembers':
+            offset = int(params.get('cmcontinue', 0))
+            page = self.filenames[offset:offset + self.page_size]
+            data = {'query': {'categorymembers': [{'ns': 6, 'title': f'File:{name}'} for name in page]}}
+            if offset + self.page_size < len(self.filenames):
+                data['continue'] = {'cmcontinue': str(offset + self.page_size), 'continue': '-||'}
+            return data
+        if params.get('prop') == 'imageinfo':
+            pages = {}
+            for i, title in enumerate(params.get('titles', '').split('|')):
+                name = title[len('File:'):]
+                if name not in self.filenames:
+                    pages[str(-1 - i)] = {'title': title, 'missing': ''}
+                    continue
+                with open(os.path.join(self.image_dir, name), 'rb') as f:
+                    sha1 = hashlib.sha1(f.read()).hexdigest()
+                pages[str(i)] = {'title': title, 'imageinfo': [{
+                    'url': f'{self.url}/files/{quote(name)}',
+                    'descriptionurl': f'{self.url}/wiki/{quote(title)}',
+                    'user': 'mock',
+                    'sha1': sha1,
+                    'extmetadata': {
+                        'LicenseShortName': {'value': self.license},
+                        'Attribution': {'value': 'mock'},
+                    },
+                }]}
+            return {'query': {'pages': pages}}
+        return {'error': {'code': 'badparams', 'info': f'unsupported query {params}'}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', required=True, help='directory of images to serve')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    args = parser.parse_args()
+
+    mock = MockMediaWiki(args.images, latency=args.latency)
+    print(f"serving {len(mock.filenames)} images at {mock.start(args.port)}")
+    try:
+        mock.thread.join()
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""CPU time of the image preprocessing: torchvision transforms on fully decoded images against the
+reduced-scale decode with a fused normalisation into a reused batch buffer
+
+the images are the given ones re-saved the way the downloader stores crawled images, 800 px wide JPEGs
+
+run from the server directory:
+    python -m benchmarks.preprocessing --images ../algorithm/user_images --repeat 5
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+import algorithm
+from algorithm import FeatureExtractor, decode_image, load_image_paths, IMAGE_SIZE, IMAGENET_MEAN, IMAGENET_STD
+
+DOWNLOAD_WIDTH = 800  # width of the images the downloader saves
+
+
+def make_downloads(image_paths, out_dir: str):
+    paths = []
+    for path in image_paths:
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+            height = max(1, image.height * DOWNLOAD_WIDTH // image.width)
+            out = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + '.jpg')
+            image.resize((DOWNLOAD_WIDTH, height), Image.BICUBIC).save(out, quality=85)
+            paths.append(out)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default='../algorithm/user_images')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='arttrack-bench-')
+    try:
+        paths = make_downloads(load_image_paths(args.images), workdir)
+        extractor = FeatureExtractor(torch.device('cpu'), batch_size=len(paths), backend='eager')
+        transform = transforms.Compose([
+            transforms.Resize(IMAGE_SIZE),
+            transforms.ToTensor(),
+            transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD),
+        ])
+
+        def torchvision_batch():
+            images = []
+            for path in paths:
+                with Image.open(path) as image:
+                    images.append(transform(image.convert('RGB')))
+            return torch.stack(images)
+
+        def fused_batch(draft: bool):
+            algorithm.DRAFT_DECODE = draft
+            images = []
+            for path in paths:
+                with Image.open(path) as image:
+                    images.append(decode_image(image))
+            return extractor.prepare_batch(torch.stack(images))
+
+        reference = torchvision_batch()
+        print(f"{len(paths)} JPEGs {DOWNLOAD_WIDTH} px wide, best of {args.repeat}")
+        print(f"{'path':<28}{'ms/image':>10}{'mean abs diff':>15}")
+        for name, run in (('torchvision transforms', torchvision_batch),
+                          ('fused, full decode', lambda: fused_batch(False)),
+                          ('fused, draft decode', lambda: fused_batch(True))):
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                batch = run()
+                best = min(best, time.perf_counter() - start)
+            diff = float((batch - reference).abs().mean())  # in normalized units, resampling differences only
+            print(f"{name:<28}{best * 1000 / len(paths):>10.2f}{diff:>15.4f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""query throughput of the user index split over 1..N worker processes against the single in-process index,
+and whether the merged results are the same
+
+run from the server directory:
+    python -m benchmarks.sharding --size 500000 --queries 2000 --max-shards 8
+"""
+import time
+import argparse
+import numpy as np
+
+from ann_index import build_index, range_search
+from benchmarks.ann_recall import synthetic_corpus, SIMILARITY_THRESHOLD
+from sharded_index import ShardedIndex
+
+ADD_CHUNK = 50_000  # vectors sent to the shards per request while filling them
+QUERY_BATCH = 256  # crawled images per query batch, about one scan batch
+
+
+def query_all(index, queries: np.ndarray, k: int):
+    """:return: seconds for every query batch, the threshold pairs and the top-k ids"""
+    pairs, top = set(), []
+    start = time.perf_counter()
+    for offset in range(0, len(queries), QUERY_BATCH):
+        batch = queries[offset:offset + QUERY_BATCH]
+        rows, ids, _ = range_search(index, batch, SIMILARITY_THRESHOLD)
+        pairs.update(zip((rows + offset).tolist(), ids.tolist()))
+        top.append(index.search(batch, k)[1])
+    return time.perf_counter() - start, pairs, np.vstack(top)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=500_000, help='user images in the index')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--dimension', type=int, default=2048)
+    parser.add_argument('--max-shards', type=int, default=4)
+    parser.add_argument('--mode', default='flat', help='index mode of every shard, flat or hnsw')
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+
+    corpus, queries = synthetic_corpus(args.size, args.queries, args.dimension)
+    ids = np.arange(1, args.size + 1, dtype='int64')  # store row ids start at 1
+
+    start = time.perf_counter()
+    baseline = build_index(corpus, ids, args.mode, args.dimension)
+    build = time.perf_counter() - start
+    seconds, expected_pairs, expected_top = query_all(baseline, queries, args.k)
+    del baseline
+    print(f"{args.size} vectors of dimension {args.dimension}, {args.queries} queries in batches of {QUERY_BATCH}, {args.mode}")
+    print(f"{'shards':<10}{'build s':>9}{'queries/s':>11}{'speedup':>9}{'same pairs':>12}{'same top-k':>12}")
+    print(f"{'in-process':<10}{build:>9.2f}{args.queries / seconds:>11.0f}{1.0:>9.2f}{'-':>12}{'-':>12}")
+    reference = seconds
+    for shards in range(1, args.max_shards + 1):
+        start = time.perf_counter()
+        index = ShardedIndex(shards, args.dimension, args.mode)
+        try:
+            for offset in range(0, args.size, ADD_CHUNK):
+                index.add_with_ids(corpus[offset:offset + ADD_CHUNK], ids[offset:offset + ADD_CHUNK])
+            build = time.perf_counter() - start
+            query_all(index, queries[:QUERY_BATCH], args.k)  # warm up the workers
+            seconds, pairs, top = query_all(index, queries, args.k)
+        finally:
+            index.close()
+        same_top = float((np.sort(top, axis=1) == np.sort(expected_top, axis=1)).all(axis=1).mean())
+        print(f"{shards:<10}{build:>9.2f}{args.queries / seconds:>11.0f}{reference / seconds:>9.2f}"
+              f"{str(pairs == expected_pairs):>12}{same_top:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
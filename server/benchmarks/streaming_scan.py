@@ -0,0 +1,76 @@
+"""time to first match and total time of the sequential scan vs the streaming scan, against the mock MediaWiki server
+
+run from the server directory:
+    python -m benchmarks.streaming_scan --user-images ../algorithm/user_images --crawl-images ../algorithm/new_images
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import completely_legal_scraping
+from completely_legal_scraping import WikimediaImageDownloader
+from crawl_state import CrawlState
+from engine import ScanEngine
+from streaming_scan import StreamingScan
+from benchmarks.mock_mediawiki import MockMediaWiki
+
+
+def fresh_state(download_dir: str) -> CrawlState:
+    """separate crawl state per run, so both start from an empty crawl"""
+    return CrawlState(download_dir + '.db')
+
+
+def sequential(engine: ScanEngine, api_url: str, download_dir: str) -> float:
+    """download everything, then re-read and embed the files, as scans did before streaming"""
+    start = time.perf_counter()
+    WikimediaImageDownloader(api_url=api_url, download_dir=download_dir, state=fresh_state(download_dir)).run()
+    matches = engine.scan(directory=download_dir, incremental=False)
+    elapsed = time.perf_counter() - start
+    print(f"sequential: {len(matches)} matches, first and last after {elapsed:.2f}s")
+    return elapsed
+
+
+def streaming(engine: ScanEngine, api_url: str, download_dir: str) -> float:
+    start = time.perf_counter()
+    downloader = WikimediaImageDownloader(api_url=api_url, download_dir=download_dir, state=fresh_state(download_dir))
+    scan = StreamingScan(engine, downloader)
+    matches = scan.run()
+    elapsed = time.perf_counter() - start
+    first = f"{scan.time_to_first_match:.2f}s" if scan.time_to_first_match is not None else "never"
+    print(f"streaming:  {len(matches)} matches, first after {first}, last after {elapsed:.2f}s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user-images', default='../algorithm/user_images')
+    parser.add_argument('--crawl-images', default='../algorithm/new_images')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds added to every mock response')
+    parser.add_argument('--max-images', type=int, default=1000)
+    args = parser.parse_args()
+
+    user_images = os.path.abspath(args.user_images)
+    mock = MockMediaWiki(os.path.abspath(args.crawl_images), latency=args.latency)
+    api_url = mock.start()
+    completely_legal_scraping.MAX_IMAGES = args.max_images
+
+    workdir = tempfile.mkdtemp(prefix='arttrack-bench-')
+    os.chdir(workdir)  # keep the crawl metadata and embedding store out of the source tree
+    try:
+        engine = ScanEngine(store_path=os.path.join(workdir, 'user_embeddings.db'))
+        engine.load(user_images)
+        for run in (sequential, streaming):
+            download_dir = os.path.join(workdir, run.__name__)
+            os.makedirs(download_dir)
+            if os.path.exists(completely_legal_scraping.METADATA_FILE):
+                os.remove(completely_legal_scraping.METADATA_FILE)
+            run(engine, api_url, download_dir)
+    finally:
+        mock.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
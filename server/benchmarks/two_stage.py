@@ -0,0 +1,102 @@
+"""throughput of the two-stage scan (perceptual-hash prefilter + ResNet) and its agreement with the ResNet-only baseline
+
+the crawl set is the given crawl images plus synthetic infringements of the user images:
+exact copies, downscaled and recompressed copies (caught by the prefilter) and crops (left to ResNet)
+
+run from the server directory:
+    python -m benchmarks.two_stage --user-images ../algorithm/user_images --crawl-images ../algorithm/new_images
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from collections import Counter
+from typing import Set, Tuple
+from PIL import Image
+
+from algorithm import load_image_paths
+from crawl_state import CrawlState
+from engine import ScanEngine
+from ann_index import SIMILARITY_THRESHOLD
+
+MAX_LISTED = 20  # missed pairs printed
+
+
+def make_infringements(user_paths, out_dir: str) -> Set[Tuple[str, str]]:
+    """
+    write altered copies of every user image
+
+    :return: (copy filename, user filename) pairs a scan should report
+    """
+    pairs = set()
+    for path in user_paths:
+        filename = os.path.basename(path)
+        name = os.path.splitext(filename)[0]
+        try:
+            image = Image.open(path).convert('RGB')
+        except Exception:
+            continue
+        shutil.copy(path, os.path.join(out_dir, f'copy_{filename}'))
+        small = image.resize((max(1, image.width // 2), max(1, image.height // 2)), Image.BILINEAR)
+        small.save(os.path.join(out_dir, f'small_{name}.jpg'), quality=70)
+        w, h = image.size
+        image.crop((w // 10, h // 10, w - w // 10, h - h // 10)).save(os.path.join(out_dir, f'crop_{name}.jpg'), quality=90)
+        pairs.update({(f'copy_{filename}', filename), (f'small_{name}.jpg', filename), (f'crop_{name}.jpg', filename)})
+    return pairs
+
+
+def timed_scan(engine: ScanEngine, directory: str, threshold: float, two_stage: bool, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        matches = engine.scan(directory=directory, threshold=threshold, two_stage=two_stage, incremental=False)
+        best = min(best, time.perf_counter() - start)
+    return matches, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user-images', default='../algorithm/user_images')
+    parser.add_argument('--crawl-images', default='../algorithm/new_images')
+    parser.add_argument('--threshold', type=float, default=SIMILARITY_THRESHOLD)
+    parser.add_argument('--repeat', type=int, default=3, help='scans per mode, the fastest is reported')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='arttrack-bench-')
+    try:
+        crawl_dir = os.path.join(workdir, 'crawl')
+        shutil.copytree(os.path.abspath(args.crawl_images), crawl_dir)
+        expected = make_infringements(load_image_paths(os.path.abspath(args.user_images)), crawl_dir)
+        num_images = len(load_image_paths(crawl_dir))
+        print(f"{num_images} crawled images, {len(expected)} of them synthetic copies of user images")
+
+        engine = ScanEngine(store_path=os.path.join(workdir, 'user_embeddings.db'),
+                            crawl_store_path=os.path.join(workdir, 'crawl_embeddings.db'),
+                            crawl_state=CrawlState(os.path.join(workdir, 'crawl_state.db')))
+        engine.load(os.path.abspath(args.user_images))
+
+        baseline, baseline_seconds = timed_scan(engine, crawl_dir, args.threshold, False, args.repeat)
+        two_stage, two_stage_seconds = timed_scan(engine, crawl_dir, args.threshold, True, args.repeat)
+
+        baseline_pairs = {(m['new_filename'], m['user_filename']) for m in baseline}
+        two_stage_pairs = {(m['new_filename'], m['user_filename']) for m in two_stage}
+        agreed = baseline_pairs & two_stage_pairs
+        stages = Counter(m['stage'] for m in two_stage)
+        prefiltered = len({m['new_filename'] for m in two_stage if m['stage'] == 'phash'})
+
+        print(f"resnet only: {num_images / baseline_seconds:8.1f} images/s, {len(baseline_pairs)} matches, "
+              f"{len(expected & baseline_pairs)}/{len(expected)} copies found")
+        print(f"two-stage:   {num_images / two_stage_seconds:8.1f} images/s, {len(two_stage_pairs)} matches "
+              f"({stages['phash']} phash, {stages['resnet']} resnet), {len(expected & two_stage_pairs)}/{len(expected)} copies found, "
+              f"{prefiltered} images skipped the extractor")
+        print(f"agreement:   {len(agreed) / max(1, len(baseline_pairs)):.3f} of baseline matches found, "
+              f"{len(two_stage_pairs - baseline_pairs)} matches only in two-stage")
+        for new_filename, user_filename in sorted(baseline_pairs - two_stage_pairs)[:MAX_LISTED]:
+            print(f"  missed: {new_filename} -> {user_filename}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,34 @@
 import os  
 import sys 
 import csv
+import hashlib
 import logging  
+import time
+import threading
 from dataclasses import dataclass, asdict  
-from typing import List, Dict, Optional, Set  
+from typing import Callable, List, Dict, Optional  
 from concurrent.futures import ThreadPoolExecutor, as_completed  
 import requests  
 from urllib.parse import urlencode  
 from PIL import Image  
-from io import BytesIO  
+
+import compression
+from crawl_state import CrawlState
+from metrics import DOWNLOADED_BYTES, IMAGES, timed
+from perceptual_hash import DHASH_MAX_DISTANCE, HashIndex, dhash, hash_to_hex, hex_to_hash
  
 
+API_URL = 'https://commons.wikimedia.org/w/api.php'  # MediaWiki API endpoint
 DOWNLOAD_DIR = 'images/internet-images'  
-METADATA_FILE = 'absolutely_legal_metadata.csv'  # CSV file to store image metadata
-COMPRESSION_QUALITY = 85  # JPEG quality for compression (1-95)
+METADATA_FILE = 'absolutely_legal_metadata.csv'  # CSV export of image metadata, read by the node server
+COMPRESSION_QUALITY = compression.MAX_QUALITY  # JPEG quality for compression (1-95)
+TARGET_SIZE = compression.TARGET_BYTES  # byte budget of a saved image (0.5 MB)
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')  # re-encoded images with another extension get .jpg appended
 
 MAX_WORKERS = 8  # number of threads for concurrent downloads
 MAX_IMAGES = 10  # maximum number of images to download
+IMAGEINFO_BATCH_SIZE = 50  # titles per imageinfo query, the API limit for regular clients
+CRAWLER_MODE = 'async'  # 'async' (asyncio + aiohttp, see async_crawler.py) or 'threads'
 
 CATEGORY = 'Featured pictures on Wikimedia Commons'  # category to download images from
 LICENSES = ['CC BY-SA 4.0', 'CC BY 4.0', 'Public domain']  # acceptable licenses
@@ -40,36 +52,69 @@ class ImageMetadata:
     license: str
     attribution: str
     local_path: Optional[str] = None  # path where the image is saved
+    sha1: Optional[str] = None  # content hash reported by the API, known before downloading
+    sha256: Optional[str] = None  # hash of the downloaded bytes
+    dhash: Optional[str] = None  # perceptual hash (hex), equal or close for resized and recompressed copies
+    duplicate_of: Optional[str] = None  # title of the crawled image this one duplicates, it is then not downloaded
 
 
 class WikimediaImageDownloader:
     """class to handle downloading images from Wikimedia Commons using the MediaWiki API"""
 
-    def __init__(self):
+    def __init__(self, progress: Optional[Callable[..., None]] = None,
+                 on_image: Optional[Callable[[ImageMetadata, Image.Image], None]] = None,
+                 api_url: str = API_URL, download_dir: str = DOWNLOAD_DIR, mode: str = CRAWLER_MODE,
+                 state: Optional[CrawlState] = None):
+        """
+        :param progress: optional callback, called as progress(downloaded=n) while images are downloaded
+        :param on_image: optional callback receiving each saved image already decoded, from the download threads
+        :param api_url: MediaWiki API endpoint, a local mock server in tests and benchmarks
+        :param download_dir: directory the images are saved to
+        :param mode: 'async' or 'threads', see CRAWLER_MODE
+        :param state: crawl cursor and already crawled images, opened from CRAWL_STATE_FILE if not given
+        """
+        self.progress = progress
+        self.on_image = on_image
+        self.api_url = api_url
+        self.download_dir = download_dir
+        self.mode = mode
         self.session = requests.Session()  # session for persistent connections
         self.session.headers.update({'User-Agent': USER_AGENT})  # set user-agent for all requests
+        self.state = state if state is not None else CrawlState()  # indexed lookups instead of re-reading the CSV
         self.images: List[ImageMetadata] = []  # list to store image metadata
-        self.downloaded_titles: Set[str] = set()  # set to store titles of already downloaded images
         self.load_existing_metadata()  # load metadata if it exists
 
+        # dedup stage: exact copies by content hash, near-exact copies by perceptual hash
+        self.hash_index = HashIndex()
+        for title, value in self.state.dhashes():
+            self.hash_index.add(hex_to_hash(value), title)
+        self.dedup_lock = threading.Lock()  # makes check-then-add atomic across download threads
+        self.crawl_sha1: Dict[str, str] = {}  # sha1 -> title of the images queued by this crawl
+        self.crawl_sha256: Dict[str, str] = {}  # sha256 -> title of the images saved by this crawl
+        self.dedup = {'checked': 0, 'sha1': 0, 'sha256': 0, 'dhash': 0}  # images checked and hits per stage
+        self.compression = compression.CompressionStats()  # encodes and CPU time of the compression stage
+
     def load_existing_metadata(self):
-        """load existing metadata from CSV to avoid re-downloading images"""
-        if os.path.exists(METADATA_FILE):
+        """import metadata CSV written before the crawl state existed, once, to avoid re-downloading images"""
+        if len(self.state):
+            logging.info(f"{len(self.state)} images already crawled")  # log count
+        elif os.path.exists(METADATA_FILE):
             try:
                 with open(METADATA_FILE, 'r', newline='', encoding='utf-8') as csvfile:  # open CSV file
                     reader = csv.DictReader(csvfile)  # create CSV reader
-                    for row in reader:
-                        self.downloaded_titles.add(row['title'])  # add title to the set
-                logging.info(f"loaded {len(self.downloaded_titles)} already downloaded images from metadata")  # log count
+                    fields = ImageMetadata.__dataclass_fields__
+                    images = [ImageMetadata(**{key: row.get(key) or None for key in fields}) for row in reader]
+                imported = self.state.add_images([image for image in images if image.title and image.url])
+                logging.info(f"imported {imported} already downloaded images from metadata")  # log count
             except Exception as e:
                 logging.error(f"failed to load existing metadata: {e}")  # log any errors
         else:
             logging.info("no existing metadata found, starting fresh")  # log if no metadata exists
 
-    def fetch_image_titles(self, cmcontinue: Optional[str] = None) -> Dict:
-        """fetch image titles from the specified category using the MediaWiki API
+    def image_titles_params(self, cmcontinue: Optional[str] = None) -> Dict:
+        """query parameters listing the files of the category
         :param cmcontinue: continuation token for pagination
-        :return: JSON response from the API
+        :return: parameters for the MediaWiki API
         """
         params = {
             'action': 'query',
@@ -81,31 +126,48 @@ class WikimediaImageDownloader:
         }
         if cmcontinue:
             params['cmcontinue'] = cmcontinue  # add continuation token if present
+        return params
 
+    def fetch_image_titles(self, cmcontinue: Optional[str] = None) -> Dict:
+        """fetch image titles from the specified category using the MediaWiki API
+        :param cmcontinue: continuation token for pagination
+        :return: JSON response from the API
+        """
+        params = self.image_titles_params(cmcontinue)
         try:
-            response = self.session.get('https://commons.wikimedia.org/w/api.php', params=params)  # make GET request
+            with timed('api'):
+                response = self.session.get(self.api_url, params=params)  # make GET request
+            DOWNLOADED_BYTES.inc(len(response.content), kind='api')
             response.raise_for_status()  # raise exception for HTTP errors
             return response.json()  # return JSON response
         except requests.RequestException as e:
             logging.error(f"error fetching image titles: {e}")  # log any request exceptions
             return {}
 
-    def fetch_image_info(self, titles: List[str]) -> Dict:
-        """fetch detailed image information for a batch of titles
+    def image_info_params(self, titles: List[str]) -> Dict:
+        """query parameters for detailed image information of a batch of titles
         :param titles: list of image titles
-        :return: JSON response from the API
+        :return: parameters for the MediaWiki API
         """
-        params = {
+        return {
             'action': 'query',
             'format': 'json',
             'prop': 'imageinfo',
             'titles': '|'.join(titles),
-            'iiprop': 'url|user|extmetadata',
+            'iiprop': 'url|user|extmetadata|sha1',
             'iiurlwidth': 800,  # specify desired image width
         }
 
+    def fetch_image_info(self, titles: List[str]) -> Dict:
+        """fetch detailed image information for a batch of titles
+        :param titles: list of image titles
+        :return: JSON response from the API
+        """
+        params = self.image_info_params(titles)
         try:
-            response = self.session.get('https://commons.wikimedia.org/w/api.php', params=params)  # make GET request
+            with timed('api'):
+                response = self.session.get(self.api_url, params=params)  # make GET request
+            DOWNLOADED_BYTES.inc(len(response.content), kind='api')
             response.raise_for_status()  # raise exception for HTTP errors
             return response.json()  # return JSON response
         except requests.RequestException as e:
@@ -117,6 +179,8 @@ class WikimediaImageDownloader:
         :param data: JSON response from the API
         """
         pages = data.get('query', {}).get('pages', {})  # extract pages from response
+        known_titles = self.state.known_titles(page.get('title', '') for page in pages.values())  # one indexed lookup per batch
+        known_sha1 = self.state.originals_by_sha1(page['imageinfo'][0].get('sha1') for page in pages.values() if page.get('imageinfo'))
 
         for page_id, page in pages.items():
             imageinfo = page.get('imageinfo', [])
@@ -131,7 +195,7 @@ class WikimediaImageDownloader:
                 continue  # skip images with unacceptable licenses
 
             title = page.get('title', '')
-            if title in self.downloaded_titles:
+            if title in known_titles:
                 logging.info(f"skipping already downloaded image: {title}")  # log skipped image
                 continue  # skip already downloaded images
 
@@ -141,16 +205,50 @@ class WikimediaImageDownloader:
                 descriptionurl=info.get('descriptionurl', ''),
                 user=info.get('user', ''),
                 license=license_short_name,
-                attribution=extmetadata.get('Attribution', {}).get('value', '')
+                attribution=extmetadata.get('Attribution', {}).get('value', ''),
+                sha1=info.get('sha1')
             )
+            if self.is_duplicate(metadata, known_sha1):
+                continue  # same bytes as an image already crawled, skip download and embedding
             self.images.append(metadata)  # add to images list
 
             if len(self.images) >= MAX_IMAGES:
                 break  # stop if maximum number of images reached
 
+    def is_duplicate(self, image: ImageMetadata, known_sha1: Dict[str, str]) -> bool:
+        """first dedup stage, before download: the sha1 reported by the API matches an image already crawled
+        :param image: metadata of a title not crawled yet
+        :param known_sha1: sha1 -> title of crawled images, looked up for the whole batch
+        :return: True if the image is a duplicate, it is then recorded as such
+        """
+        with self.dedup_lock:
+            self.dedup['checked'] += 1
+            if not image.sha1:
+                return False
+            original = known_sha1.get(image.sha1) or self.crawl_sha1.get(image.sha1)
+            if not original:
+                self.crawl_sha1[image.sha1] = image.title
+                return False
+            self.dedup['sha1'] += 1
+        self.record_duplicate(image, original, 'sha1')
+        return True
+
+    def record_duplicate(self, image: ImageMetadata, original: str, stage: str):
+        """remember a duplicate so it is never fetched again, the original's embedding and matches stand for it"""
+        image.duplicate_of = original
+        image.local_path = None
+        IMAGES.inc(stage='duplicate')
+        self.state.add_images([image])
+        logging.info(f"skipping {image.title}, {stage} duplicate of {original}")
+
+    def dedup_report(self) -> Dict[str, float]:
+        """:return: images checked, hits per dedup stage and the overall hit rate of this crawl"""
+        hits = self.dedup['sha1'] + self.dedup['sha256'] + self.dedup['dhash']
+        return {**self.dedup, 'hit_rate': round(hits / self.dedup['checked'], 4) if self.dedup['checked'] else 0.0}
+
     def fetch_images(self):
-        """fetch image metadata by iterating through API responses until MAX_IMAGES is reached"""
-        cmcontinue = None
+        """fetch image metadata by iterating through API responses until MAX_IMAGES is reached, resuming from the last crawl"""
+        cmcontinue = self.state.cursor(CATEGORY)
 
         while len(self.images) < MAX_IMAGES:
             data = self.fetch_image_titles(cmcontinue)  # fetch image titles
@@ -164,9 +262,8 @@ class WikimediaImageDownloader:
                 break  # exit if no titles found
 
             # batch titles to avoid exceeding URL length limits
-            batch_size = 10  # number of titles per batch
-            for i in range(0, len(titles), batch_size):
-                batch_titles = titles[i:i + batch_size]
+            for i in range(0, len(titles), IMAGEINFO_BATCH_SIZE):
+                batch_titles = titles[i:i + IMAGEINFO_BATCH_SIZE]
                 info_data = self.fetch_image_info(batch_titles)  # fetch image info for the batch
                 if not info_data:
                     continue  # skip if no data returned
@@ -175,96 +272,140 @@ class WikimediaImageDownloader:
                 if len(self.images) >= MAX_IMAGES:
                     break  # stop if maximum number of images reached
 
-            cmcontinue = data.get('continue', {}).get('cmcontinue')  # get continuation token
+            cmcontinue = self.next_cursor(data)
             if not cmcontinue:
                 break  # exit if no more pages
 
+    def next_cursor(self, data: Dict) -> Optional[str]:
+        """advance the stored cursor past a fully processed page of categorymembers
+        :param data: categorymembers response
+        :return: continuation token of the next page, None once the category is exhausted or MAX_IMAGES is reached
+        """
+        if len(self.images) >= MAX_IMAGES:
+            return None  # the page may hold unseen titles, the next crawl starts from it again
+        cmcontinue = data.get('continue', {}).get('cmcontinue')  # get continuation token
+        self.state.set_cursor(CATEGORY, cmcontinue)  # None wraps the next crawl around to the first page
+        return cmcontinue
+
     def download_image(self, image: ImageMetadata):
         """download and save a single image, then update its local_path
         :param image: ImageMetadata object containing image details
         """
+        if self.keep_existing(image):
+            return  # already on disk, not fetched again
         try:
-            response = self.session.get(image.url, timeout=10)  # download image with timeout
+            with timed('download'):
+                response = self.session.get(image.url, timeout=10)  # download image with timeout
+            DOWNLOADED_BYTES.inc(len(response.content), kind='image')
             response.raise_for_status()  # raise exception for HTTP errors
-
-            image_content = response.content  # get image bytes
-            img = Image.open(BytesIO(image_content))  # open image
-            img = img.convert('RGB')  # convert to RGB to ensure compatibility
-
-            # smart compression to ensure image size does not exceed 0.5 MB
-            target_size = 500000  # target size in bytes (0.5 MB)
-            buffer = BytesIO()
-            img.save(buffer, format='JPEG', quality=COMPRESSION_QUALITY)  # initial save
-            size = buffer.tell()  # current size
-
-            if size > target_size:
-                # calculate scaling factor
-                scale_factor = (target_size / size) ** 0.5  # approximate scaling factor
-                new_width = max(1, int(img.width * scale_factor))  # ensure width is at least 1
-                new_height = max(1, int(img.height * scale_factor))  # ensure height is at least 1
-                img = img.resize((new_width, new_height), Image.ANTIALIAS)  # resize image
-
-                buffer = BytesIO()
-                img.save(buffer, format='JPEG', quality=COMPRESSION_QUALITY)  # save resized image
-                size = buffer.tell()
-
-                # adjust quality if still larger
-                if size > target_size:
-                    quality = max(int(COMPRESSION_QUALITY * (target_size / size)), 10)  # calculate new quality
-                    buffer = BytesIO()
-                    img.save(buffer, format='JPEG', quality=quality)  # save with adjusted quality
-
-            buffer.seek(0)
-            img = Image.open(buffer)  # reopen image from buffer
-
-            local_filename = os.path.basename(image.url)  # extract filename from URL
-            local_path = os.path.join(DOWNLOAD_DIR, local_filename)  # define local path
-
-            if os.path.exists(local_path):
-                logging.info(f"image already exists, skipping download: {local_filename}")  # log existing image
-                image.local_path = local_path  # set existing path
-                return  # skip downloading
-
-            img.save(local_path, 'JPEG', quality=COMPRESSION_QUALITY)  # save and compress image
-            image.local_path = local_path  # update metadata with local path
-
-            logging.info(f"downloaded {local_filename}")  # log successful download
+            self.save_image(image, response.content)
         except Exception as e:
             logging.error(f"failed to download {image.url}: {e}")  # log any download errors
             image.local_path = None  # mark as failed
 
+    def local_path_for(self, image: ImageMetadata, encoded: bool = False) -> str:
+        """
+        :param encoded: the saved bytes are a JPEG encode rather than the source bytes
+        :return: where the image is saved, named after its URL, e.g. A.png or A.png.jpg once re-encoded
+        """
+        name = os.path.basename(image.url)
+        if encoded and os.path.splitext(name)[1].lower() not in JPEG_EXTENSIONS:
+            name += '.jpg'  # appended rather than replaced, A.png and A.jpg are different files
+        return os.path.join(self.download_dir, name)
+
+    def keep_existing(self, image: ImageMetadata, image_content: Optional[bytes] = None) -> bool:
+        """
+        record an image whose file is already on disk instead of decoding and compressing it again
+
+        :param image: ImageMetadata object containing image details
+        :param image_content: downloaded bytes if the check runs after the download
+        :return: False if the file does not exist yet
+        """
+        recorded = self.state.local_path(image.url)  # recorded where it was saved
+        candidates = [recorded] if recorded else [self.local_path_for(image), self.local_path_for(image, encoded=True)]
+        local_path = next((path for path in candidates if os.path.exists(path)), None)
+        if local_path is None:
+            return False
+        self.compression.record_kept()
+        logging.info(f"image already exists, skipping download: {os.path.basename(local_path)}")  # log existing image
+        if image_content is not None:
+            image.sha256 = hashlib.sha256(image_content).hexdigest()
+        image.local_path = local_path  # set existing path
+        self.state.add_images([image])
+        return True
+
+    def save_image(self, image: ImageMetadata, image_content: bytes):
+        """compress and save downloaded image bytes, then update its local_path
+        :param image: ImageMetadata object containing image details
+        :param image_content: downloaded image bytes
+        """
+        if self.keep_existing(image, image_content):
+            return  # checked before any decode or encode
+        decode_start = time.thread_time()
+        with timed('download_decode'):
+            img = compression.decode(image_content)  # large JPEGs are decoded at reduced scale
+        decode_seconds = time.thread_time() - decode_start
+
+        # second dedup stage, before compression: identical bytes, then a near-identical perceptual hash
+        image.sha256 = hashlib.sha256(image_content).hexdigest()
+        value = dhash(img)
+        image.dhash = hash_to_hex(value)
+        with self.dedup_lock:
+            stage = 'sha256'
+            original = self.state.original_by_sha256(image.sha256) or self.crawl_sha256.get(image.sha256)
+            if not original:
+                nearest = self.hash_index.nearest(value, DHASH_MAX_DISTANCE)
+                original, stage = (nearest[0] if nearest else None), 'dhash'
+            if original:
+                self.dedup[stage] += 1
+            else:
+                self.crawl_sha256[image.sha256] = image.title
+                self.hash_index.add(value, image.title)
+        if original:
+            self.record_duplicate(image, original, stage)
+            return
+
+        # fit the image into the byte budget and write the chosen encode, or the source if it fits, as it is
+        with timed('compression'):
+            result = compression.compress(img, TARGET_SIZE, COMPRESSION_QUALITY, source=image_content)
+        self.compression.record(result, len(image_content), decode_seconds)
+        local_path = self.local_path_for(image, result.encoded)
+        with open(local_path, 'wb') as f:
+            f.write(result.data)
+        image.local_path = local_path  # update metadata with local path
+        IMAGES.inc(stage='downloaded')
+        self.state.add_images([image])  # recorded as it lands, an interrupted crawl resumes without re-fetching
+        if self.on_image:
+            self.on_image(image, result.image)  # hand the decoded image on, e.g. to a streaming scan
+
+        logging.info(f"downloaded {os.path.basename(local_path)} ({len(result.data)} bytes, quality {result.quality}, "
+                     f"scale {result.scale:.2f}, {result.encodes} encodes)")  # log successful download
+
     def download_all_images(self):
         """download all images concurrently using ThreadPoolExecutor"""
+        downloaded = 0
         with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
             # submit all download tasks
             future_to_image = {executor.submit(self.download_image, image): image for image in self.images}
             for future in as_completed(future_to_image):
                 image = future_to_image[future]
                 if image.local_path:
-                    self.downloaded_titles.add(image.title)  # add to downloaded titles
-                else:
+                    downloaded += 1
+                    if self.progress:
+                        self.progress(downloaded=downloaded)
+                elif not image.duplicate_of:
                     logging.warning(f"image {image.title} was not downloaded successfully")  # log if not downloaded
 
-    def save_metadata_to_csv(self): # now it keeps all urls  
-        """save all image metadata to a CSV file"""
+    def save_metadata_to_csv(self):
+        """append the metadata of the images downloaded by this crawl to the CSV export"""
         try:
-            existing_titles = set()  
-            if os.path.exists(METADATA_FILE):
-                with open(METADATA_FILE, 'r', newline='', encoding='utf-8') as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    for row in reader:
-                        existing_titles.add(row['title']) 
-
-            new_rows = []
-            for image in self.images:
-                if image.title not in existing_titles:  # check for new entries
-                    new_rows.append(asdict(image))
-
+            # the crawl state only hands out unseen titles, so the rows are new and the file need not be re-read
+            new_rows = [asdict(image) for image in self.images if image.local_path]
             if new_rows:  # only append if there are new rows
                 with open(METADATA_FILE, 'a', newline='', encoding='utf-8') as csvfile:
                     fieldnames = ['title', 'url', 'descriptionurl', 'user', 'license', 'attribution', 'local_path']
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                    if os.path.getsize(METADATA_FILE) == 0:  # if the file is empty, write the header
+                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')  # hashes stay in the crawl state
+                    if csvfile.tell() == 0:  # if the file is empty, write the header
                         writer.writeheader()
                     writer.writerows(new_rows)  # append new rows
 
@@ -273,26 +414,40 @@ class WikimediaImageDownloader:
             logging.error(f"failed to save metadata to CSV: {e}")  # log any errors during save
 
     def run(self):
-        """execute the full image downloading and metadata saving process"""
-        if not os.path.exists(DOWNLOAD_DIR):
-            os.makedirs(DOWNLOAD_DIR)  # create download directory if it doesn't exist
+        """execute the full image downloading and metadata saving process
+        :return: False if no images were found to download
+        """
+        if self.mode == 'async':
+            try:
+                from async_crawler import AsyncWikimediaCrawler  # needs aiohttp
+            except ImportError as e:
+                logging.warning(f"async crawler unavailable ({e}), falling back to threads")
+            else:
+                return AsyncWikimediaCrawler(self).run()
+
+        if not os.path.exists(self.download_dir):
+            os.makedirs(self.download_dir)  # create download directory if it doesn't exist
 
         logging.info(f"starting image fetch for category: {CATEGORY}")  # log start of fetching
         self.fetch_images()
 
         if not self.images:
             logging.error("no images found to download")  # log if no images found
-            sys.exit(1)  # exit script with error
+            return False
 
         logging.info(f"found {len(self.images)} images. starting download...")  # log number of images found
         self.download_all_images()  # download all images concurrently
 
         logging.info("all downloads completed. saving metadata...")  # log completion of downloads
         self.save_metadata_to_csv() 
+        logging.info(f"dedup: {self.dedup_report()}")
+        logging.info(f"compression: {self.compression.report()}")
 
         logging.info("process completed successfully")  # log successful completion
+        return True
 
 
 if __name__ == "__main__":
     downloader = WikimediaImageDownloader()  
-    downloader.run()  
+    if not downloader.run():
+        sys.exit(1)  # exit script with error
@@ -0,0 +1,179 @@
+import time
+import logging
+import threading
+from io import BytesIO
+from dataclasses import dataclass
+from typing import Optional
+from PIL import Image
+
+# configuration
+TARGET_BYTES = 500_000  # byte budget of a saved image (0.5 MB)
+MAX_QUALITY = 85  # JPEG quality images are saved at when they fit the budget
+MIN_QUALITY = 30  # lowest quality tried once the smallest scale still does not fit
+MIN_SCALE = 0.05  # smallest downscale factor tried
+MAX_ENCODES = 6  # JPEG encodes per image, the search keeps the largest one that fit
+FILL_RATIO = 0.85  # a fitting encode this close to the budget ends the search early
+DRAFT_BITS_PER_PIXEL = 1.0  # JPEG sources are draft-decoded down to about TARGET_BYTES * 8 / this many pixels
+RESIZE_FILTER = Image.LANCZOS  # Image.ANTIALIAS was removed in Pillow 10
+REDUCING_GAP = 3.0  # let Pillow shrink by whole factors first when downscaling a lot
+
+
+@dataclass
+class Compressed:
+    """one image encoded to the byte budget"""
+    data: bytes  # bytes to write as they are, JPEG unless the source was passed through
+    image: Image.Image  # the RGB image that was encoded, at the chosen scale
+    quality: Optional[int]  # None when the source was passed through
+    scale: float  # relative to the decoded source
+    encodes: int  # 0 when the source was passed through
+    seconds: float  # CPU time spent resizing and encoding
+
+    @property
+    def encoded(self) -> bool:
+        """:return: False if data are the source bytes, in the source format"""
+        return self.encodes > 0
+
+
+def decode(content: bytes, target_bytes: int = TARGET_BYTES) -> Image.Image:
+    """
+    decode downloaded bytes to RGB, letting libjpeg skip resolution the byte budget could never keep
+
+    :param content: downloaded image bytes
+    :param target_bytes: byte budget the image will be compressed to
+    :return: RGB image, possibly at 1/2, 1/4 or 1/8 of the source resolution
+    """
+    image = Image.open(BytesIO(content))
+    max_pixels = target_bytes * 8 / DRAFT_BITS_PER_PIXEL
+    if image.format == 'JPEG' and image.width * image.height > max_pixels:
+        ratio = (max_pixels / (image.width * image.height)) ** 0.5
+        image.draft('RGB', (max(1, int(image.width * ratio)), max(1, int(image.height * ratio))))
+    return image.convert('RGB')
+
+
+def _encode(image: Image.Image, quality: int) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=False)
+    return buffer.getvalue()
+
+
+def _resized(image: Image.Image, scale: float) -> Image.Image:
+    if scale >= 1.0:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, RESIZE_FILTER, reducing_gap=REDUCING_GAP)
+
+
+def _next_scale(low: Optional[tuple], high: tuple, target_bytes: int) -> float:
+    """
+    next scale to try between the largest fitting encode and the smallest oversized one, JPEG size grows
+    roughly linearly with the pixel count so interpolate in scale squared, aiming a little under the budget
+
+    :param low: (scale, size) of the largest encode that fit, None if none did yet
+    :param high: (scale, size) of the smallest encode that was too large
+    """
+    goal = 0.95 * target_bytes
+    low_scale, low_size = low if low is not None else (0.0, 0)
+    high_scale, high_size = high
+    fraction = (goal - low_size) / max(1, high_size - low_size)
+    scale = (low_scale ** 2 + fraction * (high_scale ** 2 - low_scale ** 2)) ** 0.5
+    margin = 0.1 * (high_scale - low_scale)  # stay strictly inside the bracket so every encode narrows it
+    return max(MIN_SCALE, low_scale + margin, min(scale, high_scale - margin))
+
+
+def compress(image: Image.Image, target_bytes: int = TARGET_BYTES, quality: int = MAX_QUALITY,
+             source: Optional[bytes] = None) -> Compressed:
+    """
+    fit an image into the byte budget with a bounded number of encodes: keep the quality and search the scale,
+    only lower the quality when even MIN_SCALE is too large
+
+    :param image: RGB image
+    :param target_bytes: byte budget
+    :param quality: JPEG quality to keep if possible
+    :param source: the downloaded bytes, passed through unchanged when they already fit the budget
+    :return: the source bytes if they fit, else the largest encode that fit, the smallest one if none did
+    """
+    if source is not None and len(source) <= target_bytes:
+        return Compressed(source, image, None, 1.0, 0, 0.0)  # a re-encode could only lose quality or grow
+    start = time.thread_time()  # CPU time of this download thread only
+    data = _encode(image, quality)
+    encodes = 1
+    best = (data, image, quality, 1.0)
+    if len(data) > target_bytes:
+        best, smallest = None, best
+        low, high = None, (1.0, len(data))  # (scale, size) brackets
+        while encodes < MAX_ENCODES and high[0] > MIN_SCALE and (low is None or high[0] - low[0] > 0.01):
+            scale = _next_scale(low, high, target_bytes)
+            resized = _resized(image, scale)
+            data = _encode(resized, quality)
+            encodes += 1
+            if len(data) <= target_bytes:
+                best, low = (data, resized, quality, scale), (scale, len(data))  # every fit is larger than the last
+                if len(data) >= FILL_RATIO * target_bytes:
+                    break
+            else:
+                smallest, high = (data, resized, quality, scale), (scale, len(data))
+        if best is None:
+            # even the smallest scale is too large, trade quality instead
+            _, resized, _, scale = smallest
+            low_quality, high_quality = MIN_QUALITY, quality
+            while encodes < 2 * MAX_ENCODES and high_quality - low_quality > 1:
+                middle = (low_quality + high_quality) // 2
+                data = _encode(resized, middle)
+                encodes += 1
+                if len(data) <= target_bytes:
+                    best, low_quality = (data, resized, middle, scale), middle
+                else:
+                    high_quality = middle
+            if best is None:
+                logging.warning(f"image does not fit {target_bytes} bytes even at quality {MIN_QUALITY}")
+                best = smallest
+    data, encoded, chosen_quality, scale = best
+    return Compressed(data, encoded, chosen_quality, scale, encodes, time.thread_time() - start)
+
+
+class CompressionStats:
+    """thread-safe totals of the compression stage, for the crawl report"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = 0  # saved, encoded or passed through
+        self.encoded = 0
+        self.kept = 0  # already on disk, neither decoded nor encoded
+        self.encodes = 0
+        self.encode_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def record(self, result: Compressed, source_bytes: int, decode_seconds: float):
+        with self.lock:
+            self.images += 1
+            self.encoded += result.encoded
+            self.encodes += result.encodes
+            self.encode_seconds += result.seconds
+            self.decode_seconds += decode_seconds
+            self.bytes_in += source_bytes
+            self.bytes_out += len(result.data)
+
+    def record_kept(self):
+        with self.lock:
+            self.kept += 1
+
+    def report(self) -> dict:
+        with self.lock:
+            images = max(1, self.images)
+            encode_cost = self.encode_seconds / max(1, self.encoded)
+            decode_cost = self.decode_seconds / images
+            # skipped work priced at this crawl's own averages: passed through images skip the encodes,
+            # images already on disk skip the decode as well
+            saved = (self.images - self.encoded) * encode_cost + self.kept * (decode_cost + encode_cost)
+            return {
+                "images": self.images,
+                "passed_through": self.images - self.encoded,
+                "kept": self.kept,
+                "encodes_per_image": round(self.encodes / images, 2),
+                "cpu_ms_per_image": round((self.encode_seconds + self.decode_seconds) * 1000 / images, 1),
+                "cpu_ms_saved": round(saved * 1000, 1),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
@@ -0,0 +1,159 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+import faiss
+from typing import List, Optional, Tuple
+
+from algorithm import normalize_vectors
+from ann_index import INDEX_MODE, SIMILARITY_THRESHOLD, build_index, range_search, resolve_index_mode, supports_remove
+from embedding_store import EmbeddingStore
+
+# configuration
+CRAWL_INDEX_FILE = 'crawl_index.faiss'  # faiss index over every crawled embedding, reloaded at startup
+CRAWL_INDEX_MODE = INDEX_MODE  # chosen by corpus size like the user index, 'mapped' is not supported here
+CRAWL_INDEX_SAVE_EVERY = 1024  # additions after which the index is written out again
+
+
+class CrawlIndex:
+    """
+    persistent faiss index over the embeddings of all crawled images, the reverse direction of the user index:
+    one new user image is queried against the whole crawl history
+    """
+
+    def __init__(self, store: EmbeddingStore, dimension: int, path: str = CRAWL_INDEX_FILE, mode: str = CRAWL_INDEX_MODE):
+        """
+        :param store: embedding store of the crawled images, ids of the index are its row ids
+        :param dimension: embedding dimension of the store's backbone
+        :param path: faiss index file, a JSON sidecar next to it records the model id and the last indexed row
+        """
+        self.store = store
+        self.dimension = dimension
+        self.path = path
+        self.meta_path = path + '.json'
+        self.configured_mode = mode
+        self.lock = threading.Lock()  # guards the index, the id map and the save counters
+        self.save_lock = threading.Lock()  # one writer of the files at a time
+        self.index: Optional[faiss.Index] = None
+        self.mode: Optional[str] = None
+        self.filenames = {}  # faiss id -> crawled filename
+        self.max_id = 0  # largest store row id in the index
+        self.unsaved = 0
+
+    def load(self):
+        """read the saved index and add the rows stored since, or rebuild it from the store if it does not fit"""
+        meta = None
+        if os.path.exists(self.path) and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        filenames = self.store.filenames_by_id()
+        if meta is not None and meta.get('model_id') == self.store.model_id:
+            index = faiss.read_index(self.path)
+            indexed = sum(1 for row_id in filenames if row_id <= meta['max_id'])
+            if index.ntotal == indexed and index.d == self.dimension:
+                with self.lock:
+                    self.index, self.mode, self.max_id = index, meta['mode'], meta['max_id']
+                    self.filenames = {row_id: name for row_id, name in filenames.items() if row_id <= self.max_id}
+                added = self.catch_up()
+                if added:
+                    self.save()
+                logging.info(f"loaded {self.mode} crawl index with {index.ntotal - added} images, added {added} stored since")
+                return
+            logging.warning(f"crawl index {self.path} is out of sync with the embedding store, rebuilding it")
+        self.rebuild(len(filenames))
+
+    def rebuild(self, num_vectors: Optional[int] = None):
+        """build a fresh index over every stored crawled embedding"""
+        mode = resolve_index_mode(self.configured_mode, len(self.store) if num_vectors is None else num_vectors)
+        if mode == 'mapped':
+            mode = 'flat'  # the mapped index directory belongs to the user index
+        # trained modes need their training vectors up front, the others are filled chunk by chunk
+        training = mode in ('ivf', 'ivfpq')
+        if training:
+            ids, _, vectors = self.store.load()
+            index = build_index(normalize_vectors(vectors.astype('float32')), ids, mode, self.dimension)
+        else:
+            index = build_index(np.empty((0, self.dimension), dtype='float32'), np.empty(0, dtype='int64'), mode, self.dimension)
+        with self.lock:
+            self.index, self.mode, self.filenames, self.max_id = index, mode, {}, 0
+            if training:
+                self.filenames = self.store.filenames_by_id()
+                self.max_id = max(self.filenames, default=0)
+        if not training:
+            self.catch_up()
+        self.save()
+        logging.info(f"{mode} crawl index built with {index.ntotal} images")
+
+    def catch_up(self) -> int:
+        """add the stored embeddings newer than the index, :return: how many were added"""
+        added = 0
+        for ids, filenames, vectors in self.store.iter_chunks(after_id=self.max_id):
+            self.add(ids, filenames, vectors, autosave=False)  # the caller saves once at the end
+            added += len(ids)
+        return added
+
+    def add(self, ids: np.ndarray, filenames: List[str], vectors: np.ndarray, autosave: bool = True):
+        """
+        index embeddings just written to the store, re-embedded rows replace their old vector
+
+        :param ids: store row ids
+        :param filenames: crawled filenames aligned with ids
+        :param vectors: (n, D) unnormalized feature vectors
+        :param autosave: write the index out once CRAWL_INDEX_SAVE_EVERY additions are unsaved
+        """
+        if not len(ids):
+            return
+        vectors = normalize_vectors(vectors.astype('float32'))
+        with self.lock:
+            known = np.array([row_id in self.filenames for row_id in ids.tolist()], dtype=bool)
+            if known.any():
+                if supports_remove(self.mode):
+                    self.index.remove_ids(ids[known])
+                else:
+                    ids, vectors, filenames = ids[~known], vectors[~known], [f for f, k in zip(filenames, known) if not k]
+            self.index.add_with_ids(vectors, ids)
+            self.filenames.update(zip(ids.tolist(), filenames))
+            self.max_id = max(self.max_id, int(ids.max()) if len(ids) else 0)
+            self.unsaved += len(ids)
+            save = autosave and self.unsaved >= CRAWL_INDEX_SAVE_EVERY
+        if save:
+            self.save()
+
+    def search(self, query: np.ndarray, threshold: float = SIMILARITY_THRESHOLD) -> List[Tuple[str, float]]:
+        """
+        :param query: (D,) unnormalized feature vector of one user image
+        :param threshold: minimum percentage similarity
+        :return: (crawled filename, similarity) of every crawled image at or above the threshold
+        """
+        return [(filename, score) for _, filename, score in self.search_batch(query.reshape(1, -1), threshold)]
+
+    def search_batch(self, queries: np.ndarray, threshold: float = SIMILARITY_THRESHOLD) -> List[Tuple[int, str, float]]:
+        """
+        :param queries: (M, D) unnormalized feature vectors, e.g. every image of one user
+        :param threshold: minimum percentage similarity
+        :return: (query row, crawled filename, similarity) of every pair at or above the threshold
+        """
+        queries = normalize_vectors(queries.astype('float32'))
+        with self.lock:
+            if self.index is None or self.index.ntotal == 0 or not len(queries):
+                return []
+            rows, ids, similarity = range_search(self.index, queries, threshold)
+            return [(row, self.filenames[row_id], score)
+                    for row, row_id, score in zip(rows.tolist(), ids.tolist(), similarity.tolist()) if row_id in self.filenames]
+
+    def save(self):
+        """write the index and its sidecar atomically, readers never see a half-written file"""
+        with self.lock:
+            if self.index is None:
+                return
+            data = faiss.serialize_index(self.index)
+            meta = {'model_id': self.store.model_id, 'mode': self.mode, 'max_id': self.max_id}
+            self.unsaved = 0
+        with self.save_lock:
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(data.tobytes())
+            with open(self.meta_path + '.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(self.path + '.tmp', self.path)  # the sidecar follows, a crash in between forces a rebuild
+            os.replace(self.meta_path + '.tmp', self.meta_path)
@@ -0,0 +1,180 @@
+import os
+import time
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# configuration
+CRAWL_STATE_FILE = 'crawl_state.db'  # sqlite file holding the crawl cursor and every image crawled so far
+LOOKUP_CHUNK_SIZE = 500  # titles per IN (...) query, below sqlite's bound parameter limit
+HASH_COLUMNS = {'sha1': 'TEXT', 'sha256': 'TEXT', 'dhash': 'TEXT', 'duplicate_of': 'TEXT'}  # added after the first release
+
+
+class CrawlState:
+    """on-disk crawl state: continuation token per category and the crawled images keyed by title"""
+
+    def __init__(self, path: str = CRAWL_STATE_FILE):
+        self.path = path
+        self.lock = threading.Lock()  # sqlite connection is shared between download threads
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS cursors (
+                category TEXT PRIMARY KEY,
+                cmcontinue TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS images (
+                title TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                descriptionurl TEXT,
+                user TEXT,
+                license TEXT,
+                attribution TEXT,
+                local_path TEXT,
+                filename TEXT,
+                matched INTEGER NOT NULL DEFAULT 0,
+                added_at REAL NOT NULL
+            );
+        """)
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(images)")}
+        if 'embedded' in columns:  # the flag always meant matched by a scan, clear copies are never embedded
+            self.connection.execute("ALTER TABLE images RENAME COLUMN embedded TO matched")
+        for column, kind in HASH_COLUMNS.items():
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE images ADD COLUMN {column} {kind}")
+        self.connection.executescript("""
+            CREATE INDEX IF NOT EXISTS images_url_idx ON images (url);
+            CREATE INDEX IF NOT EXISTS images_filename_idx ON images (filename);
+            CREATE INDEX IF NOT EXISTS images_sha1_idx ON images (sha1);
+            CREATE INDEX IF NOT EXISTS images_sha256_idx ON images (sha256);
+        """)
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def cursor(self, category: str) -> Optional[str]:
+        """:return: continuation token the next crawl of the category starts from, None for the first page"""
+        with self.lock:
+            row = self.connection.execute("SELECT cmcontinue FROM cursors WHERE category = ?", (category,)).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, category: str, cmcontinue: Optional[str]):
+        """remember where the crawl of the category stopped, None starts the next crawl over from the first page"""
+        with self.lock:
+            self.connection.execute("""
+                INSERT INTO cursors (category, cmcontinue, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(category) DO UPDATE SET cmcontinue = excluded.cmcontinue, updated_at = excluded.updated_at
+            """, (category, cmcontinue, time.time()))
+            self.connection.commit()
+
+    def originals_by_sha1(self, sha1s: Iterable[str]) -> Dict[str, str]:
+        """:return: sha1 -> title of the crawled image with that content, for the sha1s seen before"""
+        sha1s = [sha1 for sha1 in sha1s if sha1]
+        originals = {}
+        with self.lock:
+            for i in range(0, len(sha1s), LOOKUP_CHUNK_SIZE):
+                chunk = sha1s[i:i + LOOKUP_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.connection.execute(f"""
+                    SELECT sha1, title FROM images WHERE sha1 IN ({placeholders}) AND duplicate_of IS NULL
+                """, chunk)
+                originals.update(rows)
+        return originals
+
+    def original_by_sha256(self, sha256: str) -> Optional[str]:
+        """:return: title of the crawled image with exactly these bytes, None if there is none"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT title FROM images WHERE sha256 = ? AND duplicate_of IS NULL", (sha256,)).fetchone()
+        return row[0] if row else None
+
+    def dhashes(self) -> List[Tuple[str, str]]:
+        """:return: (title, dhash hex) of every crawled image that is not itself a duplicate"""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT title, dhash FROM images WHERE dhash IS NOT NULL AND duplicate_of IS NULL").fetchall()
+
+    def known_titles(self, titles: Iterable[str]) -> Set[str]:
+        """:return: the subset of titles that have already been crawled"""
+        titles = list(titles)
+        known = set()
+        with self.lock:
+            for i in range(0, len(titles), LOOKUP_CHUNK_SIZE):
+                chunk = titles[i:i + LOOKUP_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.connection.execute(f"SELECT title FROM images WHERE title IN ({placeholders})", chunk)
+                known.update(title for title, in rows)
+        return known
+
+    def local_path(self, url: str) -> Optional[str]:
+        """:return: where the image at url was saved, None if it was never downloaded"""
+        with self.lock:
+            row = self.connection.execute("SELECT local_path FROM images WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def add_images(self, images: List) -> int:
+        """
+        record crawled images, titles seen before are left untouched
+
+        :param images: ImageMetadata objects, either downloaded (local_path set) or skipped as duplicates (duplicate_of set)
+        :return: number of images that were new
+        """
+        rows = [(image.title, image.url, image.descriptionurl, image.user, image.license, image.attribution,
+                 image.local_path, os.path.basename(image.local_path) if image.local_path else None,
+                 image.sha1, image.sha256, image.dhash, image.duplicate_of, time.time())
+                for image in images]
+        with self.lock:
+            before = self.connection.total_changes
+            self.connection.executemany("""
+                INSERT INTO images (title, url, descriptionurl, user, license, attribution, local_path, filename,
+                                    sha1, sha256, dhash, duplicate_of, added_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(title) DO NOTHING
+            """, rows)
+            self.connection.commit()
+            return self.connection.total_changes - before
+
+    def unmatched(self) -> List[Tuple[str, Optional[str]]]:
+        """:return: (local path, dhash hex) of downloaded images never matched, left over by an interrupted scan"""
+        with self.lock:
+            return self.connection.execute("""
+                SELECT local_path, dhash FROM images
+                WHERE local_path IS NOT NULL AND duplicate_of IS NULL AND matched = 0 ORDER BY added_at
+            """).fetchall()
+
+    def downloaded(self) -> List[Tuple[str, str, Optional[str], bool]]:
+        """:return: (filename, local path, dhash hex, matched by a scan) of every downloaded image that is not a duplicate"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT filename, local_path, dhash, matched FROM images WHERE local_path IS NOT NULL AND duplicate_of IS NULL")
+            return [(filename, path, value, bool(matched)) for filename, path, value, matched in rows]
+
+    def duplicates(self) -> Dict[str, str]:
+        """:return: title of every image skipped as a duplicate -> filename of the downloaded original standing for it"""
+        with self.lock:
+            return dict(self.connection.execute("""
+                SELECT duplicate.title, original.filename FROM images AS duplicate
+                JOIN images AS original ON original.title = duplicate.duplicate_of
+                WHERE original.filename IS NOT NULL
+            """).fetchall())
+
+    def matched_filenames(self, filenames: Iterable[str]) -> Set[str]:
+        """:return: the subset of filenames already matched against the user index"""
+        filenames = list(filenames)
+        matched = set()
+        with self.lock:
+            for i in range(0, len(filenames), LOOKUP_CHUNK_SIZE):
+                chunk = filenames[i:i + LOOKUP_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT filename FROM images WHERE matched = 1 AND filename IN ({placeholders})", chunk)
+                matched.update(filename for filename, in rows)
+        return matched
+
+    def mark_matched(self, filenames: List[str]):
+        """flag crawled images that have been matched against the user index, scans never query them again"""
+        with self.lock:
+            self.connection.executemany("UPDATE images SET matched = 1 WHERE filename = ?", [(f,) for f in filenames])
+            self.connection.commit()
@@ -0,0 +1,114 @@
+import logging
+import numpy as np
+from typing import Optional
+
+# configuration
+EMBEDDING_DTYPE = 'float16'  # 'float32', 'float16' or 'int8' storage of each component
+EMBEDDING_DTYPES = ('float32', 'float16', 'int8')
+PCA_DIMS: Optional[int] = None  # reduce embeddings to this many dimensions (e.g. 256), None keeps all of them
+INT8_MAX = 127
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingCodec:
+    """
+    compact embedding format: optional PCA projection, then float16 or per-dimension symmetric int8 quantisation,
+    inner products of encoded vectors approximate the cosine similarity of the originals
+    """
+
+    def __init__(self, dtype: str = EMBEDDING_DTYPE, pca_dims: Optional[int] = PCA_DIMS):
+        """
+        :param dtype: one of EMBEDDING_DTYPES
+        :param pca_dims: output dimension of the PCA projection, None to skip it
+        """
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"unknown embedding dtype {dtype}, expected one of {EMBEDDING_DTYPES}")
+        self.dtype = dtype
+        self.pca_dims = pca_dims
+        self.components: Optional[np.ndarray] = None  # (D, pca_dims) projection, None without PCA
+        self.scale: Optional[np.ndarray] = None  # per-dimension int8 step, None for float formats
+
+    @property
+    def dimension(self) -> Optional[int]:
+        """dimension of encoded vectors, None while it depends on the first vectors seen"""
+        return self.components.shape[1] if self.components is not None else None
+
+    def fit(self, vectors: np.ndarray) -> 'EmbeddingCodec':
+        """
+        learn the PCA projection and the int8 scales from the vectors about to be encoded
+
+        :param vectors: (N, D) float32 unit vectors
+        :return: self
+        """
+        if self.pca_dims is not None and self.pca_dims < vectors.shape[1]:
+            if len(vectors) < self.pca_dims:
+                logging.warning(f"only {len(vectors)} vectors, too few for a {self.pca_dims}-dim PCA, keeping {vectors.shape[1]} dims")
+            else:
+                # uncentred PCA: top eigenvectors of X^T X best preserve inner products between the vectors
+                gram = vectors.T.astype('float64') @ vectors.astype('float64')
+                eigenvalues, eigenvectors = np.linalg.eigh(gram)
+                self.components = np.ascontiguousarray(eigenvectors[:, ::-1][:, :self.pca_dims], dtype='float32')
+                kept = eigenvalues[::-1][:self.pca_dims].sum() / max(eigenvalues.sum(), 1e-12)
+                logging.info(f"PCA to {self.pca_dims} dims keeps {kept:.1%} of the energy")
+        if self.dtype == 'int8':
+            projected = self.project(vectors)
+            peak = np.abs(projected).max(axis=0) if len(projected) else np.ones(projected.shape[1], dtype='float32')
+            self.scale = (np.maximum(peak, 1e-6) / INT8_MAX).astype('float32')
+        return self
+
+    def project(self, vectors: np.ndarray) -> np.ndarray:
+        """apply the PCA projection and renormalize, identity without PCA"""
+        if self.components is None:
+            return vectors.astype('float32', copy=False)
+        return _normalize(vectors @ self.components).astype('float32')
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        :param vectors: (N, D) float32 unit vectors
+        :return: (N, dimension) codes in the storage dtype
+        """
+        projected = self.project(vectors)
+        if self.dtype == 'int8':
+            if self.scale is None:
+                self.scale = np.full(projected.shape[1], 1.0 / INT8_MAX, dtype='float32')  # unit vector components
+            return np.clip(np.rint(projected / self.scale), -INT8_MAX, INT8_MAX).astype('int8')
+        return projected.astype(self.dtype)
+
+    def prepare_queries(self, queries: np.ndarray) -> np.ndarray:
+        """
+        turn unit query vectors into the matrix that is multiplied with raw codes,
+        int8 scales are folded into the queries so stored codes never need decoding
+
+        :param queries: (M, D) float32 unit vectors
+        :return: (M, dimension) float32
+        """
+        projected = self.project(queries)
+        if self.dtype == 'int8':
+            return projected * self.scale
+        return projected
+
+    def bytes_per_vector(self, input_dimension: int) -> int:
+        dimension = self.dimension or input_dimension
+        return dimension * np.dtype(self.dtype).itemsize
+
+    def save(self, file):
+        """:param file: path or binary file object"""
+        arrays = {'dtype': np.array(self.dtype), 'pca_dims': np.array(-1 if self.pca_dims is None else self.pca_dims)}
+        if self.components is not None:
+            arrays['components'] = self.components
+        if self.scale is not None:
+            arrays['scale'] = self.scale
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> 'EmbeddingCodec':
+        with np.load(path) as arrays:
+            pca_dims = int(arrays['pca_dims'])
+            codec = cls(str(arrays['dtype']), None if pca_dims < 0 else pca_dims)
+            codec.components = arrays['components'] if 'components' in arrays else None
+            codec.scale = arrays['scale'] if 'scale' in arrays else None
+        return codec
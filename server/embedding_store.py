@@ -0,0 +1,304 @@
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from perceptual_hash import file_dhash, hash_to_hex
+
+# configuration
+EMBEDDING_STORE_FILE = 'user_embeddings.db'  # sqlite file holding one embedding per user image
+HASH_CHUNK_SIZE = 1 << 20  # read files in 1 MB chunks when hashing
+LOAD_CHUNK_ROWS = 8192  # embeddings per chunk when streaming the store
+LEGACY_MODEL_ID = 'resnet50'  # backbone of the entries stored before the model id was kept
+
+
+def file_sha256(path: str) -> str:
+    """
+    compute the SHA-256 of a file's content
+
+    :param path: file path
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingStore:
+    """on-disk store of image embeddings, one row per file keyed by filename plus size/mtime/content hash"""
+
+    def __init__(self, path: str = EMBEDDING_STORE_FILE, model_id: Optional[str] = None):
+        """
+        :param path: sqlite file
+        :param model_id: backbone whose embeddings are read and written, entries of other backbones are stale,
+            None opens the store read-only over every entry
+        """
+        self.path = path
+        self.model_id = model_id
+        self.lock = threading.Lock()  # sqlite connection is shared between threads
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                dhash TEXT,
+                model_id TEXT NOT NULL DEFAULT '{LEGACY_MODEL_ID}'
+            )
+        """)
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(embeddings)")}
+        if 'dhash' not in columns:  # stores created before the perceptual-hash prefilter
+            self.connection.execute("ALTER TABLE embeddings ADD COLUMN dhash TEXT")
+        if 'model_id' not in columns:  # stores created before the backbone was configurable
+            self.connection.execute(f"ALTER TABLE embeddings ADD COLUMN model_id TEXT NOT NULL DEFAULT '{LEGACY_MODEL_ID}'")
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _model_filter(self, *conditions: str) -> Tuple[str, tuple]:
+        """:return: WHERE clause restricted to the store's backbone and the given conditions, and the backbone parameter"""
+        params = ()
+        if self.model_id is not None:
+            conditions, params = ("model_id = ?", *conditions), (self.model_id,)
+        return (f" WHERE {' AND '.join(conditions)}" if conditions else ""), params
+
+    def fingerprints(self) -> Dict[str, Tuple[int, int, str, str]]:
+        """:return: filename -> (size, mtime_ns, sha256, model_id) for every stored entry"""
+        with self.lock:
+            rows = self.connection.execute("SELECT filename, size, mtime_ns, sha256, model_id FROM embeddings").fetchall()
+        return {filename: (size, mtime_ns, sha256, model_id) for filename, size, mtime_ns, sha256, model_id in rows}
+
+    def put_many(self, paths: List[str], vectors: np.ndarray, dhashes: Optional[List[Optional[str]]] = None):
+        """
+        insert or replace the embeddings of several files in one transaction
+
+        :param paths: image file paths, stored under their basenames
+        :param vectors: feature vectors aligned with paths
+        :param dhashes: dhash hex of each file if already known, computed from the files otherwise
+        """
+        if self.model_id is None:
+            raise ValueError("embedding store opened without a model id is read-only")
+        if dhashes is None:
+            dhashes = [self._dhash(path) for path in paths]
+        rows = []
+        for path, vector, value in zip(paths, vectors, dhashes):
+            stat = os.stat(path)
+            blob = np.ascontiguousarray(vector, dtype='float32').tobytes()
+            rows.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns, file_sha256(path), blob, value, self.model_id))
+        with self.lock:
+            self.connection.executemany("""
+                INSERT INTO embeddings (filename, size, mtime_ns, sha256, vector, dhash, model_id) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(filename) DO UPDATE SET
+                    size = excluded.size, mtime_ns = excluded.mtime_ns, sha256 = excluded.sha256,
+                    vector = excluded.vector, dhash = excluded.dhash, model_id = excluded.model_id
+            """, rows)
+            self.connection.commit()
+
+    @staticmethod
+    def _dhash(path: str) -> Optional[str]:
+        value = file_dhash(path)
+        return hash_to_hex(value) if value is not None else None
+
+    def dhashes(self, filenames: Optional[List[str]] = None) -> List[Tuple[str, str]]:
+        """
+        :param filenames: restrict to these filenames, all entries if None
+        :return: (filename, dhash hex) of the entries that have a perceptual hash
+        """
+        query = "SELECT filename, dhash FROM embeddings WHERE dhash IS NOT NULL"
+        with self.lock:
+            if filenames is None:
+                return self.connection.execute(query).fetchall()
+            return self.connection.execute(
+                f"{query} AND filename IN ({','.join('?' * len(filenames))})", filenames).fetchall()
+
+    def backfill_dhashes(self, image_paths: List[str]):
+        """hash the files of entries stored before perceptual hashes were kept, without re-embedding them"""
+        with self.lock:
+            missing = {filename for filename, in self.connection.execute("SELECT filename FROM embeddings WHERE dhash IS NULL")}
+        rows = [(self._dhash(path), os.path.basename(path)) for path in image_paths if os.path.basename(path) in missing]
+        if not rows:
+            return
+        with self.lock:
+            self.connection.executemany("UPDATE embeddings SET dhash = ? WHERE filename = ?", rows)
+            self.connection.commit()
+        logging.info(f"computed perceptual hashes of {len(rows)} stored images")
+
+    def delete(self, filenames: List[str]):
+        """drop the entries for the given filenames"""
+        with self.lock:
+            self.connection.executemany("DELETE FROM embeddings WHERE filename = ?", [(f,) for f in filenames])
+            self.connection.commit()
+
+    def touch(self, path: str):
+        """refresh size/mtime of an entry whose content hash did not change"""
+        stat = os.stat(path)
+        with self.lock:
+            self.connection.execute(
+                "UPDATE embeddings SET size = ?, mtime_ns = ? WHERE filename = ?",
+                (stat.st_size, stat.st_mtime_ns, os.path.basename(path))
+            )
+            self.connection.commit()
+
+    def ids_of(self, filenames: List[str]) -> Dict[str, int]:
+        """:return: filename -> row id for the stored filenames among the given ones"""
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT filename, id FROM embeddings WHERE filename IN ({','.join('?' * len(filenames))})",
+                filenames
+            ).fetchall()
+        return dict(rows)
+
+    def load(self) -> Tuple[np.ndarray, List[str], np.ndarray]:
+        """
+        load every stored embedding of the store's backbone
+
+        :return: row ids, filenames and the matching (N, D) float32 matrix
+        """
+        where, params = self._model_filter()
+        with self.lock:
+            rows = self.connection.execute(f"SELECT id, filename, vector FROM embeddings{where} ORDER BY id", params).fetchall()
+        if not rows:
+            return np.empty(0, dtype='int64'), [], np.empty((0, 0), dtype='float32')
+        ids = np.array([row_id for row_id, _, _ in rows], dtype='int64')
+        filenames = [filename for _, filename, _ in rows]
+        vectors = np.vstack([np.frombuffer(blob, dtype='float32') for _, _, blob in rows])
+        return ids, filenames, vectors
+
+    def load_many(self, filenames: List[str]) -> Tuple[np.ndarray, List[str], np.ndarray, List[Optional[str]]]:
+        """
+        load the embeddings of the given files, in chunks below sqlite's bound parameter limit
+
+        :param filenames: filenames to look up, those without an embedding of the store's backbone are left out
+        :return: row ids, filenames, the matching (n, D) float32 matrix and the dhash hex of each entry
+        """
+        rows = []
+        for i in range(0, len(filenames), LOAD_CHUNK_ROWS // 8):
+            chunk = filenames[i:i + LOAD_CHUNK_ROWS // 8]
+            where, params = self._model_filter(f"filename IN ({','.join('?' * len(chunk))})")
+            with self.lock:
+                rows += self.connection.execute(
+                    f"SELECT id, filename, vector, dhash FROM embeddings{where} ORDER BY id", (*params, *chunk)).fetchall()
+        if not rows:
+            return np.empty(0, dtype='int64'), [], np.empty((0, 0), dtype='float32'), []
+        return (np.array([row[0] for row in rows], dtype='int64'), [row[1] for row in rows],
+                np.vstack([np.frombuffer(row[2], dtype='float32') for row in rows]), [row[3] for row in rows])
+
+    def filenames(self) -> Set[str]:
+        """:return: filenames embedded by the store's backbone"""
+        where, params = self._model_filter()
+        with self.lock:
+            return {filename for filename, in self.connection.execute(f"SELECT filename FROM embeddings{where}", params)}
+
+    def vector_of(self, filename: str) -> Optional[np.ndarray]:
+        """:return: the stored embedding of one file, None if it has none from the store's backbone"""
+        where, params = self._model_filter("filename = ?")
+        with self.lock:
+            row = self.connection.execute(f"SELECT vector FROM embeddings{where}", (*params, filename)).fetchone()
+        return np.frombuffer(row[0], dtype='float32') if row else None
+
+    def iter_chunks(self, chunk_rows: int = LOAD_CHUNK_ROWS, after_id: int = 0) -> Iterator[Tuple[np.ndarray, List[str], np.ndarray]]:
+        """
+        stream the stored embeddings without holding all of them in memory
+
+        :param chunk_rows: entries per chunk
+        :param after_id: only entries with a larger row id, e.g. those added since an index was saved
+        :return: iterator of row ids, filenames and their (n, D) float32 matrix
+        """
+        where, params = self._model_filter("id > ?")
+        last_id = after_id
+        while True:
+            with self.lock:
+                rows = self.connection.execute(f"""
+                    SELECT id, filename, vector FROM embeddings{where} ORDER BY id LIMIT ?
+                """, (*params, last_id, chunk_rows)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield (np.array([row_id for row_id, _, _ in rows], dtype='int64'), [filename for _, filename, _ in rows],
+                   np.vstack([np.frombuffer(blob, dtype='float32') for _, _, blob in rows]))
+
+    def content_key(self) -> str:
+        """
+        :return: digest of the row ids and file hashes of the store's backbone, changes whenever an entry
+            is added, replaced or deleted, without reading the vectors
+        """
+        where, params = self._model_filter()
+        digest = hashlib.sha256(str(self.model_id).encode())
+        with self.lock:
+            for row_id, sha256 in self.connection.execute(f"SELECT id, sha256 FROM embeddings{where} ORDER BY id", params):
+                digest.update(f"{row_id}:{sha256};".encode())
+        return digest.hexdigest()
+
+    def filenames_by_id(self) -> Dict[int, str]:
+        """:return: row id -> filename of the entries embedded by the store's backbone"""
+        where, params = self._model_filter()
+        with self.lock:
+            return dict(self.connection.execute(f"SELECT id, filename FROM embeddings{where}", params).fetchall())
+
+    def stale_paths(self, image_paths: List[str], stats: Optional[Dict[str, Tuple[int, int]]] = None) -> Tuple[List[str], List[str]]:
+        """
+        compare files on disk with the stored entries
+
+        :param image_paths: current image file paths
+        :param stats: path -> (size, mtime_ns) already known from a directory listing, files missing here are stat'ed
+        :return: paths that need (re-)embedding and filenames whose files were deleted
+        """
+        stats = stats or {}
+        stored = self.fingerprints()
+        stale = []
+        for path in image_paths:
+            filename = os.path.basename(path)
+            entry = stored.get(filename)
+            if entry is None:
+                stale.append(path)
+                continue
+            size, mtime_ns, sha256, entry_model_id = entry
+            if self.model_id is not None and entry_model_id != self.model_id:
+                stale.append(path)  # embedded by another backbone
+                continue
+            if path in stats:
+                current_size, current_mtime_ns = stats[path]
+            else:
+                stat = os.stat(path)
+                current_size, current_mtime_ns = stat.st_size, stat.st_mtime_ns
+            if current_size == size and current_mtime_ns == mtime_ns:
+                continue  # unchanged, no need to read the file
+            if file_sha256(path) == sha256:
+                self.touch(path)  # only the mtime moved
+            else:
+                stale.append(path)
+        current = {os.path.basename(p) for p in image_paths}
+        deleted = [filename for filename in stored if filename not in current]
+        return stale, deleted
+
+    def sync(self, image_paths: List[str], extractor,
+             stats: Optional[Dict[str, Tuple[int, int]]] = None) -> Tuple[List[str], List[str]]:
+        """
+        embed only new or changed files and drop entries of deleted ones, the vectors are left in the store
+        for the caller to load once, whole with load() or streamed with iter_chunks()
+
+        :param image_paths: current image file paths
+        :param extractor: FeatureExtractor used for new or changed files
+        :param stats: path -> (size, mtime_ns) from the directory listing, see stale_paths
+        :return: paths that were (re-)embedded, or failed to decode, and filenames dropped as deleted
+        """
+        stale, deleted = self.stale_paths(image_paths, stats)
+        if deleted:
+            self.delete(deleted)
+            logging.info(f"dropped {len(deleted)} deleted images from embedding store")
+        logging.info(f"{len(image_paths) - len(stale)} cached embeddings, {len(stale)} images to embed")
+
+        for features, kept_paths in extractor.iter_features(stale):
+            self.put_many(kept_paths, features)  # images that failed to decode are simply not stored
+        self.backfill_dhashes(image_paths)
+        return stale, deleted
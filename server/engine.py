@@ -0,0 +1,519 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+import faiss
+from typing import Callable, Dict, List, Optional, Tuple
+
+from algorithm import (
+    FeatureExtractor, load_image_entries, load_image_paths, normalize_vectors,
+    USER_IMAGES_DIR, NEW_IMAGES_DIR, IMAGE_SIZE, DEVICE,
+)
+from embedding_store import EmbeddingStore, EMBEDDING_STORE_FILE
+from ann_index import INDEX_MODE, SIMILARITY_THRESHOLD, build_index, range_search, resolve_index_mode, supports_remove
+from crawl_index import CrawlIndex, CRAWL_INDEX_FILE
+from mapped_index import MAPPED_INDEX_DIR, MappedIndex
+from crawl_state import CrawlState
+from sharded_index import SHARDS, ShardedIndex
+from user_partitions import UserPartition
+from metrics import IMAGES, timed
+from perceptual_hash import HashIndex, file_dhash, hamming_to_similarity, hash_to_hex, hex_to_hash
+
+# configuration
+TOMBSTONE_REBUILD_RATIO = 0.1  # rebuild an index that cannot remove vectors once this share is masked out
+TWO_STAGE = True  # report perceptual-hash copies directly and run ResNet only on the remaining images
+PREFILTER_MAX_DISTANCE = 4  # dHash bits (of 64) up to which a crawled image is a clear copy of a user image
+CRAWL_EMBEDDING_STORE_FILE = 'crawl_embeddings.db'  # embeddings of crawled images, queried when a user uploads an image
+PARTITION_CACHE_SIZE = 256  # user partitions kept between scans, the least recently scanned are dropped
+
+
+class ScanEngine:
+    """process-level scan engine holding the warmed model and a live FAISS index over user images"""
+
+    def __init__(self, device: torch.device = DEVICE, store_path: str = EMBEDDING_STORE_FILE, index_mode: str = INDEX_MODE,
+                 two_stage: bool = TWO_STAGE, crawl_store_path: str = CRAWL_EMBEDDING_STORE_FILE,
+                 crawl_state: Optional[CrawlState] = None, crawl_index_path: str = CRAWL_INDEX_FILE, shards: int = SHARDS):
+        self.extractor = FeatureExtractor(device)
+        self.store = EmbeddingStore(store_path, self.extractor.model_id)
+        self.crawl_store = EmbeddingStore(crawl_store_path, self.extractor.model_id)
+        self.crawl_state = crawl_state if crawl_state is not None else CrawlState()
+        self.lock = threading.Lock()  # guards the index and the id maps
+        self.dimension: Optional[int] = None
+        self.configured_mode = index_mode
+        self.index_mode: Optional[str] = None
+        self.index: Optional[faiss.Index] = None
+        self.tombstones = 0  # removed vectors still inside an index that cannot drop them
+        self.filenames: Dict[int, str] = {}  # faiss id -> user filename
+        self.ids: Dict[str, int] = {}  # user filename -> faiss id
+        self.two_stage = two_stage
+        self.hash_index = HashIndex(PREFILTER_MAX_DISTANCE)  # first stage, dHash of every user image
+        self.crawl_hashes = HashIndex(PREFILTER_MAX_DISTANCE)  # dHash of every crawled image, for the reverse pass
+        self.unembedded: Dict[str, str] = {}  # crawled filename -> path of clear copies that skipped the feature extractor
+        self.backfill_lock = threading.Lock()  # one backfill at a time
+        self.stopping = threading.Event()  # set by close, ends a running backfill between batches
+        self.crawl_index: Optional[CrawlIndex] = None  # embeddings of every crawled image, for the reverse pass
+        self.crawl_index_path = crawl_index_path
+        self.shards = shards  # above 1 the user index is split over that many worker processes
+        self.partitions: Dict[int, UserPartition] = OrderedDict()  # Users.user_id -> that user's images, by last scan
+        self.owners: Dict[str, int] = {}  # user filename -> user_id, for the images held by a partition
+
+    def warm_up(self):
+        """run one dummy batch so the first real request does not pay for lazy initialisation"""
+        dummy = torch.zeros((1, 3, *IMAGE_SIZE), device=self.extractor.device)
+        output = self.extractor.infer(dummy)
+        self.dimension = output.shape[1]
+        logging.info(f"feature extractor warmed up, embedding dimension {self.dimension}")
+
+    def load(self, directory: str = USER_IMAGES_DIR):
+        """
+        sync the embedding store with the user images on disk and build the live index
+
+        :param directory: directory holding user images
+        """
+        if self.dimension is None:
+            self.warm_up()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        entries = load_image_entries(directory)
+        logging.info(f"found {len(entries)} user images")
+        stats = {entry.path: (entry.size, entry.mtime_ns) for entry in entries}  # spares a stat per image
+        self.store.sync([entry.path for entry in entries], self.extractor, stats)
+        self.rebuild()  # the only read of the whole store, straight into the index or into the shard workers
+        crawl_hashes = HashIndex(PREFILTER_MAX_DISTANCE)
+        embedded = self.crawl_store.filenames()
+        unembedded = {}
+        for filename, path, value, matched in self.crawl_state.downloaded():
+            if value:
+                crawl_hashes.add(hex_to_hash(value), filename)
+            if matched and filename not in embedded:  # unmatched ones are picked up by the next scan's catch-up
+                unembedded[filename] = path
+        for filename, value in self.crawl_store.dhashes():  # also covers files the crawler did not record
+            crawl_hashes.add(hex_to_hash(value), filename)
+        with self.lock:
+            self.crawl_hashes = crawl_hashes
+            self.unembedded = unembedded
+        crawl_index = CrawlIndex(self.crawl_store, self.dimension, self.crawl_index_path)
+        crawl_index.load()
+        self.crawl_index = crawl_index
+        logging.info(f"{len(self.crawl_store)} crawled images embedded, {len(crawl_hashes)} hashed, "
+                     f"{len(unembedded)} left to backfill")
+
+    def rebuild(self):
+        """build a fresh index over the embedding store, choosing the index type by corpus size"""
+        if self.shards > 1:
+            # the workers read their own partition from the store, the vectors never pass through this process
+            filenames_by_id = self.store.filenames_by_id()
+            ids, filenames = list(filenames_by_id), list(filenames_by_id.values())
+            mode = resolve_index_mode(self.configured_mode, len(ids) // self.shards)
+            if mode == 'mapped':
+                mode = 'flat'  # one mapped index directory cannot hold several partitions
+            index = ShardedIndex(self.shards, self.dimension, mode)
+            index.load(self.store.path, self.store.model_id)
+        elif self.configured_mode == 'mapped':
+            # every worker process maps the same files, only the first to find them stale reads the store
+            mode = 'mapped'
+            index = MappedIndex.open_or_build(MAPPED_INDEX_DIR, self.store.content_key(), self._load_store, self.dimension)
+            filenames_by_id = self.store.filenames_by_id()
+            ids, filenames = list(filenames_by_id), list(filenames_by_id.values())
+        else:
+            ids, filenames, vectors = self.store.load()
+            mode = resolve_index_mode(self.configured_mode, len(ids))
+            if len(ids):
+                vectors = normalize_vectors(vectors.astype('float32'))
+            index = build_index(vectors, ids, mode, self.dimension)
+            ids = ids.tolist()
+        hash_index = HashIndex(PREFILTER_MAX_DISTANCE)
+        for filename, value in self.store.dhashes():
+            hash_index.add(hex_to_hash(value), filename)
+        with self.lock:
+            previous = self.index
+            self.hash_index = hash_index
+            self.index = index
+            self.index_mode = mode
+            self.tombstones = 0
+            self.filenames = dict(zip(ids, filenames))
+            self.ids = {filename: i for i, filename in self.filenames.items()}
+        if isinstance(previous, ShardedIndex):
+            previous.close()
+        logging.info(f"{mode} faiss index created with {index.ntotal} user images, dimension {self.dimension}")
+
+    def _load_store(self) -> Tuple[np.ndarray, np.ndarray]:
+        """:return: every stored user embedding as unit vectors and their row ids"""
+        ids, _, vectors = self.store.load()
+        if not len(ids):
+            return np.empty((0, self.dimension), dtype='float32'), ids
+        return normalize_vectors(vectors.astype('float32')), ids
+
+    def close(self):
+        """stop a running backfill and the shard processes of a sharded user index"""
+        self.stopping.set()
+        with self.lock:
+            index, self.index = self.index, None
+        if isinstance(index, ShardedIndex):
+            index.close()
+
+    def _forget(self, filename: str) -> bool:
+        """drop a filename from the id maps and the index, caller holds the lock"""
+        image_id = self.ids.pop(filename, None)
+        if image_id is None:
+            return False
+        del self.filenames[image_id]
+        self.hash_index.remove(filename)
+        owner = self.owners.pop(filename, None)
+        if owner in self.partitions:
+            self.partitions[owner].remove([filename])
+        if supports_remove(self.index_mode):
+            self.index.remove_ids(np.array([image_id], dtype='int64'))
+        else:
+            self.tombstones += 1  # stays in the graph, search results for it are masked out
+        return True
+
+    def _needs_rebuild(self) -> bool:
+        return self.tombstones > TOMBSTONE_REBUILD_RATIO * max(1, self.index.ntotal)
+
+    def add_user_image(self, filename: str, directory: str = USER_IMAGES_DIR, user_id: Optional[int] = None) -> bool:
+        """
+        embed one uploaded user image and add it to the store and the live index
+
+        :param filename: name of the file inside the user images directory
+        :param directory: directory holding user images
+        :param user_id: owner of the image, its partition is updated in place if it was already built
+        :return: False if the image could not be decoded
+        """
+        path = os.path.join(directory, filename)
+        features, kept_paths = self.extractor.extract_features([path])
+        if not kept_paths:
+            return False
+        with self.lock:
+            replaced = self._forget(filename)  # re-upload under the same name
+        if replaced:
+            self.store.delete([filename])  # a fresh row id keeps masked ids from coming back
+        self.store.put_many([path], features)
+        image_id = self.store.ids_of([filename])[filename]
+        vectors = normalize_vectors(features.astype('float32'))
+        value = next((hex_to_hash(value) for _, value in self.store.dhashes([filename])), None)
+        with self.lock:
+            self.index.add_with_ids(vectors, np.array([image_id], dtype='int64'))
+            self.filenames[image_id] = filename
+            self.ids[filename] = image_id
+            if value is not None:
+                self.hash_index.add(value, filename)
+            if user_id in self.partitions:
+                self.partitions[user_id].add(np.array([image_id], dtype='int64'), [filename], vectors, [value])
+                self.owners[filename] = user_id
+            rebuild = self._needs_rebuild()
+        if rebuild:
+            self.rebuild()
+        logging.info(f"added {filename} to the user index")
+        return True
+
+    def remove_user_image(self, filename: str) -> bool:
+        """
+        drop a deleted user image from the store and the live index
+
+        :param filename: name of the removed file
+        :return: False if the image was not indexed
+        """
+        self.store.delete([filename])
+        with self.lock:
+            if not self._forget(filename):
+                return False
+            rebuild = self._needs_rebuild()
+        if rebuild:
+            self.rebuild()
+        logging.info(f"removed {filename} from the user index")
+        return True
+
+    def _lookup_filenames(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        map faiss ids to user filenames without a per-id python loop
+
+        :param ids: int64 ids returned by the index
+        :return: mask of ids that are still indexed and the filenames of those
+        """
+        with self.lock:
+            known_ids = np.fromiter(self.filenames.keys(), dtype='int64', count=len(self.filenames))
+            names = np.array(list(self.filenames.values()), dtype=object)
+        order = np.argsort(known_ids)
+        known_ids, names = known_ids[order], names[order]
+        positions = np.minimum(np.searchsorted(known_ids, ids), max(0, len(known_ids) - 1))
+        mask = (known_ids[positions] == ids) if len(known_ids) else np.zeros(len(ids), dtype=bool)
+        return mask, names[positions[mask]]
+
+    def scan(self, directory: str = NEW_IMAGES_DIR, threshold: float = SIMILARITY_THRESHOLD,
+             progress: Optional[Callable[..., None]] = None, two_stage: Optional[bool] = None,
+             incremental: bool = True) -> List[dict]:
+        """
+        embed the crawled images and query them against the live user index
+
+        :param directory: directory holding crawled images
+        :param threshold: minimum percentage similarity of a match
+        :param progress: optional callback, called as progress(embedded=n) and progress(matched=n)
+        :param two_stage: run the perceptual-hash prefilter first, defaults to the engine setting
+        :param incremental: skip images matched by an earlier scan, new user images reach those through reverse_scan
+        :return: list of matches with similarity of at least threshold
+        """
+        new_image_paths = load_image_paths(directory)
+        if incremental:
+            names = [os.path.basename(p) for p in new_image_paths]
+            done = self.crawl_state.matched_filenames(names) | (self.crawl_store.filenames() & set(names))
+            new_image_paths = [p for p, name in zip(new_image_paths, names) if name not in done]
+            logging.info(f"{len(done)} images matched by earlier scans")
+        logging.info(f"found {len(new_image_paths)} new images")
+        if self.index is None or self.index.ntotal == 0:
+            logging.error("no user images are indexed")
+            return []
+
+        prefilter_matches = []
+        hashes = [file_dhash(p) for p in new_image_paths]
+        self.add_crawled_hashes(new_image_paths, hashes)
+        if self.two_stage if two_stage is None else two_stage:
+            names = [os.path.basename(p) for p in new_image_paths]
+            prefilter_matches, ambiguous = self.prefilter(names, hashes, threshold)
+            self.crawl_state.mark_matched([name for name, keep in zip(names, ambiguous) if not keep])
+            self.defer_embedding([p for p, keep in zip(new_image_paths, ambiguous) if not keep])
+            new_image_paths = [p for p, keep in zip(new_image_paths, ambiguous) if keep]
+            hashes = [value for value, keep in zip(hashes, ambiguous) if keep]
+            logging.info(f"{len(names) - len(new_image_paths)} images matched by perceptual hash, {len(new_image_paths)} left for the feature extractor")
+
+        # extract features and match batch by batch, only one batch of vectors is held at a time
+        matches = prefilter_matches
+        embedded = 0
+        hash_of = dict(zip(new_image_paths, hashes))
+        for features, paths in self.extractor.iter_features(new_image_paths):
+            names = [os.path.basename(p) for p in paths]
+            matches += self.match_vectors(features, names, threshold)
+            self.add_crawled_embeddings(paths, features, [hash_of[p] for p in paths])
+            self.crawl_state.mark_matched(names)
+            embedded += len(paths)
+            if progress:
+                progress(embedded=embedded)
+        if new_image_paths and not embedded:
+            logging.error("no new images were processed successfully")
+        if progress:  # also when the prefilter resolved every image or none decoded
+            progress(matched=len(matches))
+        return matches
+
+    def add_crawled_hashes(self, paths: List[str], hashes: List[Optional[int]]):
+        """remember the dHash of crawled images so the reverse pass finds clear copies without their embeddings"""
+        with self.lock:
+            for path, value in zip(paths, hashes):
+                if value is not None:
+                    self.crawl_hashes.add(value, os.path.basename(path))
+
+    def defer_embedding(self, paths: List[str]):
+        """remember crawled images the prefilter matched as clear copies, they skip the feature extractor until backfill"""
+        with self.lock:
+            for path in paths:
+                self.unembedded[os.path.basename(path)] = path
+
+    def add_crawled_embeddings(self, paths: List[str], vectors: np.ndarray, hashes: Optional[List[Optional[int]]] = None):
+        """store the embeddings of crawled images and add them to the crawl index for the reverse pass"""
+        dhashes = [hash_to_hex(value) if value is not None else None for value in hashes] if hashes is not None else None
+        self.crawl_store.put_many(paths, vectors, dhashes)
+        names = [os.path.basename(p) for p in paths]
+        with self.lock:
+            for name in names:
+                self.unembedded.pop(name, None)
+        if self.crawl_index is not None:
+            ids = self.crawl_store.ids_of(names)
+            self.crawl_index.add(np.array([ids[name] for name in names], dtype='int64'), names, vectors)
+
+    def save_crawl_index(self):
+        """write the crawl index out, called when a scan finishes"""
+        if self.crawl_index is not None:
+            self.crawl_index.save()
+
+    def reverse_scan(self, filename: str, threshold: float = SIMILARITY_THRESHOLD) -> List[dict]:
+        """
+        reverse pass for a newly uploaded user image: query it against every crawled image seen so far,
+        so scans never have to revisit old crawled images
+
+        :param filename: user image already added with add_user_image
+        :param threshold: minimum percentage similarity of a match
+        :return: matches between crawled images and this user image
+        """
+        vector = self.store.vector_of(filename)
+        if vector is None:
+            logging.error(f"{filename} is not in the user index")
+            return []
+        matches = []
+        hits = set()
+        for _, value in self.store.dhashes([filename]):
+            with self.lock:
+                found = self.crawl_hashes.search(hex_to_hash(value))
+            for new_filename, distance in found:
+                score = hamming_to_similarity(distance)
+                if score >= threshold:
+                    hits.add(new_filename)
+                    matches.append({"new_filename": new_filename, "user_filename": filename, "similarity": score, "stage": "phash"})
+
+        # clear copies skipped by the feature extractor are not searched here, backfill matches them against this image
+        if self.crawl_index is None:
+            logging.error("the crawl index is not loaded")
+            return matches
+        for new_filename, score in self.crawl_index.search(vector, threshold):
+            if new_filename not in hits:
+                matches.append({"new_filename": new_filename, "user_filename": filename, "similarity": score, "stage": "resnet"})
+        logging.info(f"reverse pass found {len(matches)} crawled images matching {filename}")
+        return matches
+
+    def backfill(self, threshold: float = SIMILARITY_THRESHOLD, on_matches: Optional[Callable[[List[dict]], None]] = None) -> int:
+        """
+        embed the crawled images that skipped the feature extractor, off the request path: each batch goes into
+        the crawl index, then is matched against the user index, so uploads since their scan are covered
+        by one or the other; only one backfill runs at a time
+
+        :param threshold: minimum percentage similarity of a match
+        :param on_matches: optional callback receiving the matches of each batch, e.g. to store them
+        :return: number of images embedded, 0 if another backfill is running
+        """
+        if not self.backfill_lock.acquire(blocking=False):
+            return 0  # the running one also picks up images deferred since it started
+        embedded = 0
+        try:
+            while not self.stopping.is_set():
+                with self.lock:
+                    pending, self.unembedded = list(self.unembedded.values()), {}  # failed decodes are not retried
+                pending = [path for path in pending if os.path.exists(path)]
+                if not pending:
+                    break
+                for features, paths in self.extractor.iter_features(pending):
+                    self.add_crawled_embeddings(paths, features)
+                    embedded += len(paths)
+                    if self.index is not None and self.index.ntotal:
+                        matches = self.match_vectors(features, [os.path.basename(p) for p in paths], threshold)
+                        if on_matches and matches:
+                            on_matches(matches)
+                    if self.stopping.is_set():
+                        break
+        finally:
+            self.backfill_lock.release()
+        if embedded:
+            logging.info(f"backfill embedded {embedded} crawled images")
+        return embedded
+
+    def start_backfill(self, threshold: float = SIMILARITY_THRESHOLD,
+                       on_matches: Optional[Callable[[List[dict]], None]] = None) -> Optional[threading.Thread]:
+        """:return: the thread running backfill, None if nothing is deferred or a backfill is already running"""
+        with self.lock:
+            if not self.unembedded:
+                return None
+        if self.backfill_lock.locked():
+            return None
+        thread = threading.Thread(target=self.backfill, args=(threshold, on_matches), name='crawl-backfill', daemon=True)
+        thread.start()
+        return thread
+
+    def sync_partition(self, user_id: int, filenames: List[str]) -> UserPartition:
+        """
+        bring one user's partition in line with their rows of the Images table, loading only what changed
+
+        :param user_id: Users.user_id
+        :param filenames: filenames of the user's Images rows
+        :return: the partition, holding those of the files that are in the user index
+        """
+        wanted = set(filenames)
+        with self.lock:
+            partition = self.partitions.get(user_id)
+            if partition is None:
+                partition = self.partitions[user_id] = UserPartition(user_id, self.dimension)
+                self._evict_partitions()
+            self.partitions.move_to_end(user_id)
+            missing = sorted(wanted - partition.ids.keys())
+            gone = [filename for filename in partition.ids if filename not in wanted]
+        ids, names, vectors, dhashes = self.store.load_many(missing)
+        if len(ids):
+            vectors = normalize_vectors(vectors.astype('float32'))
+        with self.lock:
+            partition.remove(gone)
+            for filename in gone:
+                self.owners.pop(filename, None)
+            partition.add(ids, names, vectors, [hex_to_hash(value) if value else None for value in dhashes])
+            self.owners.update(dict.fromkeys(names, user_id))
+        logging.info(f"user {user_id} partition: {len(partition)} images, {len(names)} loaded, {len(gone)} dropped")
+        return partition
+
+    def _evict_partitions(self):
+        """drop the least recently scanned partitions beyond PARTITION_CACHE_SIZE, caller holds the lock"""
+        while len(self.partitions) > PARTITION_CACHE_SIZE:
+            _, partition = self.partitions.popitem(last=False)
+            for filename in partition.ids:
+                self.owners.pop(filename, None)
+
+    def scan_user(self, user_id: int, filenames: List[str], threshold: float = SIMILARITY_THRESHOLD) -> List[dict]:
+        """
+        check one user's images against every crawled image seen so far, without touching other users' images
+
+        :param user_id: Users.user_id
+        :param filenames: filenames of the user's Images rows
+        :param threshold: minimum percentage similarity of a match
+        :return: matches between crawled images and this user's images
+        """
+        partition = self.sync_partition(user_id, filenames)
+        with self.lock:
+            matches = partition.match_hashes(self.crawl_hashes, threshold)
+            user_filenames, vectors = partition.matrix()
+        pairs = {(match["new_filename"], match["user_filename"]) for match in matches}
+
+        # the crawl history is queried with the whole portfolio at once, clear copies not embedded yet are left to backfill
+        if self.crawl_index is None:
+            logging.error("the crawl index is not loaded")
+            return matches
+        for row, new_filename, score in self.crawl_index.search_batch(vectors, threshold):
+            if (new_filename, user_filenames[row]) not in pairs:
+                matches.append({"new_filename": new_filename, "user_filename": user_filenames[row], "similarity": score, "stage": "resnet"})
+        logging.info(f"user scan found {len(matches)} crawled images matching {len(partition)} images of user {user_id}")
+        return matches
+
+    def prefilter(self, new_filenames: List[str], hashes: List[Optional[int]],
+                  threshold: float = SIMILARITY_THRESHOLD) -> Tuple[List[dict], np.ndarray]:
+        """
+        first matching stage: crawled images whose dHash is within PREFILTER_MAX_DISTANCE of a user image are clear copies
+
+        :param new_filenames: crawled filenames
+        :param hashes: dHash of each crawled image, None where it could not be computed
+        :param threshold: minimum percentage similarity of a match, in agreeing hash bits
+        :return: matches of the copies and a mask of the images still needing the feature extractor
+        """
+        matches = []
+        ambiguous = np.ones(len(new_filenames), dtype=bool)
+        with timed('prefilter'):
+            for i, (new_filename, value) in enumerate(zip(new_filenames, hashes)):
+                if value is None:
+                    continue
+                hits = [(user_filename, hamming_to_similarity(distance)) for user_filename, distance in self.hash_index.search(value)]
+                hits = [(user_filename, score) for user_filename, score in hits if score >= threshold]
+                if hits:
+                    ambiguous[i] = False
+                    matches.extend(
+                        {"new_filename": new_filename, "user_filename": user_filename, "similarity": score, "stage": "phash"}
+                        for user_filename, score in hits
+                    )
+        IMAGES.inc(len(new_filenames) - int(ambiguous.sum()), stage='prefilter_copy')
+        return matches, ambiguous
+
+    def match_vectors(self, new_vectors: np.ndarray, new_filenames: List[str], threshold: float = SIMILARITY_THRESHOLD) -> List[dict]:
+        """
+        query already extracted crawled-image features against the live user index
+
+        :param new_vectors: (M, D) feature vectors of crawled images
+        :param new_filenames: crawled filenames aligned with new_vectors
+        :param threshold: minimum percentage similarity of a match
+        :return: list of matches with similarity of at least threshold
+        """
+        new_vectors = normalize_vectors(new_vectors.astype('float32'))  # normalize new vectors
+        new_filenames = np.array(new_filenames, dtype=object)
+
+        # every user image above the threshold, not just the top few neighbours
+        with self.lock, timed('search'):
+            query_rows, ids, similarity = range_search(self.index, new_vectors, threshold)
+        IMAGES.inc(len(new_vectors), stage='searched')
+        mask, user_filenames = self._lookup_filenames(ids)  # drops removed images still in an HNSW graph
+        new_names = new_filenames[query_rows[mask]]
+        return [
+            {"new_filename": new_filename, "user_filename": user_filename, "similarity": score, "stage": "resnet"}
+            for new_filename, user_filename, score in zip(new_names.tolist(), user_filenames.tolist(), similarity[mask].tolist())
+        ]
@@ -0,0 +1,160 @@
+import os
+import struct
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from PIL import Image
+
+# configuration
+MANIFEST_FILE = 'image_manifest.db'  # sqlite file caching the listing and header probe of every image directory
+HEADER_BYTES = 32  # enough for the magic number and the dimensions of PNG, GIF, BMP and WebP
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+Probe = Tuple[str, int, int]  # format, width, height
+
+
+class ManifestEntry(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    format: str
+    width: int
+    height: int
+
+
+def _jpeg_dimensions(f) -> Optional[Tuple[int, int]]:
+    """walk the JPEG markers up to the start-of-frame segment, skipping EXIF and other metadata segments"""
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        while marker[1] == 0xFF:  # fill bytes
+            fill = f.read(1)
+            if not fill:
+                return None
+            marker = marker[1:] + fill
+        if marker[1] in (0x01, *range(0xD0, 0xD8)):  # markers without a length
+            continue
+        length = f.read(2)
+        if len(length) < 2 or struct.unpack('>H', length)[0] < 2:
+            return None
+        if marker[1] in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+        f.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+
+
+def _webp_dimensions(header: bytes) -> Optional[Tuple[int, int]]:
+    chunk = header[12:16]
+    if chunk == b'VP8 ' and len(header) >= 30:
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(header) >= 25:
+        bits = struct.unpack('<I', header[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(header) >= 30:
+        return int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1
+    return None
+
+
+def probe(path: str) -> Optional[Probe]:
+    """
+    identify an image from its magic number and read its dimensions from the header, without decoding it
+
+    :param path: file path
+    :return: (PIL format name, width, height), None if the file is not an image or its header is truncated
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_BYTES)
+            dimensions, image_format = None, None
+            if header[:3] == b'\xff\xd8\xff':
+                image_format, dimensions = 'JPEG', _jpeg_dimensions(f)
+            elif header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR' and len(header) >= 24:
+                image_format, dimensions = 'PNG', struct.unpack('>II', header[16:24])
+            elif header[:6] in (b'GIF87a', b'GIF89a') and len(header) >= 10:
+                image_format, dimensions = 'GIF', struct.unpack('<HH', header[6:10])
+            elif header[:2] == b'BM' and len(header) >= 26:
+                width, height = struct.unpack('<ii', header[18:26])
+                image_format, dimensions = 'BMP', (width, abs(height))  # negative height: rows stored top-down
+            elif header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+                image_format, dimensions = 'WEBP', _webp_dimensions(header)
+    except (OSError, IndexError, struct.error):  # unreadable, or a header cut short
+        return None
+    if image_format is not None:
+        return (image_format, *dimensions) if dimensions else None
+    try:
+        with Image.open(path) as image:  # rarer formats: PIL only parses the header here too
+            return image.format, image.width, image.height
+    except Exception:  # PIL raises several types for files it cannot identify
+        return None
+
+
+class ImageManifest:
+    """on-disk listing of image directories: size, mtime, format and dimensions of every file, probed once"""
+
+    def __init__(self, path: str = MANIFEST_FILE):
+        self.path = path
+        self.lock = threading.Lock()  # sqlite connection is shared between threads
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                directory TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                format TEXT,
+                width INTEGER,
+                height INTEGER,
+                PRIMARY KEY (directory, filename)
+            )
+        """)  # format is NULL for files that are not images
+        self.connection.commit()
+
+    def scan(self, directory: str) -> List[ManifestEntry]:
+        """
+        list the images of a directory, probing only files that are new or changed since the last scan
+
+        :param directory: directory to list, subdirectories are not descended into
+        :return: image entries sorted by filename
+        """
+        key = os.path.realpath(directory)
+        with self.lock:
+            cached: Dict[str, tuple] = {
+                row[0]: row[1:] for row in self.connection.execute(
+                    "SELECT filename, size, mtime_ns, format, width, height FROM files WHERE directory = ?", (key,))
+            }
+        entries, changed, invalid = [], [], []
+        with os.scandir(directory) as listing:
+            for item in listing:
+                if not item.is_file():
+                    continue
+                stat = item.stat()
+                row = cached.pop(item.name, None)
+                if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+                    probed = probe(item.path)
+                    row = (stat.st_size, stat.st_mtime_ns, *(probed or (None, None, None)))
+                    changed.append((key, item.name, *row))
+                    if probed is None:
+                        invalid.append(item.name)
+                if row[2] is not None:
+                    entries.append(ManifestEntry(item.path, *row))
+        if changed or cached:
+            with self.lock:
+                self.connection.executemany("""
+                    INSERT OR REPLACE INTO files (directory, filename, size, mtime_ns, format, width, height)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, changed)
+                self.connection.executemany("DELETE FROM files WHERE directory = ? AND filename = ?",
+                                            [(key, filename) for filename in cached])  # gone from disk
+                self.connection.commit()
+        if invalid:  # reported when first seen, skipped silently on later scans
+            logging.warning(f"skipping {len(invalid)} files in {directory} that are not images: {', '.join(sorted(invalid)[:10])}")
+        logging.info(f"{directory}: {len(entries)} images, {len(changed)} new or changed files probed")
+        entries.sort(key=lambda entry: entry.path)
+        return entries
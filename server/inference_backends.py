@@ -0,0 +1,150 @@
+import os
+import copy
+import inspect
+import logging
+import torch
+from torch import nn
+from typing import Callable, Iterable, Optional
+
+# configuration
+INFERENCE_BACKEND = 'eager'  # 'eager', 'torchscript', 'compile', 'onnx' or 'int8'
+INFERENCE_BACKENDS = ('eager', 'torchscript', 'compile', 'onnx', 'int8')
+CHANNELS_LAST = True  # NHWC activations, faster convolutions on CPUs with oneDNN
+INTRA_OP_THREADS: Optional[int] = os.cpu_count()  # threads inside one operator, None leaves torch's default
+INTER_OP_THREADS: Optional[int] = 1  # operators run concurrently, a CNN is a chain so one is enough
+ONNX_MODEL_FILE = 'feature_extractor-{model_id}.onnx'  # exported once per backbone, reused by later processes
+PARITY_MIN_COSINE = 0.99  # a backend whose embeddings drift further from eager mode is not used
+CALIBRATION_BATCHES = 4  # batches run through the int8 observers
+
+Backend = Callable[[torch.Tensor], torch.Tensor]
+
+
+def configure_threads(intra_op: Optional[int] = INTRA_OP_THREADS, inter_op: Optional[int] = INTER_OP_THREADS):
+    """set torch's CPU thread pools, the inter-op pool can only be sized before its first use"""
+    if intra_op:
+        torch.set_num_threads(intra_op)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            pass  # already started, keep whatever it has
+    logging.info(f"torch threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+
+def cosine_parity(reference: torch.Tensor, candidate: torch.Tensor) -> float:
+    """:return: lowest cosine similarity between matching rows of two embedding batches"""
+    return float(nn.functional.cosine_similarity(reference.float(), candidate.float(), dim=1).min())
+
+
+def _eager(model: nn.Module, example: torch.Tensor, calibration, model_id: str) -> Backend:
+    def run(batch: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return model(batch)
+    return run
+
+
+def _torchscript(model: nn.Module, example: torch.Tensor, calibration, model_id: str) -> Backend:
+    with torch.inference_mode():
+        traced = torch.jit.optimize_for_inference(torch.jit.trace(model, example))  # folds batch norm into convolutions
+
+    def run(batch: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return traced(batch)
+    return run
+
+
+def _compile(model: nn.Module, example: torch.Tensor, calibration, model_id: str) -> Backend:
+    compiled = torch.compile(model, dynamic=True)  # batch sizes vary, the last batch of a scan is usually short
+
+    def run(batch: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return compiled(batch)
+    return run
+
+
+def _onnx(model: nn.Module, example: torch.Tensor, calibration, model_id: str) -> Backend:
+    import onnxruntime  # in requirements.txt with onnx, build_backend falls back to eager if it is missing
+    onnx_file = ONNX_MODEL_FILE.format(model_id=model_id)
+    if not os.path.exists(onnx_file):
+        # newer torch defaults to the dynamo exporter, the pinned torch 2.0 only has the TorchScript one
+        legacy = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+        torch.onnx.export(
+            model, example.contiguous(), onnx_file, input_names=['images'], output_names=['features'],
+            dynamic_axes={'images': {0: 'batch'}, 'features': {0: 'batch'}}, **legacy,
+        )
+        logging.info(f"exported feature extractor to {onnx_file}")
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if INTRA_OP_THREADS:
+        options.intra_op_num_threads = INTRA_OP_THREADS
+    if INTER_OP_THREADS:
+        options.inter_op_num_threads = INTER_OP_THREADS
+    session = onnxruntime.InferenceSession(onnx_file, options, providers=['CPUExecutionProvider'])
+
+    def run(batch: torch.Tensor) -> torch.Tensor:
+        features, = session.run(None, {'images': batch.contiguous().numpy()})
+        return torch.from_numpy(features)
+    return run
+
+
+def _int8(model: nn.Module, example: torch.Tensor, calibration, model_id: str) -> Backend:
+    """static post-training quantisation in FX graph mode, activations calibrated on representative images"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+    torch.backends.quantized.engine = engine
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping(engine), (example,))
+    with torch.inference_mode():
+        for batch in calibration or [example]:
+            prepared(batch)
+    quantized = convert_fx(prepared)
+
+    def run(batch: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return quantized(batch)
+    return run
+
+
+BUILDERS = {'eager': _eager, 'torchscript': _torchscript, 'compile': _compile, 'onnx': _onnx, 'int8': _int8}
+
+
+def build_backend(name: str, model: nn.Module, example: torch.Tensor, channels_last: bool = CHANNELS_LAST,
+                  calibration: Optional[Iterable[torch.Tensor]] = None, model_id: str = 'model') -> Backend:
+    """
+    wrap an eval-mode model in the requested CPU inference backend, checking its embeddings against eager mode
+
+    :param name: one of INFERENCE_BACKENDS
+    :param model: eager model on the target device
+    :param example: representative input batch, used for tracing, export and the parity check
+    :param channels_last: convert the model and every input batch to NHWC
+    :param calibration: input batches for int8 calibration, the example batch if None
+    :param model_id: backbone identifier, keys artefacts exported to disk
+    :return: callable mapping an image batch to embeddings, eager mode if the backend is unavailable or inaccurate
+    """
+    if name not in BUILDERS:
+        raise ValueError(f"unknown inference backend {name}, expected one of {INFERENCE_BACKENDS}")
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model = model.to(memory_format=memory_format)
+    example = example.to(memory_format=memory_format)
+    eager = _eager(model, example, calibration, model_id)
+    if name == 'eager':
+        backend = eager
+    else:
+        try:
+            backend = BUILDERS[name](model, example, calibration, model_id)
+            parity = cosine_parity(eager(example), backend(example))
+        except Exception as e:  # missing optional package, unsupported operator, no compiler, ...
+            logging.warning(f"{name} inference backend unavailable ({e}), using eager mode")
+            backend, name = eager, 'eager'
+        else:
+            if parity < PARITY_MIN_COSINE:
+                logging.error(f"{name} inference backend embeddings drift from eager mode (cosine {parity:.4f}), using eager mode")
+                backend, name = eager, 'eager'
+            else:
+                logging.info(f"{name} inference backend ready, cosine parity with eager mode {parity:.4f}")
+
+    def run(batch: torch.Tensor) -> torch.Tensor:
+        return backend(batch.to(memory_format=memory_format))
+    run.name = name
+    return run
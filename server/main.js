@@ -9,6 +9,7 @@ const Users = require('./models/users');
 const Images = require('./models/images');
 const Matches = require('./models/matches');
 
+const axios = require('axios'); // For notifying the scan server
 const multer = require('multer'); // For handling file uploads
 const path = require('path');
 const fs = require('fs');
@@ -20,6 +21,9 @@ const app = express();
 app.use(bodyParser.json());
 app.use(cors());
 app.use('/images', express.static(path.join(__dirname, 'images')));
+// Python scan server (server/main.py) that keeps the live image index
+const SCAN_SERVER_URL = 'http://localhost:8000';
+
 // Connect to PostgreSQL pool
 const pool = new Pool({
     user: 'postgres',
@@ -115,9 +119,19 @@ app.post('/images/users-images', upload.single('image'), async (req, res) => {
             filename: req.file.filename,
         });
 
+        // Index the new image and check it against every image crawled so far (the upload still succeeds if this fails)
+        let matches = [];
+        try {
+            const response = await axios.post(`${SCAN_SERVER_URL}/images/users-images/${encodeURIComponent(req.file.filename)}`);
+            matches = response.data.matches;
+        } catch (err) {
+            console.error('Error indexing image on scan server:', err.message);
+        }
+
         res.status(201).json({
             message: 'Image table succesfully updated',
             filename: req.file.filename,   // for front to display
+            matches,   // crawled images already matching the upload, stored in Matches by the scan server
         }); 
     } catch (error) {
         console.error('Error handling upload:', error);
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import logging
+import contextlib
+import numpy as np
+from typing import Callable, Iterator, Optional, Tuple
+
+from embedding_codec import EmbeddingCodec
+
+# configuration
+MAPPED_INDEX_DIR = 'user_index'  # directory holding the versions of the memory-mapped user index
+SCORE_CHUNK_ROWS = 8192  # stored vectors scored per matrix product, bounds the temporary float32 buffers
+
+CODES_FILE = 'codes.npy'
+IDS_FILE = 'ids.npy'
+CODEC_FILE = 'codec.npz'
+META_FILE = 'meta.json'
+CURRENT_FILE = 'CURRENT'  # name of the version directory readers open, swapped atomically by each build
+LOCK_FILE = '.lock'
+
+
+@contextlib.contextmanager
+def _locked(directory: str, exclusive: bool) -> Iterator[None]:
+    """hold a lock on the index directory, shared by readers, exclusive while a version is written"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def current_version(directory: str) -> Tuple[Optional[str], Optional[str]]:
+    """:return: path of the version directory CURRENT points to and the key it was built for, None if there is none"""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            version = os.path.join(directory, f.read().strip())
+        with open(os.path.join(version, META_FILE)) as f:
+            return version, json.load(f).get('key')
+    except FileNotFoundError:
+        return None, None
+
+
+class MappedIndex:
+    """
+    exact inner-product index over compact codes kept in memory-mapped .npy files, so every process opening
+    the same directory shares one copy through the page cache; exposes the faiss calls the scan engine uses
+
+    each build writes a new version directory and then repoints CURRENT at it, a version is never modified,
+    so readers map codes, ids and codec of one build even while the next one is written
+    """
+
+    def __init__(self, directory: str, codes: np.ndarray, ids: np.ndarray, codec: EmbeddingCodec):
+        self.directory = directory  # the version directory
+        self.codec = codec
+        self.codes = codes  # read-only memory map
+        self.ids = ids
+        self.alive = np.ones(len(ids), dtype=bool)  # False for ids removed since the files were written
+        self.tail_codes = np.empty((0, codes.shape[1]), dtype=codes.dtype)  # vectors added since, in memory
+        self.tail_ids = np.empty(0, dtype='int64')
+
+    @classmethod
+    def build(cls, directory: str, vectors: np.ndarray, ids: np.ndarray, codec: Optional[EmbeddingCodec] = None,
+              dimension: Optional[int] = None, key: Optional[str] = None) -> 'MappedIndex':
+        """
+        encode vectors into a new version of the index, open readers keep their mapping of the previous one
+
+        :param directory: index directory, created if missing
+        :param vectors: (N, D) float32 unit vectors
+        :param ids: int64 ids stored with the vectors
+        :param codec: format of the stored vectors, fitted on vectors, a default EmbeddingCodec if None
+        :param dimension: vector dimension, needed when vectors is empty
+        :param key: identifies the vectors, see open_or_build
+        :return: the index, opened from the new files
+        """
+        with _locked(directory, exclusive=True):
+            return cls._build(directory, vectors, ids, codec, dimension, key)
+
+    @classmethod
+    def _build(cls, directory: str, vectors: np.ndarray, ids: np.ndarray, codec: Optional[EmbeddingCodec],
+               dimension: Optional[int], key: Optional[str]) -> 'MappedIndex':
+        """write and publish a version, the caller holds the exclusive lock"""
+        codec = codec or EmbeddingCodec()
+        if not len(vectors):
+            vectors = np.empty((0, dimension or vectors.shape[1]), dtype='float32')
+        codec.fit(vectors)
+        codes = codec.encode(vectors)
+        name = f"v{time.time_ns()}-{os.getpid()}"
+        staging = os.path.join(directory, f".{name}.tmp")
+        os.makedirs(staging)
+        np.save(os.path.join(staging, CODES_FILE), codes)
+        np.save(os.path.join(staging, IDS_FILE), np.ascontiguousarray(ids, dtype='int64'))
+        codec.save(os.path.join(staging, CODEC_FILE))
+        with open(os.path.join(staging, META_FILE), 'w') as f:
+            json.dump({'key': key, 'count': len(codes), 'dtype': codec.dtype, 'dimension': int(codes.shape[1])}, f)
+        os.rename(staging, os.path.join(directory, name))
+        pointer = os.path.join(directory, f"{CURRENT_FILE}.{os.getpid()}.tmp")
+        with open(pointer, 'w') as f:
+            f.write(name)
+        os.replace(pointer, os.path.join(directory, CURRENT_FILE))  # readers see either the old or the new version
+        for entry in os.listdir(directory):
+            if entry.startswith('v') and entry != name:
+                shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)  # mapped files stay readable until unmapped
+        logging.info(f"wrote {len(codes)} {codec.dtype} codes of dimension {codes.shape[1]} to {directory}/{name}")
+        return cls._open(os.path.join(directory, name))
+
+    @classmethod
+    def open(cls, directory: str = MAPPED_INDEX_DIR) -> 'MappedIndex':
+        """map the current version written by build, e.g. from another worker process"""
+        with _locked(directory, exclusive=False):
+            version, _ = current_version(directory)
+            if version is None:
+                raise FileNotFoundError(f"no mapped index in {directory}")
+            return cls._open(version)
+
+    @classmethod
+    def _open(cls, version: str) -> 'MappedIndex':
+        codes = np.load(os.path.join(version, CODES_FILE), mmap_mode='r')
+        ids = np.load(os.path.join(version, IDS_FILE), mmap_mode='r')
+        return cls(version, codes, ids, EmbeddingCodec.load(os.path.join(version, CODEC_FILE)))
+
+    @classmethod
+    def open_or_build(cls, directory: str, key: str, load: Callable[[], Tuple[np.ndarray, np.ndarray]],
+                      dimension: int, codec: Optional[EmbeddingCodec] = None) -> 'MappedIndex':
+        """
+        map the current version if it was built from the same vectors, otherwise build it; of several processes
+        starting together one builds while the others wait on the lock and then map its files
+
+        :param key: identifies the vectors, e.g. EmbeddingStore.content_key
+        :param load: returns the (N, D) float32 unit vectors and their ids, only called when building
+        :param dimension: vector dimension, needed when there are no vectors
+        :param codec: format of the stored vectors, a default EmbeddingCodec if None
+        """
+        codec = codec or EmbeddingCodec()
+        key = f"{key}:{codec.dtype}:{codec.pca_dims}"
+        with _locked(directory, exclusive=True):
+            version, current_key = current_version(directory)
+            if version is not None and current_key == key:
+                logging.info(f"mapping the user index built in {version}")
+                return cls._open(version)
+            vectors, ids = load()
+            return cls._build(directory, vectors, ids, codec, dimension, key)
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.alive.sum()) + len(self.tail_ids)
+
+    @property
+    def d(self) -> int:
+        return self.codes.shape[1]
+
+    def add_with_ids(self, vectors: np.ndarray, ids: np.ndarray):
+        """keep new vectors in memory until the next build rewrites the files"""
+        self.tail_codes = np.vstack([self.tail_codes, self.codec.encode(vectors)])
+        self.tail_ids = np.concatenate([self.tail_ids, np.asarray(ids, dtype='int64')])
+
+    def remove_ids(self, ids: np.ndarray) -> int:
+        """mask out stored ids and drop added ones, :return: number of vectors removed"""
+        ids = np.asarray(ids, dtype='int64')
+        stored = self.alive & np.isin(self.ids, ids)
+        self.alive &= ~stored
+        added = np.isin(self.tail_ids, ids)
+        self.tail_codes, self.tail_ids = self.tail_codes[~added], self.tail_ids[~added]
+        return int(stored.sum() + added.sum())
+
+    def _scores(self, queries: np.ndarray):
+        """yield (ids, scores) for chunks of stored vectors, removed ones scoring -inf
+
+        :param queries: (M, dimension) output of codec.prepare_queries
+        """
+        for start in range(0, len(self.ids), SCORE_CHUNK_ROWS):
+            alive = self.alive[start:start + SCORE_CHUNK_ROWS]
+            if not alive.any():
+                continue
+            chunk = np.asarray(self.codes[start:start + SCORE_CHUNK_ROWS], dtype='float32')
+            scores = queries @ chunk.T
+            scores[:, ~alive] = -np.inf
+            yield np.asarray(self.ids[start:start + SCORE_CHUNK_ROWS]), scores
+        if len(self.tail_ids):
+            yield self.tail_ids, queries @ self.tail_codes.astype('float32').T
+
+    def range_search(self, queries: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        every stored vector with an inner product above radius, in faiss layout
+
+        :param queries: (M, D) float32 unit vectors, in the original embedding space
+        :param radius: inner-product cut-off
+        :return: lims (M + 1), inner products and ids, results of query i at lims[i]:lims[i + 1]
+        """
+        rows, distances, found = [], [], []
+        for ids, scores in self._scores(self.codec.prepare_queries(queries)):
+            query_rows, cols = np.nonzero(scores > radius)
+            rows.append(query_rows)
+            distances.append(scores[query_rows, cols])
+            found.append(ids[cols])
+        if not rows:
+            return np.zeros(len(queries) + 1, dtype='int64'), np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+        rows, distances, found = np.concatenate(rows), np.concatenate(distances), np.concatenate(found)
+        order = np.argsort(rows, kind='stable')
+        lims = np.searchsorted(rows[order], np.arange(len(queries) + 1)).astype('int64')
+        return lims, distances[order].astype('float32'), found[order].astype('int64')
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        top-k inner products per query, in faiss layout
+
+        :return: (M, k) inner products and ids, padded with -inf and -1
+        """
+        best_scores = np.full((len(queries), k), -np.inf, dtype='float32')
+        best_ids = np.full((len(queries), k), -1, dtype='int64')
+        for ids, scores in self._scores(self.codec.prepare_queries(queries)):
+            scores = np.hstack([best_scores, scores])  # merge the running top-k with this chunk
+            candidates = np.hstack([best_ids, np.broadcast_to(ids, (len(queries), len(ids)))])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_ids = np.take_along_axis(candidates, top, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best_scores, best_ids = np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+        best_ids[~np.isfinite(best_scores)] = -1
+        return best_scores, best_ids
+
+    def memory_bytes(self) -> int:
+        """size of the codes and ids, shared between processes mapping the same files"""
+        return self.codes.nbytes + self.ids.nbytes + self.tail_codes.nbytes + self.tail_ids.nbytes
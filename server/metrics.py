@@ -0,0 +1,214 @@
+import io
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# configuration
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)  # seconds
+PROFILE_KINDS = ('cprofile', 'torch')
+PROFILE_TOP = 40  # functions or operators listed in a profile report
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'  # Prometheus text exposition format
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """one named metric with a fixed set of label names, thread-safe"""
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return '\n'.join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) -> Dict[Tuple[str, ...], float]:
+        """:return: label values -> current count"""
+        with self.lock:
+            return dict(self.values)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    """cumulative buckets plus sum and count, like prometheus_client's Histogram"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1  # per-bucket counts, accumulated when rendered
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """observe the wall time of the block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Tuple[List[int], float]]:
+        """:return: label values -> (per-bucket counts, the last one above every bound, and the sum of observations)"""
+        with self.lock:
+            return {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+
+    def quantile(self, q: float, counts: List[int]) -> Optional[float]:
+        """
+        estimate a quantile from bucket counts, interpolating linearly inside the bucket like histogram_quantile
+
+        :param q: quantile in [0, 1]
+        :param counts: per-bucket counts from snapshot, or the difference of two snapshots
+        :return: estimated value, the largest finite bound if it falls in the last bucket, None without observations
+        """
+        total = sum(counts)
+        if not total:
+            return None
+        rank, cumulative = q * total, 0
+        for i, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """:return: every metric in the Prometheus text format, served on /metrics"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+# the scan pipeline, from the Wikimedia API to the Matches table
+STAGE_SECONDS = Histogram(
+    'arttrack_stage_seconds',
+    'wall time per pipeline stage and call: api, download, download_decode, compression, load, inference, '
+    'prefilter, search, db_write, scan, user_scan',
+    ['stage'],
+)
+IMAGES = Counter('arttrack_images_total', 'images through each pipeline stage, rate() gives images per second', ['stage'])
+DOWNLOADED_BYTES = Counter('arttrack_downloaded_bytes_total', 'bytes received from Wikimedia', ['kind'])
+QUEUE_DEPTH = Gauge('arttrack_queue_depth', 'items waiting in a pipeline queue', ['queue'])
+
+
+def timed(stage: str):
+    """:return: context manager adding the wall time of its block to the stage histogram"""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+@contextlib.contextmanager
+def profile(kind: Optional[str], limit: int = PROFILE_TOP) -> Iterator[dict]:
+    """
+    profile a block with cProfile (python functions of the calling thread) or the torch profiler (operators)
+
+    :param kind: one of PROFILE_KINDS, None runs the block unprofiled
+    :param limit: rows in the report
+    :return: dict that holds the text report under 'profile' once the block has finished
+    """
+    result = {}
+    if kind is None:
+        yield result
+    elif kind == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield result
+        finally:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+            result['profile'] = out.getvalue()
+    elif kind == 'torch':
+        from torch.profiler import ProfilerActivity, profile as torch_profile
+        with torch_profile(activities=[ProfilerActivity.CPU]) as profiler:
+            yield result
+        result['profile'] = profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=limit)
+    else:
+        raise ValueError(f"unknown profile kind {kind}, expected one of {PROFILE_KINDS}")
@@ -14,6 +14,9 @@ const Images = sequelize.define('Images', {
   },
 },   {
   timestamps: false, // Disable createdAt and updatedAt
+  indexes: [
+    { name: 'Images_filename_idx', fields: ['filename'] }, // scans resolve matches by filename
+  ],
 });
 
 Images.belongsTo(Users, {
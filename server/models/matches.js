@@ -22,8 +22,16 @@ const Matches = sequelize.define('Matches', {
     type: DataTypes.STRING,
     allowNull: false,
   },
+  stage: {
+    type: DataTypes.STRING(16),  // Matching stage that found the pair: 'phash' (perceptual hash) or 'resnet'
+    allowNull: true,
+  },
 },  {
     timestamps: false, // Disable createdAt and updatedAt
+    indexes: [
+      // One row per scraped/user image pair, the scan server inserts with ON CONFLICT DO NOTHING
+      { name: 'Matches_pair_idx', unique: true, fields: ['new_image_filename', 'matched_image_filename'] },
+    ],
   });
 
 // Associations
@@ -0,0 +1,151 @@
+import threading
+import numpy as np
+from collections import defaultdict
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+from PIL import Image
+
+# configuration
+HASH_SIZE = 8  # dHash grid, HASH_SIZE ** 2 bits per hash
+HASH_BITS = HASH_SIZE ** 2
+DHASH_MAX_DISTANCE = 4  # hamming distance up to which two images count as near-duplicates
+DRAFT_SIZE = (64, 64)  # JPEG files are decoded at reduced scale when hashed from disk
+
+
+def dhash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """
+    difference hash: sign of the horizontal gradient on a tiny grayscale thumbnail,
+    robust to rescaling and recompression
+
+    :param image: decoded image
+    :param hash_size: rows and columns of the gradient grid
+    :return: hash_size ** 2 bit integer
+    """
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype='int16')
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def file_dhash(path: str) -> Optional[int]:
+    """
+    dHash of an image file, decoding JPEGs in draft mode since only a tiny thumbnail is needed
+
+    :param path: image file path
+    :return: hash, None if the file cannot be decoded
+    """
+    try:
+        with Image.open(path) as image:
+            image.draft('L', DRAFT_SIZE)
+            return dhash(image)
+    except Exception:
+        return None
+
+
+def is_degenerate(value: int, bits: int = HASH_BITS) -> bool:
+    """
+    :return: True for the hash of a uniform image (0) or of a plain left-to-right gradient (all ones), which any other
+        blank or gradient image shares, so it says nothing about the content
+    """
+    return value == 0 or value == (1 << bits) - 1
+
+
+def hash_to_hex(value: int) -> str:
+    return format(value, '016x')
+
+
+def hex_to_hash(value: str) -> int:
+    return int(value, 16)
+
+
+def hamming(a: int, b: int) -> int:
+    """:return: number of differing bits between two hashes"""
+    return bin(a ^ b).count('1')
+
+
+def hamming_to_similarity(distance: int, bits: int = HASH_BITS) -> float:
+    """:return: percentage of agreeing hash bits, comparable to the cosine similarity percentages of the ResNet stage"""
+    return 100.0 * (1 - distance / bits)
+
+
+class HashIndex:
+    """
+    multi-index hashing over 64-bit perceptual hashes: two hashes within r bits of each other agree exactly
+    on at least one of r + 1 disjoint bit chunks, so only hashes sharing a chunk with the query are compared
+
+    degenerate hashes (see is_degenerate) are neither indexed nor searched, those images are left to the ResNet stage
+    """
+
+    def __init__(self, max_distance: int = DHASH_MAX_DISTANCE, bits: int = HASH_BITS):
+        """
+        :param max_distance: largest search radius served from the chunk tables, wider searches compare every hash
+        :param bits: hash length
+        """
+        self.max_distance = max_distance
+        self.bits = bits
+        bounds = np.linspace(0, bits, max_distance + 2).astype(int)
+        self.chunks = [(int(start), (1 << int(end - start)) - 1) for start, end in zip(bounds[:-1], bounds[1:])]  # (shift, mask)
+        self.tables: List[Dict[int, Set[Hashable]]] = [defaultdict(set) for _ in self.chunks]
+        self.values: Dict[Hashable, int] = {}
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def _parts(self, value: int) -> List[int]:
+        return [(value >> shift) & mask for shift, mask in self.chunks]
+
+    def add(self, value: int, key: Hashable):
+        """
+        :param value: 64-bit hash
+        :param key: returned by searches, e.g. an image title or filename, adding a key again replaces its hash
+        """
+        with self.lock:
+            self._remove(key)
+            if is_degenerate(value, self.bits):
+                return
+            self.values[key] = value
+            for table, part in zip(self.tables, self._parts(value)):
+                table[part].add(key)
+
+    def remove(self, key: Hashable) -> bool:
+        """:return: False if the key was not indexed"""
+        with self.lock:
+            return self._remove(key)
+
+    def _remove(self, key: Hashable) -> bool:
+        value = self.values.pop(key, None)
+        if value is None:
+            return False
+        for table, part in zip(self.tables, self._parts(value)):
+            bucket = table[part]
+            bucket.discard(key)
+            if not bucket:
+                del table[part]
+        return True
+
+    def search(self, value: int, max_distance: Optional[int] = None) -> List[Tuple[Hashable, int]]:
+        """
+        :param value: 64-bit hash
+        :param max_distance: search radius, defaults to the radius the index was built for
+        :return: (key, distance) of every stored hash within max_distance, closest first, none for a degenerate hash
+        """
+        max_distance = self.max_distance if max_distance is None else max_distance
+        if is_degenerate(value, self.bits):
+            return []
+        with self.lock:
+            if max_distance > self.max_distance:
+                candidates = set(self.values)  # the pigeonhole guarantee no longer holds
+            else:
+                candidates = set()
+                for table, part in zip(self.tables, self._parts(value)):
+                    candidates.update(table.get(part, ()))
+            hits = [(key, hamming(value, self.values[key])) for key in candidates]
+        return sorted((hit for hit in hits if hit[1] <= max_distance), key=lambda hit: (hit[1], str(hit[0])))
+
+    def nearest(self, value: int, max_distance: Optional[int] = None) -> Optional[Tuple[Hashable, int]]:
+        """
+        :param value: 64-bit hash
+        :param max_distance: largest hamming distance that counts as a hit
+        :return: (key, distance) of the closest stored hash, None if none is within max_distance
+        """
+        hits = self.search(value, max_distance)
+        return hits[0] if hits else None
@@ -0,0 +1,94 @@
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from typing import Callable, Dict, Optional
+
+from metrics import QUEUE_DEPTH
+
+# configuration
+JOB_HISTORY = 50  # finished jobs kept around for polling
+
+
+@dataclass
+class ScanJob:
+    """state of one background scan, polled by clients"""
+    job_id: str
+    params: dict
+    status: str = 'queued'  # queued, running, done or failed
+    progress: Dict[str, int] = field(default_factory=lambda: {'downloaded': 0, 'embedded': 0, 'matched': 0})
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    def update(self, **counts: int):
+        """update progress counters, e.g. job.update(downloaded=3)"""
+        self.progress.update(counts)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class ScanJobManager:
+    """runs scans one at a time on a background thread so requests return immediately"""
+
+    def __init__(self, run_scan: Callable[[ScanJob], dict]):
+        """
+        :param run_scan: does the actual scan for a job, reports progress through job.update and returns the result
+        """
+        self.run_scan = run_scan
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scan')  # scans queue behind each other
+        self.lock = threading.Lock()
+        self.jobs: Dict[str, ScanJob] = OrderedDict()
+
+    def submit(self, **params) -> ScanJob:
+        """
+        queue a scan, a request identical to one that is still waiting shares that job instead
+
+        :param params: scan parameters passed on to run_scan through job.params
+        :return: the queued job
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                if job.status == 'queued' and job.params == params:
+                    return job
+            job = ScanJob(job_id=uuid.uuid4().hex, params=params)
+            self.jobs[job.job_id] = job
+            self._forget_old_jobs()
+            self._report_depth()
+        self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[ScanJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _run(self, job: ScanJob):
+        with self.lock:
+            job.status = 'running'
+            self._report_depth()
+        job.started_at = time.time()
+        try:
+            job.result = self.run_scan(job)
+            job.status = 'done'
+        except Exception as e:
+            logging.exception(f"scan job {job.job_id} failed")
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+
+    def _report_depth(self):
+        """publish how many scans wait behind the running one, caller holds the lock"""
+        QUEUE_DEPTH.set(sum(job.status == 'queued' for job in self.jobs.values()), queue='scan_jobs')
+
+    def _forget_old_jobs(self):
+        """drop the oldest finished jobs beyond JOB_HISTORY, caller holds the lock"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del self.jobs[job_id]
@@ -0,0 +1,173 @@
+import os
+import logging
+import threading
+import multiprocessing
+import numpy as np
+import faiss
+from typing import List, Optional, Tuple
+
+from ann_index import build_index, index_range_search, resolve_index_mode
+from embedding_store import EmbeddingStore
+
+# configuration
+SHARDS = 1  # worker processes each holding one partition of the user index, 1 keeps the index in the scan process
+START_METHOD = 'spawn'  # forking a process that already runs torch and OpenMP threads can deadlock the children
+
+
+def shard_of(ids: np.ndarray, num_shards: int) -> np.ndarray:
+    """partition by store row id, consecutive ids are dealt round robin so the shards stay the same size"""
+    return ids % num_shards
+
+
+def _serve(connection, shard: int, num_shards: int, dimension: int, mode: str):
+    """
+    worker process: hold the index over one partition and answer the coordinator's requests until it closes
+
+    requests are (command, *args) tuples, every request gets one ('ok', result) or ('error', message) reply
+    """
+    faiss.omp_set_num_threads(max(1, (os.cpu_count() or 1) // num_shards))  # the shards share the cores
+    # flat placeholder until 'load', trained modes cannot be built without training points
+    index = build_index(np.empty((0, dimension), dtype='float32'), np.empty(0, dtype='int64'), 'flat', dimension)
+    while True:
+        try:
+            command, *args = connection.recv()
+        except EOFError:
+            return  # coordinator is gone
+        if command == 'close':
+            connection.close()
+            return
+        try:
+            if command == 'load':
+                store_path, model_id = args
+                ids, vectors = [], []
+                for chunk_ids, _, chunk_vectors in EmbeddingStore(store_path, model_id).iter_chunks():
+                    mine = shard_of(chunk_ids, num_shards) == shard
+                    ids.append(chunk_ids[mine])
+                    vectors.append(chunk_vectors[mine])
+                ids = np.concatenate(ids) if ids else np.empty(0, dtype='int64')
+                vectors = np.vstack(vectors) if vectors else np.empty((0, dimension), dtype='float32')
+                if len(ids):  # normalized here, algorithm.normalize_vectors would pull torch into every worker
+                    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+                    vectors = (vectors / np.maximum(norms, 1e-12)).astype('float32')
+                # trained modes learn their partition only, flat if it is too small to train them
+                index = build_index(vectors, ids, resolve_index_mode(mode, len(ids)), dimension)
+                result = index.ntotal
+            elif command == 'add':
+                index.add_with_ids(*args)
+                result = index.ntotal
+            elif command == 'remove':
+                index.remove_ids(*args)
+                result = index.ntotal
+            elif command == 'range_search':
+                result = index_range_search(index, *args)
+            elif command == 'search':
+                result = index.search(*args)
+            else:
+                raise ValueError(f"unknown shard command {command}")
+        except Exception as e:
+            connection.send(('error', f"{type(e).__name__}: {e}"))
+        else:
+            connection.send(('ok', result))
+
+
+class ShardedIndex:
+    """
+    user index partitioned over worker processes, each with its own faiss index: queries fan out to every
+    shard and the results are merged back, so it can stand in for the faiss index of the scan engine
+    """
+
+    def __init__(self, num_shards: int, dimension: int, mode: str):
+        """
+        :param num_shards: worker processes to start
+        :param dimension: embedding dimension
+        :param mode: index mode of every shard, resolved for the partition size, see ann_index.resolve_index_mode
+        """
+        self.num_shards = num_shards
+        self.d = dimension
+        self.mode = mode
+        self.lock = threading.Lock()  # one request in flight per pipe
+        self.counts = [0] * num_shards  # vectors held by each shard
+        context = multiprocessing.get_context(START_METHOD)
+        self.connections = []
+        self.processes = []
+        for shard in range(num_shards):
+            parent, child = context.Pipe()
+            process = context.Process(target=_serve, args=(child, shard, num_shards, dimension, mode),
+                                      name=f'index-shard-{shard}', daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    @property
+    def ntotal(self) -> int:
+        return sum(self.counts)
+
+    def _request(self, requests: List[Optional[tuple]]) -> list:
+        """send one request per shard (None skips it), then collect the replies, the shards work in parallel"""
+        with self.lock:
+            for connection, request in zip(self.connections, requests):
+                if request is not None:
+                    connection.send(request)
+            replies = [connection.recv() if request is not None else None
+                       for connection, request in zip(self.connections, requests)]
+        errors = [reply[1] for reply in replies if reply is not None and reply[0] == 'error']
+        if errors:
+            raise RuntimeError(f"index shard failed: {errors[0]}")  # same type faiss raises in process
+        return [reply[1] if reply is not None else None for reply in replies]
+
+    def _update_counts(self, results: list):
+        for shard, count in enumerate(results):
+            if count is not None:
+                self.counts[shard] = count
+
+    def load(self, store_path: str, model_id: str):
+        """let every shard build its index from its partition of an embedding store, read in the worker itself"""
+        self._update_counts(self._request([('load', store_path, model_id)] * self.num_shards))
+        logging.info(f"{self.mode} index sharded over {self.num_shards} processes, {self.counts} user images")
+
+    def _route(self, command: str, ids: np.ndarray, *arrays: np.ndarray):
+        shards = shard_of(ids, self.num_shards)
+        requests = []
+        for shard in range(self.num_shards):
+            mine = shards == shard
+            requests.append((command, *(array[mine] for array in arrays), ids[mine]) if mine.any() else None)
+        self._update_counts(self._request(requests))
+
+    def add_with_ids(self, vectors: np.ndarray, ids: np.ndarray):
+        self._route('add', ids, vectors)
+
+    def remove_ids(self, ids: np.ndarray):
+        self._route('remove', ids)
+
+    def range_search(self, queries: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """faiss range_search over all shards: lims, inner products and ids, grouped by query"""
+        results = self._request([('range_search', queries, radius)] * self.num_shards)
+        rows = np.concatenate([np.repeat(np.arange(len(queries)), np.diff(lims).astype('int64')) for lims, _, _ in results])
+        distances = np.concatenate([distances for _, distances, _ in results])
+        ids = np.concatenate([ids for _, _, ids in results])
+        order = np.argsort(rows, kind='stable')
+        lims = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(queries)))])
+        return lims, distances[order], ids[order]
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """faiss top-k search over all shards: the k best of the shards' k best for each query"""
+        results = self._request([('search', queries, k)] * self.num_shards)
+        distances = np.hstack([distances for distances, _ in results])
+        ids = np.hstack([ids for _, ids in results])
+        best = np.argsort(-distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, best, axis=1), np.take_along_axis(ids, best, axis=1)
+
+    def close(self):
+        """stop the worker processes"""
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.send(('close',))
+                except (BrokenPipeError, OSError):
+                    pass  # already gone
+            for process in self.processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+            self.connections, self.processes = [], []
@@ -0,0 +1,162 @@
+import os
+import time
+import queue
+import logging
+import threading
+from typing import Callable, List, Optional
+from PIL import Image
+
+from ann_index import SIMILARITY_THRESHOLD
+from perceptual_hash import dhash, hex_to_hash
+from metrics import QUEUE_DEPTH
+
+# configuration
+QUEUE_SIZE = 64  # decoded images waiting for the extractor, download threads block when it is full
+MICRO_BATCH_SIZE = 8  # images embedded and queried together
+MICRO_BATCH_TIMEOUT = 0.5  # seconds to wait for a micro-batch to fill before running a partial one
+
+_DONE = object()  # queue sentinel pushed once the crawl has finished
+
+
+class StreamingScan:
+    """overlaps crawling with inference: decoded downloads go through a bounded queue straight into the extractor and the index"""
+
+    def __init__(self, engine, downloader, threshold: float = SIMILARITY_THRESHOLD,
+                 progress: Optional[Callable[..., None]] = None,
+                 on_matches: Optional[Callable[[List[dict]], None]] = None,
+                 queue_size: int = QUEUE_SIZE, micro_batch_size: int = MICRO_BATCH_SIZE):
+        """
+        :param engine: ScanEngine holding the extractor and the user index
+        :param downloader: WikimediaImageDownloader, its on_image hook is taken over by the scan
+        :param threshold: minimum percentage similarity of a match
+        :param progress: optional callback, called as progress(embedded=n) and progress(matched=n)
+        :param on_matches: optional callback receiving matches as soon as each micro-batch is queried
+        """
+        self.engine = engine
+        self.downloader = downloader
+        self.threshold = threshold
+        self.progress = progress
+        self.on_matches = on_matches
+        self.micro_batch_size = micro_batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.downloader.on_image = self._push
+        self.crawl_error: Optional[BaseException] = None
+        self.cancelled = False  # set when matching fails, so download threads stop feeding the queue
+        self.time_to_first_match: Optional[float] = None
+
+    def _push(self, metadata, image: Image.Image):
+        """producer side, runs on the download threads"""
+        if self.cancelled:
+            return
+        image.load()  # make sure decoding happened on the download thread
+        value = hex_to_hash(metadata.dhash) if metadata.dhash else dhash(image)  # the dedup stage usually computed it
+        self.queue.put((metadata.local_path, image, value))
+        QUEUE_DEPTH.set(self.queue.qsize(), queue='streaming_scan')
+
+    def _catch_up(self):
+        """queue images downloaded by an earlier scan that stopped before matching them"""
+        leftovers = [(path, value) for path, value in self.downloader.state.unmatched() if os.path.exists(path)]
+        if leftovers:
+            logging.info(f"matching {len(leftovers)} images left over by an interrupted scan")
+        for path, value in leftovers:
+            if self.cancelled:
+                return
+            try:
+                image = Image.open(path)
+                image.load()
+            except Exception as e:
+                logging.error(f"error processing image {path}: {e}")
+                continue
+            self.queue.put((path, image, hex_to_hash(value) if value else dhash(image)))
+
+    def _crawl(self):
+        try:
+            self._catch_up()
+            self.downloader.run()
+        except BaseException as e:
+            self.crawl_error = e
+        finally:
+            self.queue.put(_DONE)
+
+    def _next_batch(self) -> tuple:
+        """
+        collect up to micro_batch_size images, waiting at most MICRO_BATCH_TIMEOUT once the first has arrived
+
+        :return: list of (local path, image, dhash) and whether the crawl has finished
+        """
+        batch = [self.queue.get()]
+        if batch[0] is _DONE:
+            return [], True
+        deadline = time.monotonic() + MICRO_BATCH_TIMEOUT
+        while len(batch) < self.micro_batch_size:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        QUEUE_DEPTH.set(self.queue.qsize(), queue='streaming_scan')
+        return batch, False
+
+    def run(self) -> List[dict]:
+        """
+        crawl and match concurrently
+
+        :return: all matches found for the crawled images
+        """
+        start = time.perf_counter()
+        crawler = threading.Thread(target=self._crawl, name='streaming-crawl')
+        crawler.start()
+
+        try:
+            matches = self._consume(start)
+        except BaseException:
+            self.cancelled = True
+            while crawler.is_alive():  # unblock download threads waiting on a full queue
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+        crawler.join()
+        if self.crawl_error is not None:
+            raise self.crawl_error
+        return matches
+
+    def _consume(self, start: float) -> List[dict]:
+        """consumer side, prefilters, embeds and queries micro-batches until the crawl is done"""
+        matches = []
+        embedded = 0
+        done = False
+        while not done:
+            batch, done = self._next_batch()
+            if not batch:
+                continue
+            filenames = [os.path.basename(path) for path, _, _ in batch]
+            hashes = [value for _, _, value in batch]
+            self.engine.add_crawled_hashes([path for path, _, _ in batch], hashes)
+            batch_matches = []
+            if self.engine.two_stage:
+                batch_matches, ambiguous = self.engine.prefilter(filenames, hashes, self.threshold)
+                self.engine.defer_embedding([path for (path, _, _), keep in zip(batch, ambiguous) if not keep])
+                batch = [item for item, keep in zip(batch, ambiguous) if keep]  # clear copies skip the feature extractor
+            if batch:
+                paths = [path for path, _, _ in batch]
+                vectors = self.engine.extractor.extract_images([image for _, image, _ in batch])
+                embedded += len(batch)
+                batch_matches += self.engine.match_vectors(vectors, [os.path.basename(p) for p in paths], self.threshold)
+                self.engine.add_crawled_embeddings(paths, vectors, [value for _, _, value in batch])
+            self.downloader.state.mark_matched(filenames)  # later scans only see images crawled after this one
+            if batch_matches and self.time_to_first_match is None:
+                self.time_to_first_match = time.perf_counter() - start
+                logging.info(f"first match after {self.time_to_first_match:.2f}s")
+            matches.extend(batch_matches)
+            if self.progress:
+                self.progress(embedded=embedded, matched=len(matches))
+            if self.on_matches and batch_matches:
+                self.on_matches(batch_matches)
+
+        elapsed = time.perf_counter() - start
+        logging.info(f"streaming scan embedded {embedded} images and found {len(matches)} matches in {elapsed:.2f}s")
+        return matches
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from ann_index import MIN_POINTS_PER_CENTROID, PQ_NBITS, build_index, choose_index_mode, range_search, resolve_index_mode
+
+DIMENSION = 512  # 8 dimensions per PQ sub-quantizer, lossy enough to miss the threshold without re-ranking
+
+
+def corpus(size: int, queries: int):
+    """unit vectors and queries that are near copies of some of them, cosine about 0.9 to their source"""
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((size, DIMENSION)).astype('float32')
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    copies = vectors[:queries] + rng.standard_normal((queries, DIMENSION)).astype('float32') * 0.02
+    copies /= np.linalg.norm(copies, axis=1, keepdims=True)
+    return vectors, copies
+
+
+def pairs(index, queries) -> set:
+    rows, ids, _ = range_search(index, queries, 90)
+    return set(zip(rows.tolist(), ids.tolist()))
+
+
+@pytest.mark.parametrize('mode', ['hnsw', 'ivfpq'])
+def test_approximate_modes_keep_threshold_recall(mode):
+    vectors, queries = corpus(MIN_POINTS_PER_CENTROID * 2 ** PQ_NBITS, 100)
+    assert resolve_index_mode(mode, len(vectors)) == mode
+    ids = np.arange(len(vectors), dtype='int64')
+    exact = pairs(build_index(vectors, ids, 'flat'), queries)
+    found = pairs(build_index(vectors, ids, mode), queries)
+    assert len(exact) >= 100
+    assert len(found & exact) >= 0.95 * len(exact)
+
+
+def test_auto_mode_never_picks_ivfpq():
+    assert choose_index_mode(10 ** 9) == 'ivf'
@@ -0,0 +1,105 @@
+import os
+import pytest
+
+import async_crawler
+import completely_legal_scraping
+from async_crawler import AsyncWikimediaCrawler
+from benchmarks.corpus import draw_image
+from benchmarks.mock_mediawiki import MockMediaWiki
+from completely_legal_scraping import WikimediaImageDownloader
+from crawl_state import CrawlState
+
+IMAGES = 12
+
+
+@pytest.fixture
+def mock(tmp_path, monkeypatch):
+    crawl_dir = tmp_path / 'crawl'
+    crawl_dir.mkdir()
+    for i in range(IMAGES):
+        draw_image((2, 1, i), 128).save(crawl_dir / f'c{i:02d}.jpg', quality=90)
+    monkeypatch.chdir(tmp_path)  # the downloader writes its metadata CSV into the working directory
+    monkeypatch.setattr(completely_legal_scraping, 'MAX_IMAGES', 100)
+    monkeypatch.setattr(async_crawler, 'BACKOFF_BASE', 0.01)
+    mock = MockMediaWiki(str(crawl_dir), page_size=5)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+def crawler(mock, tmp_path) -> AsyncWikimediaCrawler:
+    downloader = WikimediaImageDownloader(api_url=mock.api_url, download_dir=str(tmp_path / 'downloads'), mode='async',
+                                          state=CrawlState(str(tmp_path / 'state.db')))
+    return AsyncWikimediaCrawler(downloader)
+
+
+def test_downloads_every_image(mock, tmp_path):
+    crawl = crawler(mock, tmp_path)
+    assert crawl.run()
+    assert sorted(os.listdir(tmp_path / 'downloads')) == mock.filenames
+    assert crawl.stats.images == IMAGES
+    assert crawl.stats.retries == 0
+    assert crawl.downloader.crawl_stats['images'] == IMAGES
+
+
+def test_retries_server_errors(mock, tmp_path):
+    mock.fail('api', 503, times=2)
+    mock.fail('file', 500)
+    mock.fail('file', 502)
+    crawl = crawler(mock, tmp_path)
+    assert crawl.run()
+    assert len(os.listdir(tmp_path / 'downloads')) == IMAGES
+    assert crawl.stats.retries == 4
+    assert crawl.stats.images == IMAGES
+
+
+def test_does_not_retry_client_errors(mock, tmp_path):
+    mock.fail('file', 404)
+    crawl = crawler(mock, tmp_path)
+    assert crawl.run()
+    filename = next(target for _, kind, target, status in mock.history if status == 404)
+    assert len(mock.requests_of('file', filename)) == 1
+    assert crawl.stats.retries == 0
+    assert len(os.listdir(tmp_path / 'downloads')) == IMAGES - 1
+
+
+def test_honours_retry_after(mock, tmp_path):
+    mock.fail('file', 429, retry_after=0.5)
+    crawl = crawler(mock, tmp_path)
+    assert crawl.run()
+    assert len(os.listdir(tmp_path / 'downloads')) == IMAGES
+    filename = next(target for _, kind, target, status in mock.history if status == 429)
+    (throttled, _), (retried, status) = mock.requests_of('file', filename)
+    assert status == 200
+    assert retried - throttled >= 0.45
+    # the whole crawl pauses, requests sent before the 429 came back may still complete right after it
+    assert all(at - throttled >= 0.45 for at, _ in mock.requests_of('file') if at - throttled > 0.1)
+
+
+def test_backs_off_on_maxlag(mock, tmp_path):
+    mock.fail('api', 'maxlag', retry_after=0.3)
+    crawl = crawler(mock, tmp_path)
+    assert crawl.run()
+    (lagged, _), (retried, status) = mock.requests_of('api', 'categorymembers')[:2]
+    assert status == 200
+    assert retried - lagged >= 0.25
+    assert crawl.stats.retries == 1
+    assert len(os.listdir(tmp_path / 'downloads')) == IMAGES
+
+
+def test_gives_up_after_max_retries(mock, tmp_path, monkeypatch):
+    monkeypatch.setattr(async_crawler, 'MAX_RETRIES', 2)
+    mock.fail('api', 503, times=3)
+    crawl = crawler(mock, tmp_path)
+    assert not crawl.run()  # the category listing failed, nothing to download
+    assert len(mock.requests_of('api')) == 3
+
+
+def test_stops_fetching_imageinfo_at_max_images(mock, tmp_path, monkeypatch):
+    monkeypatch.setattr(completely_legal_scraping, 'MAX_IMAGES', 3)
+    monkeypatch.setattr(completely_legal_scraping, 'IMAGEINFO_BATCH_SIZE', 2)
+    crawl = crawler(mock, tmp_path)
+    assert crawl.run()
+    assert len(crawl.downloader.images) == 3
+    assert len(mock.requests_of('api', 'imageinfo')) == 2  # of the page's 3 batches
+    assert len(mock.requests_of('api', 'categorymembers')) == 1
@@ -0,0 +1,23 @@
+import sqlite3
+
+from crawl_state import CrawlState
+
+
+def test_renames_the_legacy_embedded_flag(tmp_path):
+    path = str(tmp_path / 'state.db')
+    connection = sqlite3.connect(path)
+    connection.execute("""
+        CREATE TABLE images (title TEXT PRIMARY KEY, url TEXT NOT NULL, descriptionurl TEXT, user TEXT, license TEXT,
+                             attribution TEXT, local_path TEXT, filename TEXT, embedded INTEGER NOT NULL DEFAULT 0,
+                             added_at REAL NOT NULL)
+    """)
+    connection.executemany("INSERT INTO images (title, url, local_path, filename, embedded, added_at) VALUES (?, ?, ?, ?, ?, 0)",
+                           [('File:A.jpg', 'http://a', '/d/A.jpg', 'A.jpg', 1), ('File:B.jpg', 'http://b', '/d/B.jpg', 'B.jpg', 0)])
+    connection.commit()
+    connection.close()
+
+    state = CrawlState(path)
+    assert state.matched_filenames(['A.jpg', 'B.jpg']) == {'A.jpg'}
+    assert state.unmatched() == [('/d/B.jpg', None)]
+    state.mark_matched(['B.jpg'])
+    assert CrawlState(path).matched_filenames(['A.jpg', 'B.jpg']) == {'A.jpg', 'B.jpg'}
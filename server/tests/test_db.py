@@ -0,0 +1,84 @@
+import pytest
+from sqlalchemy import create_engine, func, select, text
+
+import db
+from db import Image, Match, User, init_db, persist_matches
+
+
+@pytest.fixture
+def Session(tmp_path):
+    Session = init_db(f"sqlite:///{tmp_path / 'arttrack.db'}")
+    with Session() as session, session.begin():
+        user = User(username='owner', password='-')
+        session.add(user)
+        session.flush()
+        session.add_all([Image(filename='a.jpg', user_id=user.user_id), Image(filename='b.jpg', user_id=user.user_id)])
+    return Session
+
+
+def match(new_filename, user_filename, similarity=95.0, stage='resnet'):
+    return {"new_filename": new_filename, "user_filename": user_filename, "similarity": similarity, "stage": stage}
+
+
+def stored(Session):
+    with Session() as session:
+        return sorted(session.execute(select(
+            Match.new_image_filename, Match.matched_image_filename, Match.similarity_score, Match.stage)).all())
+
+
+def test_repeated_matches_are_stored_once(Session):
+    first = [match('x.jpg', 'a.jpg'), match('y.jpg', 'a.jpg', 99.0, 'phash'), match('x.jpg', 'b.jpg')]
+    with Session() as session, session.begin():
+        assert persist_matches(session, first) == (3, [])
+    # the next scan reports the same pairs again, next to a new one and a duplicate inside the batch
+    again = [match('x.jpg', 'a.jpg', 97.0), match('z.jpg', 'b.jpg'), match('z.jpg', 'b.jpg')]
+    with Session() as session, session.begin():
+        inserted, unresolved = persist_matches(session, first + again)
+    assert (inserted, unresolved) == (1, [])
+    assert stored(Session) == [
+        ('x.jpg', 'a.jpg', 95.0, 'resnet'), ('x.jpg', 'b.jpg', 95.0, 'resnet'),
+        ('y.jpg', 'a.jpg', 99.0, 'phash'), ('z.jpg', 'b.jpg', 95.0, 'resnet'),
+    ]
+
+
+def test_unresolved_filenames_are_returned(Session):
+    matches = [match('x.jpg', 'a.jpg'), match('x.jpg', 'deleted.jpg'), match('y.jpg', 'deleted.jpg')]
+    with Session() as session, session.begin():
+        inserted, unresolved = persist_matches(session, matches)
+    assert inserted == 1
+    assert unresolved == matches[1:]
+    assert stored(Session) == [('x.jpg', 'a.jpg', 95.0, 'resnet')]
+
+
+def test_writes_in_chunks(Session, monkeypatch):
+    monkeypatch.setattr(db, 'WRITE_CHUNK_SIZE', 7)
+    matches = [match(f'{i:03d}.jpg', 'ab'[i % 2] + '.jpg') for i in range(50)]
+    with Session() as session, session.begin():
+        assert persist_matches(session, matches) == (50, [])
+    with Session() as session, session.begin():
+        assert persist_matches(session, matches) == (0, [])
+    assert len(stored(Session)) == 50
+
+
+def test_empty_batch(Session):
+    with Session() as session, session.begin():
+        assert persist_matches(session, []) == (0, [])
+
+
+def test_existing_duplicates_are_dropped_before_the_unique_index(tmp_path):
+    url = f"sqlite:///{tmp_path / 'legacy.db'}"
+    engine = create_engine(url)
+    with engine.begin() as connection:  # tables as the node server's sequelize sync created them
+        connection.execute(text('CREATE TABLE "Users" (user_id INTEGER PRIMARY KEY, username VARCHAR(20), password VARCHAR(255))'))
+        connection.execute(text('CREATE TABLE "Images" (image_id INTEGER PRIMARY KEY, filename VARCHAR UNIQUE, user_id INTEGER)'))
+        connection.execute(text(
+            'CREATE TABLE "Matches" (match_id INTEGER PRIMARY KEY, similarity_score FLOAT, '
+            'new_image_filename VARCHAR, matched_image_filename VARCHAR, image_id INTEGER)'))
+        connection.execute(text("INSERT INTO \"Users\" VALUES (1, 'owner', '-')"))
+        connection.execute(text("INSERT INTO \"Images\" VALUES (1, 'a.jpg', 1)"))
+        for match_id in (1, 2, 3):
+            connection.execute(text(f"INSERT INTO \"Matches\" VALUES ({match_id}, 95.0, 'x.jpg', 'a.jpg', 1)"))
+    Session = init_db(url)
+    with Session() as session:
+        assert session.execute(select(func.count()).select_from(Match)).scalar() == 1
+        assert session.execute(select(Match.match_id, Match.stage)).all() == [(1, None)]
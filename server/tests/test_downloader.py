@@ -0,0 +1,75 @@
+import os
+from io import BytesIO
+import numpy as np
+import pytest
+from PIL import Image
+
+import completely_legal_scraping
+from benchmarks.corpus import draw_image
+from completely_legal_scraping import ImageMetadata, WikimediaImageDownloader
+from crawl_state import CrawlState
+
+
+@pytest.fixture
+def downloader(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the downloader reads its metadata CSV from the working directory
+    (tmp_path / 'downloads').mkdir()  # created by run() in a crawl
+    return WikimediaImageDownloader(api_url='http://127.0.0.1:9/w/api.php', download_dir=str(tmp_path / 'downloads'),
+                                    mode='threads', state=CrawlState(str(tmp_path / 'state.db')))
+
+
+def metadata(title: str, url: str) -> ImageMetadata:
+    return ImageMetadata(title=title, url=url, descriptionurl='', user='', license='', attribution='')
+
+
+def png_bytes(image: Image.Image) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def test_keep_existing_finds_the_recorded_path(downloader, tmp_path):
+    saved = tmp_path / 'elsewhere.jpg'
+    saved.write_bytes(b'jpeg')
+    original = metadata('File:A.png', 'http://commons/a/A.png')
+    original.local_path = str(saved)
+    downloader.state.add_images([original])
+
+    again = metadata('File:A copy.png', 'http://commons/a/A.png')  # same file under another title
+    assert downloader.keep_existing(again)
+    assert again.local_path == str(saved)
+
+
+def test_keep_existing_without_a_file(downloader):
+    image = metadata('File:B.jpg', 'http://commons/b/B.jpg')
+    assert not downloader.keep_existing(image)
+    assert image.local_path is None
+
+
+def test_save_image_writes_fitting_sources_unchanged(downloader):
+    content = png_bytes(draw_image((2, 0, 0), 128))
+    image = metadata('File:Small.png', 'http://commons/s/Small.png')
+    downloader.save_image(image, content)
+
+    assert os.path.basename(image.local_path) == 'Small.png'
+    with open(image.local_path, 'rb') as f:
+        assert f.read() == content
+    report = downloader.compression.report()
+    assert report['passed_through'] == 1 and report['encodes_per_image'] == 0
+    assert report['bytes_out'] == report['bytes_in']
+
+
+def test_save_image_names_jpeg_encodes_jpg(downloader, monkeypatch):
+    monkeypatch.setattr(completely_legal_scraping, 'TARGET_SIZE', 50_000)
+    noise = np.random.default_rng(0).integers(0, 256, (256, 256, 3), dtype=np.uint8)
+    content = png_bytes(Image.fromarray(noise))
+    image = metadata('File:Large.png', 'http://commons/l/Large.png')
+    downloader.save_image(image, content)
+
+    assert os.path.basename(image.local_path) == 'Large.png.jpg'
+    with Image.open(image.local_path) as saved:
+        assert saved.format == 'JPEG'
+    assert os.path.getsize(image.local_path) <= 50_000
+    assert downloader.keep_existing(metadata('File:Large.png', 'http://commons/l/Large.png'))
+    report = downloader.compression.report()
+    assert report['passed_through'] == 0 and report['kept'] == 1 and report['cpu_ms_saved'] > 0
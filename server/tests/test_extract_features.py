@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from algorithm import FeatureExtractor
+
+BATCH_SIZE = 4
+IMAGES = 40
+CORRUPT = {1, 5, 6, 13, 22, 23, 24, 27, 39}  # spread over several batches, batch 6 (24..27) keeps one image
+
+
+@pytest.fixture(scope='module')
+def extractor():
+    return FeatureExtractor(torch.device('cpu'), batch_size=BATCH_SIZE, num_workers=0, backend='eager', backbone='resnet18')
+
+
+@pytest.fixture(scope='module')
+def image_paths(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('images')
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(IMAGES):
+        path = str(directory / f'{i:03d}.jpg')
+        Image.fromarray(rng.integers(0, 256, (96, 128, 3), dtype='uint8')).save(path, quality=90)
+        if i in CORRUPT:
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data[:len(data) // 8])  # truncated upload
+        paths.append(path)
+    return paths
+
+
+def test_kept_paths_align_with_vectors(extractor, image_paths):
+    features, kept_paths = extractor.extract_features(image_paths)
+    assert kept_paths == [p for i, p in enumerate(image_paths) if i not in CORRUPT]
+    assert features.shape == (len(kept_paths), extractor.dimension)
+    for path, vector in zip(kept_paths, features):
+        single, kept = extractor.extract_features([path])
+        assert kept == [path]
+        np.testing.assert_allclose(vector, single[0], rtol=1e-3, atol=1e-4)
+
+
+def test_whole_batch_corrupt(extractor, image_paths):
+    corrupt = [p for i, p in enumerate(image_paths) if i in CORRUPT][:BATCH_SIZE]
+    features, kept_paths = extractor.extract_features(corrupt)
+    assert kept_paths == []
+    assert len(features) == 0
+
+
+def test_loader_workers_keep_order(extractor, image_paths):
+    expected, expected_paths = extractor.extract_features(image_paths)
+    extractor.num_workers = 2
+    try:
+        features, kept_paths = extractor.extract_features(image_paths)
+    finally:
+        extractor.num_workers = 0
+    assert kept_paths == expected_paths
+    np.testing.assert_allclose(features, expected, rtol=1e-3, atol=1e-4)
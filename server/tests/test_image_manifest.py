@@ -0,0 +1,90 @@
+import io
+import os
+import pytest
+from PIL import Image
+
+import image_manifest
+from image_manifest import ImageManifest, probe
+
+SIZE = (40, 30)
+
+
+def encoded(image_format: str, **options) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', SIZE, 'red').save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('image_format', ['JPEG', 'PNG', 'GIF', 'BMP', 'WEBP'])
+def test_probe_reads_the_header(tmp_path, image_format):
+    path = tmp_path / f'image.{image_format.lower()}'
+    path.write_bytes(encoded(image_format))
+    assert probe(str(path)) == (image_format, *SIZE)
+
+
+def test_probe_rejects_other_files(tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_bytes(b'not an image')
+    assert probe(str(path)) is None
+
+
+def test_scan_probes_only_new_or_changed_files(tmp_path, monkeypatch):
+    directory = tmp_path / 'images'
+    directory.mkdir()
+    (directory / 'a.jpg').write_bytes(encoded('JPEG'))
+    (directory / 'b.png').write_bytes(encoded('PNG'))
+    (directory / 'notes.txt').write_bytes(b'not an image')
+    manifest = ImageManifest(str(tmp_path / 'manifest.db'))
+    entries = manifest.scan(str(directory))
+    assert [(os.path.basename(entry.path), entry.format, entry.width, entry.height) for entry in entries] == [
+        ('a.jpg', 'JPEG', *SIZE), ('b.png', 'PNG', *SIZE)]
+
+    probed = []
+    monkeypatch.setattr(image_manifest, 'probe', lambda path: probed.append(os.path.basename(path)) or probe(path))
+    (directory / 'c.gif').write_bytes(encoded('GIF'))
+    os.remove(directory / 'a.jpg')
+    entries = manifest.scan(str(directory))
+    assert [os.path.basename(entry.path) for entry in entries] == ['b.png', 'c.gif']
+    assert probed == ['c.gif']
+
+
+def test_listing_survives_reopening(tmp_path):
+    directory = tmp_path / 'images'
+    directory.mkdir()
+    (directory / 'a.jpg').write_bytes(encoded('JPEG'))
+    ImageManifest(str(tmp_path / 'manifest.db')).scan(str(directory))
+    assert ImageManifest(str(tmp_path / 'manifest.db')).scan(str(directory))[0].format == 'JPEG'
+
+
+TRUNCATED = {
+    'jpeg_fill_bytes': b'\xff\xd8\xff\xff',
+    'jpeg_magic_only': b'\xff\xd8\xff',
+    'jpeg_zero_length_segment': b'\xff\xd8\xff\xe0\x00\x00',
+    'jpeg_cut_in_frame_header': encoded('JPEG')[:160],
+    'png_signature_only': b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00',
+    'gif_magic_only': b'GIF89a\x28',
+    'bmp_magic_only': b'BM\x00',
+    'webp_cut': b'RIFF\x00\x00\x00\x00WEBPVP8 ',
+    'empty': b'',
+}
+
+
+@pytest.mark.parametrize('name', sorted(TRUNCATED))
+def test_probe_rejects_truncated_headers(tmp_path, name):
+    path = tmp_path / name
+    path.write_bytes(TRUNCATED[name])
+    assert probe(str(path)) is None
+
+
+def test_scan_skips_partial_uploads(tmp_path):
+    directory = tmp_path / 'images'
+    directory.mkdir()
+    (directory / 'good.jpg').write_bytes(encoded('JPEG'))
+    (directory / 'good.png').write_bytes(encoded('PNG'))
+    for name, data in TRUNCATED.items():
+        (directory / name).write_bytes(data)
+    manifest = ImageManifest(str(tmp_path / 'manifest.db'))
+    entries = manifest.scan(str(directory))
+    assert [entry.path for entry in entries] == [str(directory / 'good.jpg'), str(directory / 'good.png')]
+    (directory / 'jpeg_fill_bytes').write_bytes(encoded('JPEG'))  # the upload completes
+    assert len(manifest.scan(str(directory))) == 3
@@ -0,0 +1,109 @@
+import os
+import threading
+import numpy as np
+import pytest
+
+from embedding_codec import EMBEDDING_DTYPES, EmbeddingCodec
+from mapped_index import CURRENT_FILE, MappedIndex, current_version
+
+DIMENSION = 16
+
+
+def unit_vectors(n: int, seed: int) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((n, DIMENSION)).astype('float32')
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize('dtype', EMBEDDING_DTYPES)
+def test_build_and_open_find_the_stored_vectors(tmp_path, dtype):
+    directory = str(tmp_path / 'index')
+    vectors = unit_vectors(50, 0)
+    MappedIndex.build(directory, vectors, np.arange(100, 150), EmbeddingCodec(dtype, pca_dims=None))
+    index = MappedIndex.open(directory)
+
+    assert index.ntotal == 50 and index.codec.dtype == dtype
+    _, ids = index.search(vectors[:5], 1)
+    assert ids[:, 0].tolist() == [100, 101, 102, 103, 104]
+    lims, _, found = index.range_search(vectors[:5], 0.9)
+    assert [found[lims[i]:lims[i + 1]].tolist() for i in range(5)] == [[100], [101], [102], [103], [104]]
+
+
+def test_added_and_removed_vectors(tmp_path):
+    vectors = unit_vectors(30, 1)
+    index = MappedIndex.build(str(tmp_path / 'index'), vectors[:20], np.arange(20), EmbeddingCodec('float16', pca_dims=None))
+    index.add_with_ids(vectors[20:], np.arange(20, 30))
+    assert index.ntotal == 30
+    assert index.remove_ids(np.array([3, 25, 99])) == 2
+    assert index.ntotal == 28
+
+    _, ids = index.search(vectors[[3, 4, 25, 26]], 1)
+    assert ids[:, 0].tolist()[1::2] == [4, 26]
+    assert 3 not in ids and 25 not in ids
+
+
+def test_search_pads_when_fewer_vectors_than_k(tmp_path):
+    index = MappedIndex.build(str(tmp_path / 'index'), unit_vectors(2, 2), np.arange(2), EmbeddingCodec('int8', pca_dims=None))
+    scores, ids = index.search(unit_vectors(1, 3), 4)
+    assert ids[0, 2:].tolist() == [-1, -1]
+    assert np.isinf(scores[0, 2:]).all()
+
+
+def test_build_publishes_a_new_version_and_old_readers_keep_theirs(tmp_path):
+    directory = str(tmp_path / 'index')
+    first = MappedIndex.build(directory, unit_vectors(50, 0), np.arange(50), EmbeddingCodec('float16'))
+    reader = MappedIndex.open(directory)
+    second = MappedIndex.build(directory, unit_vectors(20, 1), np.arange(100, 120), EmbeddingCodec('int8'))
+
+    assert first.directory != second.directory
+    assert current_version(directory)[0] == second.directory
+    assert MappedIndex.open(directory).ntotal == 20
+    # the earlier mapping still sees one consistent build: its codes, ids and codec
+    assert reader.ntotal == 50 and reader.codec.dtype == 'float16'
+    _, ids = reader.search(unit_vectors(50, 0)[:5], 1)
+    assert ids[:, 0].tolist() == [0, 1, 2, 3, 4]
+    assert sorted(entry for entry in os.listdir(directory) if entry.startswith('v')) == [os.path.basename(second.directory)]
+
+
+def test_open_without_a_build(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        MappedIndex.open(str(tmp_path / 'index'))
+
+
+def test_open_or_build_reuses_a_version_with_the_same_key(tmp_path):
+    directory = str(tmp_path / 'index')
+    vectors = unit_vectors(30, 2)
+    built = MappedIndex.open_or_build(directory, 'store-1', lambda: (vectors, np.arange(30)), DIMENSION)
+
+    def stale():
+        raise AssertionError("the store was read although the index is current")
+
+    opened = MappedIndex.open_or_build(directory, 'store-1', stale, DIMENSION)
+    assert opened.directory == built.directory
+    rebuilt = MappedIndex.open_or_build(directory, 'store-2', lambda: (vectors[:10], np.arange(10)), DIMENSION)
+    assert rebuilt.directory != built.directory and rebuilt.ntotal == 10
+    # another codec is another index, even over the same store
+    other = MappedIndex.open_or_build(directory, 'store-2', lambda: (vectors[:10], np.arange(10)), DIMENSION, EmbeddingCodec('int8'))
+    assert other.directory != rebuilt.directory
+
+
+def test_workers_starting_together_build_once(tmp_path):
+    directory = str(tmp_path / 'index')
+    vectors = unit_vectors(200, 3)
+    loads, opened = [], []
+
+    def load():
+        loads.append(1)
+        return vectors, np.arange(200)
+
+    def worker():
+        opened.append(MappedIndex.open_or_build(directory, 'store', load, DIMENSION).directory)
+
+    threads = [threading.Thread(target=worker) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+    assert len(set(opened)) == 1
+    with open(os.path.join(directory, CURRENT_FILE)) as f:
+        assert os.path.join(directory, f.read()) == opened[0]
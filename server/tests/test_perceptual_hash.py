@@ -0,0 +1,43 @@
+import numpy as np
+from PIL import Image
+
+from benchmarks.corpus import draw_image
+from perceptual_hash import HASH_BITS, HashIndex, dhash, is_degenerate
+
+
+def blank(colour, size=(120, 80)) -> Image.Image:
+    return Image.new('RGB', size, colour)
+
+
+def gradient(size=(120, 80)) -> Image.Image:
+    row = np.linspace(0, 255, size[0]).astype('uint8')
+    return Image.fromarray(np.tile(row, (size[1], 1)))
+
+
+def test_uniform_and_gradient_images_are_degenerate():
+    assert dhash(blank('white')) == dhash(blank('black')) == 0
+    assert dhash(gradient()) == (1 << HASH_BITS) - 1
+    assert is_degenerate(dhash(blank('white')))
+    assert is_degenerate(dhash(gradient()))
+    assert not is_degenerate(dhash(draw_image((3, 0, 0), 128)))
+
+
+def test_degenerate_hashes_never_match():
+    index = HashIndex(4)
+    index.add(dhash(blank('white')), 'blank_user.jpg')
+    index.add(dhash(gradient()), 'gradient_user.jpg')
+    assert len(index) == 0
+    assert index.search(dhash(blank('grey'))) == []
+    assert index.search(dhash(gradient((200, 50)))) == []
+    assert index.search(1, max_distance=HASH_BITS) == []  # not even through a full scan
+
+
+def test_replacing_a_hash_by_a_degenerate_one_drops_the_key():
+    index = HashIndex(4)
+    value = dhash(draw_image((3, 0, 1), 128))
+    index.add(value, 'a.jpg')
+    assert index.search(value) == [('a.jpg', 0)]
+    index.add(0, 'a.jpg')
+    assert len(index) == 0
+    assert index.search(value) == []
+    assert not index.remove('a.jpg')
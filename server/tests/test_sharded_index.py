@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from ann_index import MIN_POINTS_PER_CENTROID
+from embedding_store import EmbeddingStore
+from sharded_index import ShardedIndex
+
+DIMENSION = 32
+COUNT = 40
+
+
+def make_store(tmp_path, count: int) -> EmbeddingStore:
+    paths = []
+    for i in range(count):
+        path = tmp_path / f'img{i}.jpg'
+        path.write_bytes(b'%d' % i)
+        paths.append(str(path))
+    vectors = np.random.default_rng(0).standard_normal((count, DIMENSION)).astype('float32')
+    store = EmbeddingStore(str(tmp_path / 'store.db'), 'test')
+    store.put_many(paths, vectors, [None] * count)
+    return store
+
+
+def unit(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_shards_load_search_and_update_their_partitions(tmp_path):
+    store = make_store(tmp_path, COUNT)
+    index = ShardedIndex(3, DIMENSION, 'flat')
+    try:
+        index.load(store.path, store.model_id)
+        assert index.ntotal == COUNT
+        ids, _, vectors = store.load()
+        vectors = unit(vectors)
+        distances, found = index.search(vectors[:5], 1)
+        assert found[:, 0].tolist() == ids[:5].tolist()
+        assert np.allclose(distances[:, 0], 1, atol=1e-4)
+
+        lims, _, matched = index.range_search(vectors[:5], 0.99)
+        assert [matched[lims[i]:lims[i + 1]].tolist() for i in range(5)] == [[int(i)] for i in ids[:5]]
+
+        index.remove_ids(ids[:2])
+        added = unit(np.random.default_rng(1).standard_normal((2, DIMENSION)).astype('float32'))
+        index.add_with_ids(added, np.array([1000, 1001]))
+        assert index.ntotal == COUNT
+        _, found = index.search(np.vstack([added, vectors[:2]]), 1)
+        assert found[:2, 0].tolist() == [1000, 1001]
+        assert not set(found[2:, 0].tolist()) & set(ids[:2].tolist())
+    finally:
+        index.close()
+
+
+@pytest.mark.parametrize('count', [2 * 4 * MIN_POINTS_PER_CENTROID + 10, 10])  # enough to train ivf per shard, too few
+def test_ivf_shards_load_their_partition(tmp_path, count):
+    store = make_store(tmp_path, count)
+    index = ShardedIndex(2, DIMENSION, 'ivf')
+    try:
+        index.load(store.path, store.model_id)
+        assert index.ntotal == count
+        ids, _, vectors = store.load()
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        distances, found = index.search(vectors[:5], 1)
+        assert found[:, 0].tolist() == ids[:5].tolist()
+        assert np.allclose(distances[:, 0], 1, atol=1e-4)
+    finally:
+        index.close()
@@ -0,0 +1,134 @@
+import os
+import shutil
+import pytest
+import torch
+from PIL import Image
+
+import completely_legal_scraping
+import engine as engine_module
+from ann_index import SIMILARITY_THRESHOLD
+from benchmarks.corpus import draw_image
+from benchmarks.mock_mediawiki import MockMediaWiki
+from completely_legal_scraping import WikimediaImageDownloader
+from crawl_state import CrawlState
+from engine import ScanEngine
+from streaming_scan import StreamingScan
+
+USERS = 4
+UNRELATED = 6
+
+
+@pytest.fixture
+def crawl(tmp_path, monkeypatch):
+    """user images, a crawl of copies of some of them and unrelated images served by the mock server, and an engine"""
+    user_dir, crawl_dir = tmp_path / 'users', tmp_path / 'crawl'
+    user_dir.mkdir()
+    crawl_dir.mkdir()
+    for i in range(USERS):
+        draw_image((1, 0, i), 256).save(user_dir / f'u{i}.jpg', quality=90)
+    Image.new('RGB', (256, 192), 'white').save(user_dir / 'blank.jpg')
+    shutil.copy(user_dir / 'u0.jpg', crawl_dir / 'copy_u0.jpg')
+    shutil.copy(user_dir / 'u1.jpg', crawl_dir / 'copy_u1.jpg')
+    draw_image((1, 0, 2), 256).save(crawl_dir / 'reencode_u2.jpg', quality=50)
+    Image.new('RGB', (300, 200), 'black').save(crawl_dir / 'blank_crawl.jpg')
+    for i in range(UNRELATED):
+        draw_image((1, 1, i), 256).save(crawl_dir / f'other{i}.jpg', quality=90)
+
+    monkeypatch.chdir(tmp_path)  # the downloader writes its metadata CSV into the working directory
+    monkeypatch.setattr(completely_legal_scraping, 'MAX_IMAGES', 100)
+    mock = MockMediaWiki(str(crawl_dir), page_size=4)
+    mock.start()
+    engine = ScanEngine(torch.device('cpu'), store_path=str(tmp_path / 'user.db'), crawl_store_path=str(tmp_path / 'crawl.db'),
+                        crawl_state=CrawlState(str(tmp_path / 'state.db')), crawl_index_path=str(tmp_path / 'crawl.faiss'))
+    engine.load(str(user_dir))
+    yield engine, mock, tmp_path / 'downloads'
+    engine.close()
+    mock.stop()
+
+
+def downloader(engine, mock, download_dir, mode='threads'):
+    return WikimediaImageDownloader(api_url=mock.api_url, download_dir=str(download_dir), mode=mode, state=engine.crawl_state)
+
+
+def pairs(matches):
+    return {(match['new_filename'], match['user_filename']) for match in matches}
+
+
+@pytest.mark.parametrize('mode', ['threads', 'async'])
+def test_streaming_scan_crawls_and_matches(crawl, mode):
+    engine, mock, download_dir = crawl
+    matches = StreamingScan(engine, downloader(engine, mock, download_dir, mode)).run()
+
+    assert sorted(os.listdir(download_dir)) == sorted(mock.filenames)
+    found = pairs(matches)
+    assert {('copy_u0.jpg', 'u0.jpg'), ('copy_u1.jpg', 'u1.jpg'), ('reencode_u2.jpg', 'u2.jpg')} <= found
+    stages = {(match['new_filename'], match['user_filename']): match['stage'] for match in matches}
+    assert stages[('copy_u0.jpg', 'u0.jpg')] == 'phash'
+    # blank images share the degenerate dHash 0, only the ResNet stage may pair them
+    assert stages.get(('blank_crawl.jpg', 'blank.jpg'), 'resnet') == 'resnet'
+    # every downloaded image reached the matching stages, so a sequential scan of the files finds the same pairs
+    assert pairs(engine.scan(str(download_dir), threshold=SIMILARITY_THRESHOLD, incremental=False)) == found
+
+
+def test_next_scan_resumes_after_the_crawled_images(crawl):
+    engine, mock, download_dir = crawl
+    StreamingScan(engine, downloader(engine, mock, download_dir)).run()
+    served = mock.bytes_served
+
+    assert StreamingScan(engine, downloader(engine, mock, download_dir)).run() == []
+    assert mock.bytes_served - served < 10_000  # API pages only, no image was downloaded again
+
+
+def test_clear_copies_are_embedded_by_backfill_not_by_uploads(crawl):
+    engine, mock, download_dir = crawl
+    StreamingScan(engine, downloader(engine, mock, download_dir)).run()
+    deferred = set(engine.unembedded)
+    assert {'copy_u0.jpg', 'copy_u1.jpg'} <= deferred
+    assert not deferred & engine.crawl_store.filenames()  # the scan embedded none of them
+
+    user_dir = download_dir.parent / 'users'
+    shutil.copy(user_dir / 'u0.jpg', user_dir / 'late.jpg')
+    assert engine.add_user_image('late.jpg', str(user_dir))
+    stored = len(engine.crawl_store)
+    assert ('copy_u0.jpg', 'late.jpg') in pairs(engine.reverse_scan('late.jpg'))
+    assert len(engine.crawl_store) == stored  # the upload path leaves the deferred copies alone
+
+    found = []
+    assert engine.backfill(on_matches=found.extend) == len(deferred)
+    assert not engine.unembedded and deferred <= engine.crawl_store.filenames()
+    assert {('copy_u0.jpg', 'u0.jpg'), ('copy_u1.jpg', 'u1.jpg')} <= pairs(found)
+    assert engine.backfill() == 0
+
+
+def test_user_partitions_are_evicted_least_recently_scanned_first(crawl, monkeypatch):
+    engine, mock, download_dir = crawl
+    monkeypatch.setattr(engine_module, 'PARTITION_CACHE_SIZE', 2)
+    StreamingScan(engine, downloader(engine, mock, download_dir)).run()
+    found = pairs(engine.scan_user(1, ['u0.jpg', 'u1.jpg']))
+    assert {('copy_u0.jpg', 'u0.jpg'), ('copy_u1.jpg', 'u1.jpg')} <= found
+    engine.scan_user(2, ['u2.jpg'])
+    engine.scan_user(1, ['u0.jpg', 'u1.jpg'])
+    engine.scan_user(3, ['u3.jpg'])
+
+    assert list(engine.partitions) == [1, 3]
+    assert engine.owners == {'u0.jpg': 1, 'u1.jpg': 1, 'u3.jpg': 3}
+
+
+def test_scan_reports_progress_when_nothing_is_embedded(crawl):
+    engine, _, download_dir = crawl
+    copies = download_dir.parent / 'copies'
+    copies.mkdir()
+    for name in ('u0.jpg', 'u1.jpg'):
+        shutil.copy(download_dir.parent / 'users' / name, copies / f'copy_{name}')
+    progress = {}
+    matches = engine.scan(str(copies), progress=lambda **counts: progress.update(counts))
+
+    assert {match['stage'] for match in matches} == {'phash'}
+    assert progress == {'matched': len(matches)} and len(matches) >= 2
+
+    broken = download_dir.parent / 'broken'
+    broken.mkdir()
+    (broken / 'truncated.jpg').write_bytes((copies / 'copy_u0.jpg').read_bytes()[:200])
+    progress.clear()
+    assert engine.scan(str(broken), progress=lambda **counts: progress.update(counts)) == []
+    assert progress == {'matched': 0}
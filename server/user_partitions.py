@@ -0,0 +1,63 @@
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from perceptual_hash import HashIndex, hamming_to_similarity
+
+
+class UserPartition:
+    """
+    the part of the user index holding one user's images: their embeddings to query the crawl index with
+    and their dHashes, small enough to keep per user
+    """
+
+    def __init__(self, user_id: int, dimension: int):
+        """
+        :param user_id: Users.user_id owning the images
+        :param dimension: embedding dimension
+        """
+        self.user_id = user_id
+        self.dimension = dimension
+        self.ids: Dict[str, int] = {}  # filename -> user index id
+        self.vectors: Dict[str, np.ndarray] = {}  # filename -> unit vector
+        self.hashes: Dict[str, int] = {}  # filename -> dHash
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, ids: np.ndarray, filenames: List[str], vectors: np.ndarray, hashes: List[Optional[int]]):
+        """
+        :param ids: user index ids of the images
+        :param vectors: (n, D) unit vectors
+        :param hashes: dHash of each image, None where it could not be computed
+        """
+        self.remove([filename for filename in filenames if filename in self.ids])  # re-uploads replace the old entry
+        if not len(ids):
+            return
+        for image_id, filename, vector, value in zip(ids.tolist(), filenames, vectors, hashes):
+            self.ids[filename] = image_id
+            self.vectors[filename] = vector
+            if value is not None:
+                self.hashes[filename] = value
+
+    def remove(self, filenames: List[str]):
+        for filename in filenames:
+            if self.ids.pop(filename, None) is not None:
+                self.vectors.pop(filename, None)
+                self.hashes.pop(filename, None)
+
+    def matrix(self) -> Tuple[List[str], np.ndarray]:
+        """:return: filenames and their (n, D) unit vectors, to query the crawl index with the whole portfolio"""
+        filenames = list(self.vectors)
+        if not filenames:
+            return [], np.empty((0, self.dimension), dtype='float32')
+        return filenames, np.vstack([self.vectors[filename] for filename in filenames])
+
+    def match_hashes(self, crawl_hashes: HashIndex, threshold: float) -> List[dict]:
+        """first stage: crawled images whose dHash is close to one of the user's images"""
+        matches = []
+        for filename, value in self.hashes.items():
+            for new_filename, distance in crawl_hashes.search(value):
+                score = hamming_to_similarity(distance)
+                if score >= threshold:
+                    matches.append({"new_filename": new_filename, "user_filename": filename, "similarity": score, "stage": "phash"})
+        return matches